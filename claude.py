@@ -1,20 +1,32 @@
 import pandas as pd
 import numpy as np
-import lightgbm as lgb
-import xgboost as xgb
-import catboost as cb
 import joblib
 import gc
-import optuna
+import os
+import json
+import hashlib
 from datetime import datetime, timedelta
 import warnings
-from sklearn.metrics import mean_absolute_error, mean_squared_error
-from sklearn.preprocessing import StandardScaler, PowerTransformer
-from sklearn.model_selection import TimeSeriesSplit
-from sklearn.pipeline import Pipeline
 from concurrent.futures import ProcessPoolExecutor
-from xgboost.callback import EarlyStopping
 import multiprocessing
+from claude_bagging import FoldBaggedModel
+from claude_panel import panel_time_series_features, panel_anomaly_stats
+from claude_promo_calendar import build_promotion_calendar, promotion_lookup, count_active_promotions
+from claude_rolling import rolling_distinct_count, group_codes
+from claude_receipts import aggregate_receipts, GUID_KEY_COLUMNS
+from claude_groupstats import grouped_statistics
+from claude_snapshot import save_state_snapshot
+from claude_prediction_cache import artifact_version, future_sales_key, cached_prediction
+from claude_diagnostics import (
+    segment_errors, prediction_histogram, plot_prediction_histogram, plot_segment_errors, plot_feature_importance
+)
+from claude_forecast_store import (
+    save_forecast, compact_forecast_store, open_forecast_store, close_forecast_store, lookup_forecast
+)
+from claude_cube import (
+    refresh_sales_cube, cube_store_performance_summary, cube_product_performance_summary,
+    cube_promotion_effectiveness, cube_seasonality_tables
+)
 
 # Отключение предупреждений для более чистого вывода
 warnings.filterwarnings('ignore')
@@ -40,18 +52,33 @@ def clean_column_to_int(series, false_values=('Нет', 'False', 'false', '-', '
 # ================================================
 # 1. Загрузка и начальная обработка данных
 # ================================================
-def load_data():
+def read_store_csv(path, stores=None, chunksize=200_000, **kwargs):
+    """
+    Чтение CSV с колонкой Магазин: stores - оставить только строки этих магазинов уже при чтении
+    (файл читается частями по chunksize строк, в памяти - только строки магазинов). None - весь файл
+    """
+    if stores is None:
+        return pd.read_csv(path, **kwargs)
+    stores = set(map(str, stores))
+    parts = [
+        chunk[chunk['Магазин'].astype(str).isin(stores)]
+        for chunk in pd.read_csv(path, chunksize=chunksize, **kwargs)
+    ]
+    return pd.concat(parts, ignore_index=True)
+
+def load_data(stores=None):
+    """stores: загрузить продажи и возвраты только этих магазинов (шард) - фильтр при чтении файлов"""
     print("DEBUG: Начало загрузки данных")
 
-    sales = pd.read_csv('data/sales.csv', parse_dates=['Дата'])
-    returns = pd.read_csv('data/returns.csv', parse_dates=['Дата_возврата'])
-    promotions = pd.read_csv('data/promotions.csv', parse_dates=['Дата_начала', 'Дата_окончания'], dayfirst=True)
-    holidays = pd.read_csv('data/holidays.csv', parse_dates=['Дата'])
-    
     ###############################################################################
-    sales = sales.head(100_000)  # Ограничить размер для теста
+    sales_rows = 100_000  # Ограничить размер для теста (первые строки файла, до фильтра по магазинам)
     ###############################################################################
 
+    sales = read_store_csv('data/sales.csv', stores, parse_dates=['Дата'], nrows=sales_rows)
+    returns = read_store_csv('data/returns.csv', stores, parse_dates=['Дата_возврата'])
+    promotions = pd.read_csv('data/promotions.csv', parse_dates=['Дата_начала', 'Дата_окончания'], dayfirst=True)
+    holidays = pd.read_csv('data/holidays.csv', parse_dates=['Дата'])
+
     # Если есть информация о категориях товаров - загрузим её
     try:
         products = pd.read_csv('data/products.csv')
@@ -62,22 +89,8 @@ def load_data():
 
     promotions['Это_уценка'] = clean_column_to_int(promotions['Это_уценка'])
 
-    # Фильтрация возвратов по существующим продажам
-    valid_guids = set(sales['GUID_продажи'])
-    returns = returns[returns['GUID_продажи'].isin(valid_guids)].copy()
-    returns_agg = returns.groupby(['GUID_продажи', 'SKU', 'Магазин']).agg(
-        Количество_возвращено=('Количество_возвращено', 'sum')
-    ).reset_index()
-
-    # Объединение продаж с возвратами
-    sales = pd.merge(sales, returns_agg, on=['GUID_продажи', 'SKU', 'Магазин'], how='left')
-    sales['Количество_возвращено'] = sales['Количество_возвращено'].fillna(0)
-    sales['Чистые_продажи'] = sales['Количество'] - sales['Количество_возвращено']
-
-    # Сумма чека и сертификата
-    sales['Сумма_чека'] = sales.groupby('GUID_продажи')['Цена_со_скидкой'].transform('sum')
-    negative_prices = sales[sales['Цена_со_скидкой'] < 0].groupby('GUID_продажи')['Цена_со_скидкой'].sum()
-    sales['Сумма_сертификата'] = sales['GUID_продажи'].map(negative_prices).fillna(0).abs()
+    # Возвраты, чистые продажи, суммы чека и сертификата - по 128-битным ключам GUID одним сортированным проходом
+    sales = aggregate_receipts(sales, returns)
 
     # Информация о праздниках
     sales = pd.merge(sales, holidays[['Дата', 'Название_праздника', 'Тип_праздника', 'Выходной']], on='Дата', how='left')
@@ -86,22 +99,21 @@ def load_data():
     sales['Выходной_день'] = sales['Выходной'].fillna(0).astype('int8')
     sales.drop(columns=['Название_праздника', 'Тип_праздника', 'Выходной'], inplace=True)
 
-    # Объединение с акциями
-    sales = pd.merge(sales, promotions, on='Номер_акции', how='left')
-    sales['Акция_активна'] = (
-        (sales['Номер_акции'] != 0)
-        & (sales['Дата'] >= sales['Дата_начала']) 
-        & (sales['Дата'] <= sales['Дата_окончания'])
-    ).astype('int8')
-    sales['Тип_акции'] = sales['Тип_акции'].fillna('Нет акции')
-    sales['Процент_скидки'] = sales['Процент_скидки'].fillna(0)
+    # Акции: тип, скидка, уценка и активность - одним поиском по календарю интервалов
+    promo = promotion_lookup(
+        build_promotion_calendar(promotions), sales['Номер_акции'], sales['Дата'],
+        sales['Магазин'] if 'Магазин' in promotions.columns else None
+    )
+    sales['Тип_акции'] = pd.Series(promo['type'], index=sales.index).fillna('Нет акции')
+    sales['Процент_скидки'] = promo['discount']
     
-    if sales['Это_уценка'].isna().any():
+    if np.isnan(promo['clearance']).any():
         print("Пропуски найдены в 'Это_уценка', они будут заполнены 0.")
-    sales['Это_уценка'] = sales['Это_уценка'].fillna(0).astype('int8')
+    sales['Это_уценка'] = np.nan_to_num(promo['clearance']).astype('int8')
+    sales['Акция_активна'] = promo['active']
     
     sales['Промо_код_применён'] = sales['Промо_код'].notnull().astype('int8')
-    sales.drop(columns=['Дата_начала', 'Дата_окончания', 'Промо_код'], inplace=True)
+    sales.drop(columns=['Промо_код'], inplace=True)
 
     # Добавление информации о товарах, если она доступна
     if has_product_info:
@@ -112,11 +124,72 @@ def load_data():
     sales = sales.astype({col: 'float32' for col in sales.select_dtypes('float64').columns})
     sales = sales.astype({col: 'int32' for col in sales.select_dtypes('int64').columns if col not in ['Магазин', 'SKU']})
     sales['SKU'] = sales['SKU'].astype(str).astype('category')  # SKU как категория
-    sales.drop(columns=['GUID_продажи'], inplace=True, errors='ignore')
+    sales.drop(columns=['GUID_продажи'] + GUID_KEY_COLUMNS, inplace=True, errors='ignore')
 
     print("DEBUG: Данные загружены. Размер DataFrame:", sales.shape)
     return sales, holidays, promotions
 
+# Агрегация строк чеков до дневного зерна (SKU, Магазин, Дата)
+DAILY_KEYS = ['SKU', 'Магазин', 'Дата']
+DAILY_SUM_COLUMNS = ['Количество', 'Количество_возвращено', 'Чистые_продажи', 'Сумма_сертификата']
+DAILY_WEIGHTED_PRICES = ['Цена_со_скидкой', 'Цена_без_скидки']
+DAILY_MAX_COLUMNS = ['Акция_активна', 'Промо_код_применён', 'Весовой']
+DAILY_MEAN_COLUMNS = ['Карта_клиента', 'Сумма_чека']
+
+def aggregate_daily_sales(sales):
+    """
+    Схлопывание строк чеков в одну строку на (SKU, Магазин, Дата), чтобы лаги и окна
+    считались по дням, а не по транзакциям:
+    - количества и возвраты суммируются;
+    - цены - средние, взвешенные по проданному количеству (без продаж - простое среднее);
+    - флаги акций и промокодов - максимум за день, атрибуты акции берутся из строки с активной акцией;
+    - Карта_клиента и Сумма_чека - доля/среднее по строкам дня;
+    - остальные колонки (атрибуты даты и товара) - первое значение
+    """
+    print("DEBUG: Агрегация продаж до дневного зерна")
+    t0 = datetime.now()
+    rows_before = len(sales)
+
+    # Строки с активной акцией - первыми в своем дне, чтобы 'first' брал атрибуты действующей акции
+    sales = sales.sort_values(DAILY_KEYS + ['Акция_активна'], ascending=[True, True, True, False], kind='stable')
+    weights = sales['Количество'].clip(lower=0).astype('float64')
+    sales = sales.assign(
+        _вес=weights,
+        **{f'_взв_{col}': sales[col].astype('float64') * weights for col in DAILY_WEIGHTED_PRICES}
+    )
+
+    aggregations = {}
+    for col in sales.columns:
+        if col in DAILY_KEYS:
+            continue
+        if col in DAILY_SUM_COLUMNS or col == '_вес' or col.startswith('_взв_'):
+            aggregations[col] = 'sum'
+        elif col in DAILY_MAX_COLUMNS:
+            aggregations[col] = 'max'
+        elif col in DAILY_MEAN_COLUMNS or col in DAILY_WEIGHTED_PRICES:
+            aggregations[col] = 'mean'
+        else:
+            aggregations[col] = 'first'
+
+    daily = sales.groupby(DAILY_KEYS, observed=True, sort=True).agg(aggregations).reset_index()
+
+    # Взвешенные цены; дни без положительных продаж (только возвраты) - простое среднее
+    has_weight = daily['_вес'] > 0
+    for col in DAILY_WEIGHTED_PRICES:
+        weighted = daily[f'_взв_{col}'] / daily['_вес'].where(has_weight)
+        daily[col] = weighted.where(has_weight, daily[col]).astype('float32')
+    daily.drop(columns=['_вес'] + [f'_взв_{col}' for col in DAILY_WEIGHTED_PRICES], inplace=True)
+
+    for col in DAILY_SUM_COLUMNS + DAILY_MEAN_COLUMNS:
+        if col in daily.columns:
+            daily[col] = daily[col].astype('float32')
+    daily['SKU'] = daily['SKU'].astype(sales['SKU'].dtype)
+    daily = daily[[col for col in sales.columns if col in daily.columns]]
+
+    print(f"DEBUG: Дневная агрегация: {rows_before} -> {len(daily)} строк "
+          f"({rows_before / max(len(daily), 1):.1f}x) за {(datetime.now() - t0).total_seconds():.1f}s")
+    return daily
+
 # ================================================
 # 2. Новые и расширенные признаки (feature engineering)
 # ================================================
@@ -143,19 +216,23 @@ def create_price_features(df):
 
 def create_promotion_features(df, promotions_df):
     """Расширенные признаки акций"""
-    # Акции и уценки (категориальные)
-    promo_typemap = promotions_df.set_index('Номер_акции')['Тип_акции'].to_dict()
-    clearance_map = promotions_df.set_index('Номер_акции')['Это_уценка'].to_dict()
-    df['Тип_акции_расширенный'] = df['Номер_акции'].map(promo_typemap).fillna('Нет акции')
-    df['Является_уценкой'] = df['Номер_акции'].map(clearance_map).fillna(0).astype('int8')
+    # Акции и уценки (категориальные) - по календарю акций
+    calendar = build_promotion_calendar(promotions_df)
+    stores = df['Магазин'] if 'Магазин' in promotions_df.columns else None
+    promo = promotion_lookup(calendar, df['Номер_акции'], df['Дата'], stores)
+    df['Тип_акции_расширенный'] = pd.Series(promo['type'], index=df.index).fillna('Нет акции')
+    df['Является_уценкой'] = np.nan_to_num(promo['clearance']).astype('int8')
+    
+    # Акций по календарю за последние 30 дней (известно заранее, в том числе для будущих дат)
+    df['Акций_в_календаре_30д'] = count_active_promotions(calendar, df['Дата'], 30, stores)
     
     # Количество активных акций на данную дату в магазине
     df['Кол_акций_в_магазине'] = df.groupby(['Магазин', 'Дата'])['Акция_активна'].transform('sum').astype('int16')
     
-    # Среднее количество акций на товар за последний месяц
-    df['Акций_за_30д_товар'] = df.groupby(['SKU'])['Акция_активна'].transform(
-        lambda x: x.rolling(30, min_periods=1).mean()
-    ).astype('float32')
+    # Число различных активных акций товара за последние 30 дней (по всем магазинам)
+    df['Акций_за_30д_товар'] = rolling_distinct_count(
+        group_codes(df, ['SKU']), df['Дата'], df['Номер_акции'].where(df['Акция_активна'] == 1), 30
+    ).astype('int16')
     
     # Средняя скидка по этому товару
     df['Скидка_средняя_товар'] = df.groupby(['SKU'])['Скидка_фактическая'].transform('mean').astype('float32')
@@ -236,7 +313,20 @@ def add_holiday_features(df, holidays_df):
     
     return df
 
-def create_lags_vectorized(df, lags=[1, 2, 3, 7, 14, 21, 30, 60, 90], target_col='Чистые_продажи'):
+# Лаги и окна по умолчанию (используются и при отборе признаков для инференса)
+LAG_DAYS = [1, 2, 3, 7, 14, 21, 30, 60, 90]
+ROLLING_WINDOWS = [3, 7, 14, 30, 90]
+ROLLING_STATS = ['MA', 'Median', 'Max', 'Min', 'Std']
+# Признаки трендов и колонки, от которых они зависят
+TREND_DEPENDENCIES = {
+    'Trend_1_7': ['Lag_1', 'MA_7'],
+    'Trend_7_30': ['MA_7', 'MA_30'],
+    'Trend_slope_7': [],
+    'Acceleration_7': ['Trend_slope_7'],
+    'YoY_change': [],
+}
+
+def create_lags_vectorized(df, lags=LAG_DAYS, target_col='Чистые_продажи'):
     """Создание лаговых признаков"""
     print(f"DEBUG: Создание {len(lags)} лаговых признаков")
     group = df.groupby(['SKU', 'Магазин'], observed=True)[target_col]
@@ -249,27 +339,38 @@ def create_lags_vectorized(df, lags=[1, 2, 3, 7, 14, 21, 30, 60, 90], target_col
     
     return df
 
-def create_rolling_vectorized(df, windows=[3, 7, 14, 30, 90], target_col='Чистые_продажи'):
-    """Создание признаков скользящих средних"""
+def create_rolling_vectorized(df, windows=ROLLING_WINDOWS, target_col='Чистые_продажи', columns=None):
+    """
+    Создание признаков скользящих средних.
+    columns: считать только перечисленные колонки (MA_7, Std_30, ...); None - все статистики всех окон
+    """
     print(f"DEBUG: Создание скользящих средних для {len(windows)} окон")
     df = df.sort_values(by=['SKU', 'Магазин', 'Дата'])
     group = df.groupby(['SKU', 'Магазин'], observed=True)[target_col]
     
+    def needed(name):
+        return columns is None or name in columns
+    
     for window in windows:
         # Скользящее среднее
-        df[f'MA_{window}'] = group.transform(lambda x: x.rolling(window, min_periods=1).mean()).astype('float32')
+        if needed(f'MA_{window}'):
+            df[f'MA_{window}'] = group.transform(lambda x: x.rolling(window, min_periods=1).mean()).astype('float32')
         
         # Скользящая медиана (более устойчива к выбросам)
-        df[f'Median_{window}'] = group.transform(lambda x: x.rolling(window, min_periods=1).median()).astype('float32')
+        if needed(f'Median_{window}'):
+            df[f'Median_{window}'] = group.transform(lambda x: x.rolling(window, min_periods=1).median()).astype('float32')
         
         # Максимум за период
-        df[f'Max_{window}'] = group.transform(lambda x: x.rolling(window, min_periods=1).max()).astype('float32')
+        if needed(f'Max_{window}'):
+            df[f'Max_{window}'] = group.transform(lambda x: x.rolling(window, min_periods=1).max()).astype('float32')
         
         # Минимум за период
-        df[f'Min_{window}'] = group.transform(lambda x: x.rolling(window, min_periods=1).min()).astype('float32')
+        if needed(f'Min_{window}'):
+            df[f'Min_{window}'] = group.transform(lambda x: x.rolling(window, min_periods=1).min()).astype('float32')
         
         # Стандартное отклонение (волатильность продаж)
-        df[f'Std_{window}'] = group.transform(lambda x: x.rolling(window, min_periods=1).std()).fillna(0).astype('float32')
+        if needed(f'Std_{window}'):
+            df[f'Std_{window}'] = group.transform(lambda x: x.rolling(window, min_periods=1).std()).fillna(0).astype('float32')
     
     return df
 
@@ -278,41 +379,47 @@ def create_advanced_volume_features(df):
     # Флаг весового товара и его преобразование
     df['Весовой'] = df['Весовой'].astype('int8')
     
+    # Статистики групп (весовые/штучные в магазине) одной сортировкой: среднее и квартили продаж, средняя цена
+    groups = group_codes(df, ['Весовой', 'Магазин'])
+    sales_stats = grouped_statistics(groups, df['Чистые_продажи'], quantiles=[0.25, 0.75], mean=True)
+    avg_price = grouped_statistics(groups, df['Цена_со_скидкой'], mean=True)['mean']
+    
     # Среднее кол-во продаж по весовым и штучным товарам раздельно
-    df['Среднее_по_весовой_группе'] = df.groupby(['Весовой', 'Магазин'])['Чистые_продажи'].transform('mean').astype('float32')
+    df['Среднее_по_весовой_группе'] = sales_stats['mean'].astype('float32')
     
     # Отношение продаж к среднему в своей группе (весовые/штучные)
     df['Отношение_к_среднему_группы'] = (df['Чистые_продажи'] / df['Среднее_по_весовой_группе']).fillna(1).astype('float32')
     
-    # Отдельно рассчитываем статистики для весовых и штучных
+    # Положение продаж между квартилями группы
+    spread = sales_stats[0.75] - sales_stats[0.25]
+    sales_quantile = pd.Series(
+        (df['Чистые_продажи'].to_numpy(dtype='float64') - sales_stats[0.25]) / np.where(spread == 0, 1, spread)
+    ).fillna(0.5).clip(0, 1).to_numpy()
+    
+    # Колонки для весовых и штучных раздельно (у строк другого типа - 0)
+    produced = ['Среднее_по_весовой_группе', 'Отношение_к_среднему_группы']
     for is_weighted in [0, 1]:
-        subset = df[df['Весовой'] == is_weighted]
-        if subset.empty:
+        in_group = (df['Весовой'] == is_weighted).to_numpy()
+        if not in_group.any():
             continue
             
         weight_type = 'весовой' if is_weighted else 'штучный'
-        
-        # Средняя цена в группе
-        avg_price = subset.groupby(['Магазин'])['Цена_со_скидкой'].transform('mean')
-        df.loc[df['Весовой'] == is_weighted, f'Цена_отн_средней_{weight_type}'] = (
-            subset['Цена_со_скидкой'] / avg_price
+        df[f'Цена_отн_средней_{weight_type}'] = np.where(
+            in_group, df['Цена_со_скидкой'].to_numpy(dtype='float64') / avg_price, np.nan
         ).astype('float32')
-        
-        # Квантили продаж в группе
-        q75 = subset.groupby(['Магазин'])['Чистые_продажи'].transform(lambda x: x.quantile(0.75))
-        q25 = subset.groupby(['Магазин'])['Чистые_продажи'].transform(lambda x: x.quantile(0.25))
-        df.loc[df['Весовой'] == is_weighted, f'Продажи_квантиль_{weight_type}'] = (
-            (subset['Чистые_продажи'] - q25) / (q75 - q25).replace(0, 1)
-        ).fillna(0.5).clip(0, 1).astype('float32')
-    
-    # Заполняем пропуски образовавшиеся в процессе
-    for col in df.columns:
-        if df[col].isna().any():
-            if df[col].dtype == 'float32' or df[col].dtype == 'float64':
-                df[col] = df[col].fillna(0).astype('float32')
+        df[f'Продажи_квантиль_{weight_type}'] = np.where(in_group, sales_quantile, np.nan).astype('float32')
+        produced += [f'Цена_отн_средней_{weight_type}', f'Продажи_квантиль_{weight_type}']
+    
+    # Заполняем пропуски только в колонках этапа
+    df[produced] = df[produced].fillna(0)
     
     return df
 
+def fill_unknown_target(df):
+    """Продажи будущих дат неизвестны - нули для признаков магазина и временных рядов"""
+    df['Чистые_продажи'] = df['Чистые_продажи'].fillna(0).astype('float32')
+    return df
+
 def create_store_features(df):
     """Создание признаков на основе магазина"""
     # Общая активность магазина (средний объем продаж)
@@ -353,26 +460,37 @@ def create_cross_features(df):
     
     return df
 
-def compute_trends(df):
-    """Создание признаков трендов продаж"""
+def compute_trends(df, features=None):
+    """
+    Создание признаков трендов продаж.
+    features: считать только перечисленные признаки трендов (None - все)
+    """
+    def needed(name):
+        return features is None or name in features
+    
     # Тренд между последним известным значением и скользящим средним
-    df['Trend_1_7'] = (df['Lag_1'] - df['MA_7']).astype('float32')
-    df['Trend_7_30'] = (df['MA_7'] - df['MA_30']).astype('float32')
+    if needed('Trend_1_7'):
+        df['Trend_1_7'] = (df['Lag_1'] - df['MA_7']).astype('float32')
+    if needed('Trend_7_30'):
+        df['Trend_7_30'] = (df['MA_7'] - df['MA_30']).astype('float32')
     
     # Тренд за последнюю неделю (наклон линии тренда)
-    df['Trend_slope_7'] = df.groupby(['SKU', 'Магазин'])['Чистые_продажи'].transform(
-        lambda x: (x.rolling(7, min_periods=3).apply(
-            lambda y: np.nan if len(y) < 3 else np.polyfit(np.arange(len(y)), y, 1)[0], raw=True)
-        )
-    ).fillna(0).astype('float32')
+    if needed('Trend_slope_7') or needed('Acceleration_7'):
+        df['Trend_slope_7'] = df.groupby(['SKU', 'Магазин'])['Чистые_продажи'].transform(
+            lambda x: (x.rolling(7, min_periods=3).apply(
+                lambda y: np.nan if len(y) < 3 else np.polyfit(np.arange(len(y)), y, 1)[0], raw=True)
+            )
+        ).fillna(0).astype('float32')
     
     # Ускорение/замедление продаж (вторая производная)
-    df['Acceleration_7'] = df.groupby(['SKU', 'Магазин'])['Trend_slope_7'].diff().fillna(0).astype('float32')
+    if needed('Acceleration_7'):
+        df['Acceleration_7'] = df.groupby(['SKU', 'Магазин'])['Trend_slope_7'].diff().fillna(0).astype('float32')
     
     # Изменение относительно того же периода в прошлом году (сезонность)
-    df['YoY_change'] = (
-        df['Чистые_продажи'] / df.groupby(['SKU', 'Магазин', 'День_года'])['Чистые_продажи'].shift(1)
-    ).fillna(1).replace([np.inf, -np.inf], 1).astype('float32')
+    if needed('YoY_change'):
+        df['YoY_change'] = (
+            df['Чистые_продажи'] / df.groupby(['SKU', 'Магазин', 'День_года'])['Чистые_продажи'].shift(1)
+        ).fillna(1).replace([np.inf, -np.inf], 1).astype('float32')
     
     return df
 
@@ -400,6 +518,7 @@ def create_target_encodings(df, target_col='Чистые_продажи'):
 
 def transform_target_variable(df, target_col='Чистые_продажи'):
     """Трансформация целевой переменной для улучшения распределения"""
+    from sklearn.preprocessing import PowerTransformer
     # Ограничение выбросов
     upper_limit = df[target_col].quantile(0.995)
     df[target_col] = df[target_col].clip(0, upper_limit)
@@ -421,8 +540,135 @@ def transform_target_variable(df, target_col='Чистые_продажи'):
     
     return df
 
-def feature_engineering(sales_df, holidays_df, promotions_df):
-    """Комплексное создание признаков"""
+def time_series_features(df, time_series_backend='pandas', lags=LAG_DAYS, windows=ROLLING_WINDOWS,
+                         rolling_columns=None, trends=None):
+    """
+    Лаги, скользящие статистики и тренды.
+    time_series_backend: 'pandas' - по строкам групп, 'panel' - плотная панель рядов по календарным дням
+    (claude_panel, нужно дневное зерно)
+    """
+    if time_series_backend == 'panel':
+        return panel_time_series_features(df, lags, windows, ROLLING_STATS, rolling_columns, trends)
+    df = create_lags_vectorized(df, lags=lags)
+    df = create_rolling_vectorized(df, windows=windows, columns=rolling_columns)
+    return compute_trends(df, features=trends)
+
+# Колонки, нужные локальным по ряду этапам (лаги, окна, тренды)
+SERIES_LOCAL_INPUTS = ['SKU', 'Магазин', 'Дата', 'Чистые_продажи', 'День_года']
+
+def share_series_inputs(df):
+    """
+    Входы локальных по ряду этапов в разделяемой памяти: категории - кодами, даты - int64.
+    Возвращает блоки разделяемой памяти (закрывает и удаляет вызывающий) и описание для воркеров.
+    """
+    from multiprocessing import shared_memory
+
+    sku_codes, sku_categories = df['SKU'].cat.codes.to_numpy(), df['SKU'].cat.categories
+    store_codes, store_values = pd.factorize(df['Магазин'])
+    arrays = {
+        'SKU': sku_codes,
+        'Магазин': store_codes,
+        'Дата': df['Дата'].to_numpy().view('int64'),
+        'Чистые_продажи': df['Чистые_продажи'].to_numpy(),
+        'День_года': df['День_года'].to_numpy(),
+    }
+    blocks, spec = [], {'sku_categories': sku_categories, 'store_values': store_values, 'columns': {}}
+    for col, values in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+        blocks.append(block)
+        spec['columns'][col] = (block.name, values.dtype.str, len(values))
+    return blocks, spec
+
+def _series_partition_features(spec, positions):
+    """
+    Воркер: лаги, окна и тренды для строк positions (целые SKU) по входам из разделяемой памяти.
+    Возвращает позиции строк и новые колонки в порядке их создания.
+    """
+    from multiprocessing import shared_memory
+
+    blocks, data = [], {}
+    for col, (name, dtype, length) in spec['columns'].items():
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        data[col] = np.ndarray((length,), dtype=dtype, buffer=block.buf)[positions]
+    for block in blocks:
+        block.close()
+
+    part = pd.DataFrame({
+        'SKU': pd.Categorical.from_codes(data['SKU'], categories=spec['sku_categories']),
+        'Магазин': spec['store_values'].take(data['Магазин']),
+        'Дата': data['Дата'].view('datetime64[ns]'),
+        'Чистые_продажи': data['Чистые_продажи'],
+        'День_года': data['День_года'],
+    }, index=positions)
+    part = time_series_features(part)
+    new_columns = [col for col in part.columns if col not in SERIES_LOCAL_INPUTS]
+    return part.index.to_numpy(), {col: part[col].to_numpy() for col in new_columns}
+
+def parallel_time_series_features(df, n_jobs=None, partitions_per_job=4):
+    """
+    Лаги, окна и тренды в пуле процессов: строки делятся на корзины по хешу SKU (ряды товара
+    целиком в одной корзине, в т.ч. для медианы по SKU), входы передаются через разделяемую
+    память, воркеры возвращают только новые колонки. Результат совпадает с time_series_features.
+    """
+    n_jobs = n_jobs or os.cpu_count() or 1
+    n_partitions = max(1, n_jobs * partitions_per_job)
+    t0 = datetime.now()
+    # flush: буфер stdout не должен копироваться в дочерние процессы
+    print(f"DEBUG: Признаки временных рядов в {n_jobs} процессах, корзин по SKU: {n_partitions}", flush=True)
+
+    sku_hash = pd.util.hash_array(df['SKU'].cat.categories.astype(str).to_numpy(dtype=object))
+    buckets = (sku_hash % n_partitions)[df['SKU'].cat.codes.to_numpy()]
+    partitions = [np.flatnonzero(buckets == bucket) for bucket in range(n_partitions)]
+    partitions = [positions for positions in partitions if len(positions)]
+    if not partitions:
+        # Пустая таблица (например, шард без строк) - пул процессов не нужен
+        return time_series_features(df)
+
+    blocks, spec = share_series_inputs(df)
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_series_partition_features, [spec] * len(partitions), partitions))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    # Сборка колонок по позициям строк, в порядке создания
+    for col in results[0][1]:
+        values = np.empty(len(df), dtype=results[0][1][col].dtype)
+        for positions, columns in results:
+            values[positions] = columns[col]
+        df[col] = values
+
+    # Порядок строк как после create_rolling_vectorized
+    df = df.sort_values(by=['SKU', 'Магазин', 'Дата'])
+    print(f"DEBUG: Признаки временных рядов готовы за {(datetime.now() - t0).total_seconds():.1f}s")
+    return df
+
+def feature_engineering(sales_df, holidays_df, promotions_df, time_series_backend='pandas', engine='pandas', n_jobs=1,
+                        stage_cache=False):
+    """
+    Комплексное создание признаков.
+    engine='polars': те же этапы одним ленивым многопоточным запросом Polars (claude_lazy),
+    результат совпадает с pandas-путем колонка в колонку
+    n_jobs > 1: локальные по ряду этапы (лаги, окна, тренды) - в пуле процессов по корзинам SKU
+    (parallel_time_series_features); общие этапы (магазины, ранги, target encoding) - по всей таблице
+    stage_cache: результаты этапов кэшируются на диске (claude_stages), неизменившиеся этапы загружаются;
+    n_jobs учитывается, с engine='polars' кэш этапов не используется
+    """
+    if engine == 'polars':
+        if time_series_backend == 'panel':
+            raise ValueError("engine='polars' вычисляет лаги и окна сам - несовместим с time_series_backend='panel'")
+        if stage_cache:
+            print("DEBUG: engine='polars' - кэш этапов не используется, признаки строятся одним запросом Polars")
+        from claude_lazy import lazy_feature_engineering
+        return lazy_feature_engineering(sales_df, holidays_df, promotions_df, LAG_DAYS, ROLLING_WINDOWS)
+    if stage_cache:
+        from claude_stages import cached_feature_engineering
+        return cached_feature_engineering(sales_df, holidays_df, promotions_df, time_series_backend, n_jobs)
+    
     print("DEBUG: Начало создания признаков")
     
     # Базовые ценовые признаки
@@ -443,14 +689,11 @@ def feature_engineering(sales_df, holidays_df, promotions_df):
     # Признаки магазинов
     sales_df = create_store_features(sales_df)
     
-    # Лаговые признаки
-    sales_df = create_lags_vectorized(sales_df)
-    
-    # Скользящие средние и другие статистики
-    sales_df = create_rolling_vectorized(sales_df)
-    
-    # Признаки трендов
-    sales_df = compute_trends(sales_df)
+    # Лаговые признаки, скользящие статистики и тренды
+    if n_jobs != 1 and time_series_backend == 'pandas':
+        sales_df = parallel_time_series_features(sales_df, n_jobs)
+    else:
+        sales_df = time_series_features(sales_df, time_series_backend)
     
     # Кросс-признаки
     sales_df = create_cross_features(sales_df)
@@ -468,10 +711,128 @@ def feature_engineering(sales_df, holidays_df, promotions_df):
 # ================================================
 # 3. Подготовка данных для обучения модели
 # ================================================
-def prepare_train_test_data(df, test_size_days=30, target_col='Чистые_продажи', transformed_target='log_Чистые_продажи'):
-    """Подготовка тренировочных и тестовых данных"""
+def build_feature_block(df, test_size_days=30, target_col='Чистые_продажи', transformed_target='log_Чистые_продажи',
+                        features=None):
+    """
+    Единый блок признаков для LightGBM, XGBoost и CatBoost.
+    Строки упорядочены по дате, поэтому train/test - это диапазоны строк (срезы без копий).
+    Числовые признаки и коды категорий лежат в одной C-непрерывной float32-матрице,
+    категориальные признаки - в последних колонках (пропущенная категория = NaN).
+    features: отобранный набор признаков (см. select_features); None - все колонки
+    """
+    print("DEBUG: Подготовка единого блока признаков")
+    
+    # Порядок строк по дате без сортировки всего датафрейма
+    order = np.argsort(df['Дата'].to_numpy(), kind='stable')
+    dates = df['Дата'].to_numpy()[order]
+    split_date = dates[-1] - np.timedelta64(test_size_days, 'D')
+    n_train = int(np.searchsorted(dates, split_date, side='right'))
+    
+    exclude_cols = ['Дата', target_col, 'log_Чистые_продажи', 'boxcox_Чистые_продажи']
+    feature_cols = [col for col in df.columns if col not in exclude_cols and (features is None or col in features)]
+    cat_features = [
+        col for col in feature_cols
+        if isinstance(df[col].dtype, pd.CategoricalDtype) or df[col].dtype == object
+    ]
+    num_features = [col for col in feature_cols if col not in cat_features]
+    
+    X = np.empty((len(df), len(feature_cols)), dtype='float32')
+    for j, col in enumerate(num_features):
+        X[:, j] = df[col].to_numpy(dtype='float32', na_value=np.nan)[order]
+    
+    # Словари категорий сохраняются вместе с моделью для такого же кодирования на инференсе
+    categories = {}
+    for j, col in enumerate(cat_features, start=len(num_features)):
+        values = df[col] if isinstance(df[col].dtype, pd.CategoricalDtype) else df[col].astype('category')
+        categories[col] = values.cat.categories
+        codes = values.cat.codes.to_numpy()[order].astype('float32')
+        codes[codes < 0] = np.nan
+        X[:, j] = codes
+    
+    block = {
+        'X': X,
+        'y': df[transformed_target].to_numpy(dtype='float32')[order],
+        'y_original': df[target_col].to_numpy(dtype='float32')[order],
+        'train': slice(0, n_train),
+        'test': slice(n_train, len(df)),
+        'feature_names': num_features + cat_features,
+        'cat_features': cat_features,
+        'categories': categories,
+        'order': order,
+    }
+    
+    print(f"DEBUG: Блок признаков {X.shape}, train: {n_train} строк, test: {len(df) - n_train} строк")
+    return block
+
+def block_frame(block, part):
+    """DataFrame-представление части блока (срез строк float32-матрицы, без копирования)"""
+    frame = pd.DataFrame(block['X'][part], columns=block['feature_names'], copy=False)
+    frame.attrs['categories'] = block['categories']
+    return frame
+
+# Категория вне словаря обучения для CatBoost (как код -1 в int32-блоке)
+CATBOOST_UNKNOWN_CATEGORY = '-1'
+
+def to_catboost_frame(X, cat_features):
+    """
+    CatBoost принимает категориальные признаки только как int/str, поэтому коды категорий
+    из float32-блока выносятся в отдельный int32-блок (NaN -> -1). Числовая часть остается срезом.
+    Пропуски в pandas-категориях (значения вне словаря обучения) заменяются на CATBOOST_UNKNOWN_CATEGORY.
+    """
+    missing_cats = [
+        col for col in (cat_features or [])
+        if col in X.columns and isinstance(X[col].dtype, pd.CategoricalDtype) and X[col].isna().any()
+    ]
+    if missing_cats:
+        X = X.copy()
+        for col in missing_cats:
+            if CATBOOST_UNKNOWN_CATEGORY not in X[col].cat.categories:
+                X[col] = X[col].cat.add_categories([CATBOOST_UNKNOWN_CATEGORY])
+            X[col] = X[col].fillna(CATBOOST_UNKNOWN_CATEGORY)
+    
+    float_cats = [col for col in (cat_features or []) if col in X.columns and X[col].dtype.kind == 'f']
+    if not float_cats:
+        return X
+    
+    codes = pd.DataFrame(
+        {col: np.nan_to_num(X[col].to_numpy(), nan=-1).astype('int32') for col in float_cats},
+        index=X.index
+    )
+    if X.columns[-len(float_cats):].tolist() == float_cats:
+        numeric = X.iloc[:, :-len(float_cats)]
+    else:
+        numeric = X.drop(columns=float_cats)
+    return pd.concat([numeric, codes], axis=1, copy=False)
+
+def _index_to_slice(idx):
+    """Непрерывный массив индексов (как у TimeSeriesSplit) превращается в срез - выборка без копии"""
+    if len(idx) > 0 and idx[-1] - idx[0] + 1 == len(idx):
+        return slice(int(idx[0]), int(idx[-1]) + 1)
+    return idx
+
+def prepare_train_test_data(df, test_size_days=30, target_col='Чистые_продажи', transformed_target='log_Чистые_продажи', zero_copy=False,
+                            features=None):
+    """
+    Подготовка тренировочных и тестовых данных.
+    zero_copy: X_train/X_test - представления единого float32-блока (см. build_feature_block),
+    train_df в этом режиме не создается (None), test_df - строки тестового периода.
+    features: отобранный набор признаков (см. select_features); None - все колонки
+    """
     print("DEBUG: Подготовка данных для модели")
     
+    if zero_copy:
+        block = build_feature_block(df, test_size_days, target_col, transformed_target, features=features)
+        train, test = block['train'], block['test']
+        
+        X_train, X_test = block_frame(block, train), block_frame(block, test)
+        y_train = pd.Series(block['y'][train], name=transformed_target, copy=False)
+        y_test = pd.Series(block['y'][test], name=transformed_target, copy=False)
+        y_test_original = pd.Series(block['y_original'][test], name=target_col, copy=False)
+        test_df = df.iloc[block['order'][test]].reset_index(drop=True)
+        
+        print("DEBUG: Подготовка данных завершена")
+        return X_train, y_train, X_test, y_test, y_test_original, block['cat_features'], None, test_df
+    
     # Сортировка по дате
     df = df.sort_values('Дата')
     
@@ -484,10 +845,10 @@ def prepare_train_test_data(df, test_size_days=30, target_col='Чистые_пр
     
     # Исключаем колонки, которые не должны быть в признаках
     exclude_cols = ['Дата', target_col, 'log_Чистые_продажи', 'boxcox_Чистые_продажи']
-    feature_cols = [col for col in df.columns if col not in exclude_cols]
+    feature_cols = [col for col in df.columns if col not in exclude_cols and (features is None or col in features)]
     
     # Для категориальных признаков создаем список
-    cat_features = df.select_dtypes(include=['category']).columns.tolist()
+    cat_features = [col for col in df.select_dtypes(include=['category']).columns if col in feature_cols]
     
     # Подготовка данных для обучения
     X_train = train_df[feature_cols]
@@ -500,6 +861,13 @@ def prepare_train_test_data(df, test_size_days=30, target_col='Чистые_пр
         for col in df.select_dtypes(include='object').columns:
             df[col] = df[col].astype('category')
     
+    # Тест кодируется словарями обучения (одинаковые коды для XGBoost и на инференсе),
+    # новые значения теста дописываются в конец словаря и не сдвигают обучающие коды
+    for col in X_train.select_dtypes(include='category').columns:
+        train_categories = X_train[col].cat.categories
+        new_categories = X_test[col].cat.categories.difference(train_categories)
+        X_test[col] = X_test[col].cat.set_categories(train_categories.append(new_categories))
+    
     # Сохраняем оригинальные значения для обратного преобразования
     y_test_original = test_df[target_col]
     
@@ -507,11 +875,333 @@ def prepare_train_test_data(df, test_size_days=30, target_col='Чистые_пр
     
     return X_train, y_train, X_test, y_test, y_test_original, cat_features, train_df, test_df
 
+def encode_xgb_categories(df):
+    """Коды категорий для XGBoost (float32-блок уже содержит коды - копия не нужна)"""
+    cat_cols = df.select_dtypes(include='category').columns
+    if len(cat_cols) == 0:
+        return df
+    df = df.copy()
+    for col in cat_cols:
+        df[col] = df[col].cat.codes
+    return df
+
+def category_vocabularies(X):
+    """Словари категорий обучающей выборки {признак: categories} - общие для обучения и инференса"""
+    if X.attrs.get('categories'):
+        return dict(X.attrs['categories'])
+    return {col: X[col].cat.categories for col in X.select_dtypes(include='category').columns}
+
+def xgb_categorical_kwargs(X, native=False):
+    """
+    Аргументы DMatrix/QuantileDMatrix для нативных категорий XGBoost (enable_categorical,
+    разбиения по группам категорий). Коды float32-блока помечаются типом 'c' без копирования,
+    pandas category передается как есть.
+    """
+    if not native:
+        return {}
+    block_categories = X.attrs.get('categories') or {}
+    if block_categories:
+        return {
+            'enable_categorical': True,
+            'feature_types': ['c' if col in block_categories else 'q' for col in X.columns]
+        }
+    return {'enable_categorical': True}
+
+def apply_category_vocabularies(X, vocabularies):
+    """
+    Перекодировка категорий строго по словарям обучения (значение вне словаря = NaN).
+    XGBoost с нативными категориями не принимает категории, которых не было при обучении,
+    а дообучаемые модели должны видеть те же коды, что при обучении (новые SKU и магазины
+    сдвигают коды). Коды float32-блока пересчитываются из его словарей в словари обучения.
+    """
+    if not vocabularies:
+        return X
+    if X.attrs.get('categories'):
+        return _recode_block_categories(X, vocabularies)
+    def matches(col):
+        return isinstance(X[col].dtype, pd.CategoricalDtype) and X[col].cat.categories.equals(vocabularies[col])
+    
+    cat_cols = [col for col in vocabularies if col in X.columns and X[col].dtype.kind != 'f' and not matches(col)]
+    if not cat_cols:
+        return X
+    X = X.copy()
+    for col in cat_cols:
+        X[col] = pd.Categorical(X[col], categories=vocabularies[col])
+    return X
+
+def _recode_block_categories(X, vocabularies):
+    """Коды категорий float32-блока по словарям обучения (категория вне словаря = NaN)"""
+    block_categories = X.attrs['categories']
+    cat_cols = [
+        col for col in vocabularies
+        if col in X.columns and col in block_categories and not block_categories[col].equals(vocabularies[col])
+    ]
+    if not cat_cols:
+        return X
+    X = X.copy()
+    categories = dict(block_categories)
+    for col in cat_cols:
+        mapping = pd.Index(vocabularies[col]).get_indexer(block_categories[col]).astype('float32')
+        mapping[mapping < 0] = np.nan
+        codes = X[col].to_numpy()
+        known = ~np.isnan(codes)
+        recoded = np.full(len(codes), np.nan, dtype='float32')
+        recoded[known] = mapping[codes[known].astype('int64')]
+        X[col] = recoded
+        categories[col] = vocabularies[col]
+    X.attrs['categories'] = categories
+    return X
+
+def xgb_matrix(X, label=None, native=False, vocabularies=None):
+    """
+    DMatrix для обучения/прогноза XGBoost.
+    native=False - категории заменяются кодами (копия фрейма), native=True - нативные категории.
+    vocabularies: словари обучения; pandas-категории перекодируются по ним перед построением матрицы
+    """
+    import xgboost as xgb
+    X = apply_category_vocabularies(X, vocabularies)
+    if not native:
+        return xgb.DMatrix(encode_xgb_categories(X), label=label)
+    return xgb.DMatrix(X, label=label, **xgb_categorical_kwargs(X, native=True))
+
+def xgb_is_native_categorical(booster):
+    """Обучена ли модель XGBoost на нативных категориях (типы признаков хранятся в модели)"""
+    return 'c' in (booster.feature_types or [])
+
+def features_fingerprint(X, y, cat_features=None, max_bin=255, xgb_native=False):
+    """Отпечаток признаков, целевой переменной и параметров бинаризации (ключ кэша датасетов)"""
+    h = hashlib.md5()
+    h.update(json.dumps([
+        [str(col) for col in X.columns], [str(dtype) for dtype in X.dtypes],
+        sorted(cat_features or []), max_bin, list(X.shape), xgb_native
+    ]).encode('utf-8'))
+    h.update(pd.util.hash_pandas_object(X, index=False).to_numpy().tobytes())
+    h.update(pd.util.hash_array(np.asarray(y)).tobytes())
+    return h.hexdigest()[:16]
+
+def prepare_binned_datasets(X_train, y_train, cat_features=None, cache_dir='cache/datasets', max_bin=255, xgb_native=False):
+    """
+    Бинаризация обучающих данных один раз для всех триалов Optuna, фолдов и финального обучения.
+    LightGBM - бинарный Dataset, CatBoost - квантованный Pool: оба сохраняются на диск в
+    cache_dir/<отпечаток признаков> и переиспользуются при переобучении на тех же признаках.
+    XGBoost - QuantileDMatrix (на диск не сохраняется): фолды строятся по его сеткам (ref),
+    без повторного построения квантилей.
+    xgb_native: XGBoost получает нативные категории вместо кодов (см. xgb_categorical_kwargs)
+    """
+    import lightgbm as lgb
+    import xgboost as xgb
+    import catboost as cb
+    t0 = datetime.now()
+    fingerprint = features_fingerprint(X_train, y_train, cat_features, max_bin, xgb_native)
+    path = os.path.join(cache_dir, fingerprint)
+    os.makedirs(path, exist_ok=True)
+    print(f"DEBUG: Бинаризованные датасеты: {path}")
+    
+    # LightGBM: feature_pre_filter=False, иначе нельзя менять min_child_samples между триалами
+    lgb_params = {'max_bin': max_bin, 'feature_pre_filter': False, 'verbosity': -1}
+    lgb_path = os.path.join(path, 'lgb_train.bin')
+    if os.path.exists(lgb_path):
+        lgb_train = lgb.Dataset(lgb_path, params=lgb_params).construct()
+        print("DEBUG: LightGBM Dataset загружен из кэша")
+    else:
+        lgb_train = lgb.Dataset(
+            X_train,
+            label=y_train,
+            categorical_feature=cat_features if cat_features else 'auto',
+            params=lgb_params,
+            free_raw_data=False
+        ).construct()
+        lgb_train.save_binary(lgb_path)
+    
+    # CatBoost: квантованный пул (border_count=254 соответствует 255 бинам)
+    cb_path = os.path.join(path, 'cb_train.qpool')
+    if os.path.exists(cb_path):
+        cb_train = cb.Pool(f"quantized://{cb_path}")
+        print("DEBUG: CatBoost Pool загружен из кэша")
+    else:
+        X_cb = to_catboost_frame(X_train, cat_features)
+        cb_cat_features = [
+            col for col in X_cb.columns
+            if isinstance(X_cb[col].dtype, pd.CategoricalDtype) or col in (cat_features or [])
+        ]
+        cb_train = cb.Pool(X_cb, label=y_train, cat_features=cb_cat_features)
+        cb_train.quantize(border_count=max_bin - 1)
+        cb_train.save(cb_path)
+    
+    # XGBoost: квантильная матрица в памяти процесса
+    X_xgb = X_train if xgb_native else encode_xgb_categories(X_train)
+    xgb_kwargs = xgb_categorical_kwargs(X_train, xgb_native)
+    xgb_train = xgb.QuantileDMatrix(X_xgb, label=y_train, max_bin=max_bin, **xgb_kwargs)
+    
+    print(f"DEBUG: Бинаризованные датасеты готовы за {(datetime.now() - t0).total_seconds():.1f}s")
+    return {
+        'fingerprint': fingerprint,
+        'path': path,
+        'max_bin': max_bin,
+        'lgb': lgb_train,
+        'cb': cb_train,
+        'xgb': xgb_train,
+        'xgb_X': X_xgb,
+        'xgb_kwargs': xgb_kwargs,
+        'y': y_train,
+        'folds': {}
+    }
+
+def binned_fold(datasets, lib, train_idx, valid_idx):
+    """
+    Фолд кросс-валидации из заранее бинаризованных данных (кэшируется между триалами,
+    т.к. разбиение TimeSeriesSplit одинаково во всех триалах)
+    """
+    import xgboost as xgb
+    def key(idx):
+        return (idx.start, idx.stop) if isinstance(idx, slice) else hashlib.md5(np.asarray(idx).tobytes()).hexdigest()
+    
+    cache_key = (lib, key(train_idx), key(valid_idx))
+    if cache_key in datasets['folds']:
+        return datasets['folds'][cache_key]
+    
+    def positions(idx):
+        return np.arange(idx.start, idx.stop) if isinstance(idx, slice) else np.asarray(idx)
+    
+    if lib == 'lgb':
+        fold = (datasets['lgb'].subset(positions(train_idx)), datasets['lgb'].subset(positions(valid_idx)))
+    elif lib == 'cb':
+        fold = (datasets['cb'].slice(positions(train_idx)), datasets['cb'].slice(positions(valid_idx)))
+    elif lib == 'xgb':
+        # Валидационная матрица должна ссылаться на обучающую (требование XGBoost для eval)
+        X_xgb, y = datasets['xgb_X'], datasets['y']
+        dtrain = xgb.QuantileDMatrix(
+            X_xgb.iloc[train_idx], label=y.iloc[train_idx], ref=datasets['xgb'],
+            max_bin=datasets['max_bin'], **datasets['xgb_kwargs']
+        )
+        dvalid = xgb.QuantileDMatrix(
+            X_xgb.iloc[valid_idx], label=y.iloc[valid_idx], ref=dtrain,
+            max_bin=datasets['max_bin'], **datasets['xgb_kwargs']
+        )
+        fold = (dtrain, dvalid)
+    else:
+        raise ValueError(f"Неизвестная библиотека: {lib}")
+    
+    datasets['folds'][cache_key] = fold
+    return fold
+
 # ================================================
 # 4. Функции для оптимизации гиперпараметров
 # ================================================
-def optimize_lightgbm(X_train, y_train, X_test, y_test, cat_features=None, n_trials=50):
-    """Оптимизация гиперпараметров LightGBM с использованием Optuna"""
+def optuna_storage(storage):
+    """
+    Постоянное хранилище исследований Optuna:
+    'sqlite:///optuna_studies.db' (или другой URL БД) - RDBStorage с heartbeat,
+    путь к файлу '*.log' - журнал (JournalStorage), None - в памяти (как раньше).
+    Триалы, прерванные падением процесса, помечаются FAILED по heartbeat и перезапускаются.
+    """
+    import optuna
+    if storage is None or not isinstance(storage, str):
+        return storage
+    if '://' in storage:
+        return optuna.storages.RDBStorage(
+            storage,
+            heartbeat_interval=60,
+            grace_period=180,
+            failed_trial_callback=optuna.storages.RetryFailedTrialCallback(max_retry=2)
+        )
+    from optuna.storages.journal import JournalFileBackend
+    return optuna.storages.JournalStorage(JournalFileBackend(storage))
+
+def create_tuning_study(library, storage=None, fingerprint=None, warm_start_trials=5):
+    """
+    Исследование Optuna для библиотеки.
+    С хранилищем имя детерминировано ('<library>_<отпечаток данных>'): повторный запуск на тех же
+    данных продолжает исследование, а другие процессы с тем же хранилищем подключаются к нему
+    как дополнительные воркеры. Новое исследование (например, еженедельное переобучение)
+    начинается с лучших триалов последнего исследования той же библиотеки.
+    """
+    import optuna
+    if storage is None:
+        return optuna.create_study(direction='minimize')
+    
+    storage = optuna_storage(storage)
+    study_name = f"{library}_{fingerprint}"
+    previous = [
+        summary for summary in optuna.get_all_study_summaries(storage)
+        if summary.study_name.startswith(f"{library}_") and summary.study_name != study_name
+        and summary.best_trial is not None
+    ]
+    study = optuna.create_study(
+        direction='minimize', study_name=study_name, storage=storage, load_if_exists=True
+    )
+    
+    done = len(study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,)))
+    if done:
+        print(f"DEBUG: Исследование {study_name} продолжено, завершенных триалов: {done}")
+    elif previous and warm_start_trials:
+        last = max(previous, key=lambda summary: summary.datetime_start)
+        last_trials = optuna.load_study(study_name=last.study_name, storage=storage).get_trials(
+            deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,)
+        )
+        for trial in sorted(last_trials, key=lambda trial: trial.value)[:warm_start_trials]:
+            study.enqueue_trial(trial.params, skip_if_exists=True)
+        print(f"DEBUG: Исследование {study_name} начато с {min(len(last_trials), warm_start_trials)} "
+              f"лучших триалов {last.study_name}")
+    return study
+
+def run_tuning_study(study, objective, n_trials):
+    """
+    Доводит исследование до n_trials завершенных триалов (с учетом уже сохраненных
+    и выполняемых параллельными воркерами)
+    """
+    import optuna
+    complete = (optuna.trial.TrialState.COMPLETE,)
+    remaining = n_trials - len(study.get_trials(deepcopy=False, states=complete))
+    if remaining > 0:
+        study.optimize(
+            objective, n_trials=remaining,
+            callbacks=[optuna.study.MaxTrialsCallback(n_trials, states=complete)]
+        )
+    return study
+
+def final_boost_rounds(best_iterations, n_splits=5, default=1000):
+    """
+    Число раундов финальной модели: средняя лучшая итерация фолдов лучшего триала,
+    увеличенная на 1/n_splits (финальная модель обучается на большем объеме, чем любой фолд)
+    """
+    if not best_iterations:
+        return default
+    return max(1, int(np.ceil(np.mean(best_iterations) * (1 + 1 / n_splits))))
+
+def keep_fold_models(store, trial, score, models):
+    """Сохраняет модели фолдов, только если триал лучший на данный момент (для final_fit='bagging')"""
+    if store is None:
+        return
+    if store.get('score') is None or score < store['score']:
+        store.update(score=score, trial=trial.number, models=models)
+
+def final_fit_strategy(final_fit, store, study, library):
+    """
+    Модели фолдов для бэггинга или None, если нужно переобучение.
+    Модели есть только у триалов текущего процесса: если лучший триал взят из сохраненного
+    исследования или выполнен другим воркером - переобучение с масштабированным числом раундов.
+    """
+    if final_fit != 'bagging':
+        return None
+    if store and store.get('trial') == study.best_trial.number:
+        print(f"DEBUG: {library}: финальная модель - среднее {len(store['models'])} моделей фолдов")
+        return store['models']
+    print(f"DEBUG: {library}: модели фолдов лучшего триала недоступны, переобучение")
+    return None
+
+def optimize_lightgbm(X_train, y_train, X_test, y_test, cat_features=None, n_trials=50, datasets=None,
+                      storage=None, fingerprint=None, final_fit='refit'):
+    """
+    Оптимизация гиперпараметров LightGBM с использованием Optuna.
+    datasets: результат prepare_binned_datasets - фолды берутся из бинаризованного Dataset
+    storage, fingerprint: постоянное хранилище Optuna и отпечаток данных (см. create_tuning_study)
+    final_fit: 'refit' - переобучение на всем train с числом раундов по лучшим итерациям фолдов,
+               'bagging' - среднее моделей фолдов лучшего триала
+    """
+    import lightgbm as lgb
+    from sklearn.metrics import mean_absolute_error, mean_squared_error
+    from sklearn.model_selection import TimeSeriesSplit
     print("DEBUG: Начало оптимизации LightGBM")
     
     # Функция для обратного преобразования предсказаний
@@ -554,22 +1244,27 @@ def optimize_lightgbm(X_train, y_train, X_test, y_test, cat_features=None, n_tri
         # Кросс-валидация с учетом временных рядов
         tscv = TimeSeriesSplit(n_splits=5)
         scores = []
+        best_iterations, fold_models = [], []
         
         for train_idx, valid_idx in tscv.split(X_train):
+            train_idx, valid_idx = _index_to_slice(train_idx), _index_to_slice(valid_idx)
             X_train_fold, X_valid_fold = X_train.iloc[train_idx], X_train.iloc[valid_idx]
             y_train_fold, y_valid_fold = y_train.iloc[train_idx], y_train.iloc[valid_idx]
             
             # Создание датасета LightGBM
-            train_data = lgb.Dataset(
-                X_train_fold, 
-                label=y_train_fold, 
-                categorical_feature=cat_features if cat_features else 'auto'
-            )
-            valid_data = lgb.Dataset(
-                X_valid_fold, 
-                label=y_valid_fold, 
-                categorical_feature=cat_features if cat_features else 'auto'
-            )
+            if datasets:
+                train_data, valid_data = binned_fold(datasets, 'lgb', train_idx, valid_idx)
+            else:
+                train_data = lgb.Dataset(
+                    X_train_fold, 
+                    label=y_train_fold, 
+                    categorical_feature=cat_features if cat_features else 'auto'
+                )
+                valid_data = lgb.Dataset(
+                    X_valid_fold, 
+                    label=y_valid_fold, 
+                    categorical_feature=cat_features if cat_features else 'auto'
+                )
             
             # Обучение модели
             model = lgb.train(
@@ -590,15 +1285,20 @@ def optimize_lightgbm(X_train, y_train, X_test, y_test, cat_features=None, n_tri
             # Расчет метрик
             fold_rmse = rmse(valid_true, valid_pred)
             scores.append(fold_rmse)
+            best_iterations.append(model.best_iteration)
+            fold_models.append(model)
         
         print("DEBUG: optimize_lightgbm завершена, возвращаем модель")
+        # Лучшие итерации фолдов сохраняются в триале (и в постоянном хранилище)
+        trial.set_user_attr('best_iterations', best_iterations)
+        keep_fold_models(fold_store, trial, np.mean(scores), fold_models)
         # Возвращаем среднее значение метрики для всех фолдов
         return np.mean(scores)
     
     # Создание Optuna исследования для оптимизации
-    study = optuna.create_study(direction='minimize')
-
-    study.optimize(objective, n_trials=n_trials)
+    fold_store = {} if final_fit == 'bagging' else None
+    study = create_tuning_study('lgb', storage, fingerprint)
+    run_tuning_study(study, objective, n_trials)
 
     # Лучшие параметры
     best_params = study.best_params
@@ -612,20 +1312,29 @@ def optimize_lightgbm(X_train, y_train, X_test, y_test, cat_features=None, n_tri
     best_params['n_jobs'] = -1
     best_params['random_state'] = 42
     
-    # Создание датасета
-    train_data = lgb.Dataset(
-        X_train, 
-        label=y_train, 
-        categorical_feature=cat_features if cat_features else 'auto'
-    )
-    
-    # Обучение финальной модели
-    final_model = lgb.train(
-        best_params,
-        train_data,
-        num_boost_round=10000,
-        callbacks=[lgb.log_evaluation(period=100)]
-    )
+    fold_models = final_fit_strategy(final_fit, fold_store, study, 'LightGBM')
+    if fold_models:
+        final_model = FoldBaggedModel(fold_models)
+    else:
+        # Создание датасета
+        if datasets:
+            train_data = datasets['lgb']
+        else:
+            train_data = lgb.Dataset(
+                X_train, 
+                label=y_train, 
+                categorical_feature=cat_features if cat_features else 'auto'
+            )
+        
+        # Обучение финальной модели (число раундов - по лучшим итерациям фолдов)
+        num_boost_round = final_boost_rounds(study.best_trial.user_attrs.get('best_iterations'))
+        print(f"DEBUG: LightGBM: финальное обучение на {num_boost_round} раундов")
+        final_model = lgb.train(
+            best_params,
+            train_data,
+            num_boost_round=num_boost_round,
+            callbacks=[lgb.log_evaluation(period=100)]
+        )
     
     # Предсказание и оценка на тестовом наборе
     test_pred = final_model.predict(X_test)
@@ -643,19 +1352,29 @@ def optimize_lightgbm(X_train, y_train, X_test, y_test, cat_features=None, n_tri
     
     return final_model, best_params, test_pred_inv
 
-def optimize_xgboost(X_train, y_train, X_test, y_test, n_trials=50):
-    """Оптимизация гиперпараметров XGBoost с использованием Optuna"""
+def optimize_xgboost(X_train, y_train, X_test, y_test, n_trials=50, datasets=None, native_categorical=False,
+                     storage=None, fingerprint=None, final_fit='refit'):
+    """
+    Оптимизация гиперпараметров XGBoost с использованием Optuna.
+    datasets: результат prepare_binned_datasets - фолды строятся по сеткам общей QuantileDMatrix
+    native_categorical: нативные категории XGBoost (enable_categorical) вместо копии фрейма с кодами
+    storage, fingerprint: постоянное хранилище Optuna и отпечаток данных (см. create_tuning_study)
+    final_fit: 'refit' или 'bagging' (см. optimize_lightgbm); тестовая выборка в обучении не участвует
+    """
+    import xgboost as xgb
+    from sklearn.metrics import mean_absolute_error, mean_squared_error
+    from sklearn.model_selection import TimeSeriesSplit
+    from xgboost.callback import EarlyStopping
     print("DEBUG: Начало оптимизации XGBoost")
     
-    # Кодировка категориальных признаков
-    def encode_cats(df):
-        df = df.copy()
-        for col in df.select_dtypes(include='category').columns:
-            df[col] = df[col].cat.codes
-        return df
-    
-    X_train_enc = encode_cats(X_train)
-    X_test_enc = encode_cats(X_test)
+    # Кодировка категориальных признаков (в нативном режиме фрейм не копируется)
+    if native_categorical:
+        X_train_enc = X_train
+        X_test_enc = apply_category_vocabularies(X_test, category_vocabularies(X_train))
+    else:
+        X_train_enc = datasets['xgb_X'] if datasets else encode_xgb_categories(X_train)
+        X_test_enc = encode_xgb_categories(X_test)
+    xgb_kwargs = xgb_categorical_kwargs(X_train, native_categorical)
 
     # Функция для обратного преобразования предсказаний
     def inverse_transform(y_pred):
@@ -683,18 +1402,29 @@ def optimize_xgboost(X_train, y_train, X_test, y_test, n_trials=50):
             'n_jobs': 60,
             'random_state': 42
         }
+        if native_categorical:
+            params['tree_method'] = 'hist'
+            params['max_cat_to_onehot'] = 4
+        if datasets:
+            # Сетка QuantileDMatrix фиксирована при построении
+            params['max_bin'] = datasets['max_bin']
         
         # Кросс-валидация с учетом временных рядов
         tscv = TimeSeriesSplit(n_splits=5)
         scores = []
+        best_iterations, fold_models = [], []
         
         for train_idx, valid_idx in tscv.split(X_train_enc):
+            train_idx, valid_idx = _index_to_slice(train_idx), _index_to_slice(valid_idx)
             X_train_fold, X_valid_fold = X_train_enc.iloc[train_idx], X_train_enc.iloc[valid_idx]
             y_train_fold, y_valid_fold = y_train.iloc[train_idx], y_train.iloc[valid_idx]
             
             # Создание DMatrix для XGBoost
-            dtrain = xgb.DMatrix(X_train_fold, label=y_train_fold)
-            dvalid = xgb.DMatrix(X_valid_fold, label=y_valid_fold)
+            if datasets:
+                dtrain, dvalid = binned_fold(datasets, 'xgb', train_idx, valid_idx)
+            else:
+                dtrain = xgb.DMatrix(X_train_fold, label=y_train_fold, **xgb_kwargs)
+                dvalid = xgb.DMatrix(X_valid_fold, label=y_valid_fold, **xgb_kwargs)
             
             # Обучение модели
             model = xgb.train(
@@ -702,7 +1432,7 @@ def optimize_xgboost(X_train, y_train, X_test, y_test, n_trials=50):
                 dtrain,
                 num_boost_round=10000,
                 evals=[(dvalid, 'validation')],
-                callbacks=[EarlyStopping(rounds=100)],
+                callbacks=[EarlyStopping(rounds=100, save_best=True)],
                 verbose_eval=False
             )
             
@@ -714,13 +1444,18 @@ def optimize_xgboost(X_train, y_train, X_test, y_test, n_trials=50):
             # Расчет метрик
             fold_rmse = rmse(valid_true, valid_pred)
             scores.append(fold_rmse)
+            best_iterations.append(model.best_iteration + 1)
+            fold_models.append(model)
         
+        trial.set_user_attr('best_iterations', best_iterations)
+        keep_fold_models(fold_store, trial, np.mean(scores), fold_models)
         # Возвращаем среднее значение метрики для всех фолдов
         return np.mean(scores)
     
     # Создание Optuna исследования для оптимизации
-    study = optuna.create_study(direction='minimize')
-    study.optimize(objective, n_trials=n_trials)
+    fold_store = {} if final_fit == 'bagging' else None
+    study = create_tuning_study('xgb_native' if native_categorical else 'xgb', storage, fingerprint)
+    run_tuning_study(study, objective, n_trials)
     
     # Лучшие параметры
     best_params = study.best_params
@@ -732,20 +1467,33 @@ def optimize_xgboost(X_train, y_train, X_test, y_test, n_trials=50):
     best_params['verbosity'] = 0
     best_params['n_jobs'] = -1
     best_params['random_state'] = 42
+    if native_categorical:
+        best_params['tree_method'] = 'hist'
+        best_params['max_cat_to_onehot'] = 4
     
     # Создание датасета
-    dtrain = xgb.DMatrix(X_train_enc, label=y_train)
-    dtest = xgb.DMatrix(X_test_enc, label=y_test)
-    
-    # Обучение финальной модели
-    final_model = xgb.train(
-        best_params,
-        dtrain,
-        num_boost_round=10000,
-        evals=[(dtest, 'test')],
-        callbacks=[EarlyStopping(100)],
-        verbose_eval=100
-    )
+    if datasets:
+        best_params['max_bin'] = datasets['max_bin']
+        dtrain = datasets['xgb']
+        dtest = xgb.QuantileDMatrix(X_test_enc, label=y_test, ref=dtrain, max_bin=datasets['max_bin'], **xgb_kwargs)
+    else:
+        dtrain = xgb.DMatrix(X_train_enc, label=y_train, **xgb_kwargs)
+        dtest = xgb.DMatrix(X_test_enc, label=y_test, **xgb_kwargs)
+    
+    fold_models = final_fit_strategy(final_fit, fold_store, study, 'XGBoost')
+    if fold_models:
+        final_model = FoldBaggedModel(fold_models)
+    else:
+        # Обучение финальной модели: фиксированное число раундов, тест только в журнале
+        num_boost_round = final_boost_rounds(study.best_trial.user_attrs.get('best_iterations'))
+        print(f"DEBUG: XGBoost: финальное обучение на {num_boost_round} раундов")
+        final_model = xgb.train(
+            best_params,
+            dtrain,
+            num_boost_round=num_boost_round,
+            evals=[(dtest, 'test')],
+            verbose_eval=100
+        )
     
     # Предсказание и оценка на тестовом наборе
     test_pred = final_model.predict(dtest)
@@ -763,10 +1511,27 @@ def optimize_xgboost(X_train, y_train, X_test, y_test, n_trials=50):
     
     return final_model, best_params, test_pred_inv
 
-def optimize_catboost(X_train, y_train, X_test, y_test, cat_features=None, n_trials=50):
-    """Оптимизация гиперпараметров CatBoost с использованием Optuna"""
+def optimize_catboost(X_train, y_train, X_test, y_test, cat_features=None, n_trials=50, datasets=None,
+                      storage=None, fingerprint=None, final_fit='refit'):
+    """
+    Оптимизация гиперпараметров CatBoost с использованием Optuna.
+    datasets: результат prepare_binned_datasets - фолды берутся из квантованного Pool
+    storage, fingerprint: постоянное хранилище Optuna и отпечаток данных (см. create_tuning_study)
+    final_fit: 'refit' или 'bagging' (см. optimize_lightgbm); тестовая выборка в обучении не участвует
+    """
+    import catboost as cb
+    from sklearn.metrics import mean_absolute_error, mean_squared_error
+    from sklearn.model_selection import TimeSeriesSplit
     print("DEBUG: Начало оптимизации CatBoost")
 
+    # Коды категорий из float32-блока переводятся в int один раз, до кросс-валидации
+    X_train = to_catboost_frame(X_train, cat_features)
+    X_test = to_catboost_frame(X_test, cat_features)
+    cb_cat_features = [
+        col for col in X_train.columns
+        if isinstance(X_train[col].dtype, pd.CategoricalDtype) or col in (cat_features or [])
+    ]
+
     # Функция для обратного преобразования предсказаний
     def inverse_transform(y_pred):
         return np.expm1(y_pred)
@@ -800,16 +1565,18 @@ def optimize_catboost(X_train, y_train, X_test, y_test, cat_features=None, n_tri
         # Кросс-валидация с учетом временных рядов
         tscv = TimeSeriesSplit(n_splits=5)
         scores = []
+        best_iterations, fold_models = [], []
 
         for train_idx, valid_idx in tscv.split(X_train):
+            train_idx, valid_idx = _index_to_slice(train_idx), _index_to_slice(valid_idx)
             X_train_fold, X_valid_fold = X_train.iloc[train_idx], X_train.iloc[valid_idx]
             y_train_fold, y_valid_fold = y_train.iloc[train_idx], y_train.iloc[valid_idx]
 
-            # Получаем список всех категориальных колонок для этого разбиения
-            cat_features_fold = X_train_fold.select_dtypes(include='category').columns.tolist()
-
-            train_pool = cb.Pool(X_train_fold, label=y_train_fold, cat_features=cat_features_fold)
-            valid_pool = cb.Pool(X_valid_fold, label=y_valid_fold, cat_features=cat_features_fold)
+            if datasets:
+                train_pool, valid_pool = binned_fold(datasets, 'cb', train_idx, valid_idx)
+            else:
+                train_pool = cb.Pool(X_train_fold, label=y_train_fold, cat_features=cb_cat_features)
+                valid_pool = cb.Pool(X_valid_fold, label=y_valid_fold, cat_features=cb_cat_features)
 
             model = cb.CatBoostRegressor(**params)
             model.fit(
@@ -825,12 +1592,17 @@ def optimize_catboost(X_train, y_train, X_test, y_test, cat_features=None, n_tri
 
             fold_rmse = rmse(valid_true, valid_pred)
             scores.append(fold_rmse)
+            best_iterations.append(model.get_best_iteration() + 1)
+            fold_models.append(model)
 
+        trial.set_user_attr('best_iterations', best_iterations)
+        keep_fold_models(fold_store, trial, np.mean(scores), fold_models)
         return np.mean(scores)
 
     # Создание Optuna исследования для оптимизации
-    study = optuna.create_study(direction='minimize')
-    study.optimize(objective, n_trials=n_trials)
+    fold_store = {} if final_fit == 'bagging' else None
+    study = create_tuning_study('cb', storage, fingerprint)
+    run_tuning_study(study, objective, n_trials)
 
     best_params = study.best_params
     print(f"DEBUG: Лучшие параметры CatBoost: {best_params}")
@@ -839,24 +1611,20 @@ def optimize_catboost(X_train, y_train, X_test, y_test, cat_features=None, n_tri
     best_params['loss_function'] = 'RMSE'
     best_params['eval_metric'] = 'RMSE'
     best_params['verbose'] = 100
-    best_params['iterations'] = 10000
+    best_params['iterations'] = final_boost_rounds(study.best_trial.user_attrs.get('best_iterations'))
     best_params['random_seed'] = 42
     best_params['allow_writing_files'] = False
     best_params['task_type'] = 'CPU'
 
-    # Получаем список всех категориальных признаков для train/test
-    final_cat_features = X_train.select_dtypes(include='category').columns.tolist()
-
-    train_pool = cb.Pool(X_train, label=y_train, cat_features=final_cat_features)
-    test_pool = cb.Pool(X_test, label=y_test, cat_features=final_cat_features)
-
-    final_model = cb.CatBoostRegressor(**best_params)
-    final_model.fit(
-        train_pool,
-        eval_set=test_pool,
-        early_stopping_rounds=100,
-        verbose=100
-    )
+    fold_models = final_fit_strategy(final_fit, fold_store, study, 'CatBoost')
+    if fold_models:
+        final_model = FoldBaggedModel(fold_models)
+    else:
+        # Без eval_set: иначе use_best_model выбирал бы итерацию по тестовой выборке
+        train_pool = datasets['cb'] if datasets else cb.Pool(X_train, label=y_train, cat_features=cb_cat_features)
+        print(f"DEBUG: CatBoost: финальное обучение на {best_params['iterations']} итераций")
+        final_model = cb.CatBoostRegressor(**best_params)
+        final_model.fit(train_pool, verbose=100)
 
     test_pred = final_model.predict(X_test)
     test_pred_inv = inverse_transform(test_pred)
@@ -875,19 +1643,71 @@ def optimize_catboost(X_train, y_train, X_test, y_test, cat_features=None, n_tri
 # ================================================
 # 5. Ансамблирование моделей для улучшения точности
 # ================================================
-def create_ensemble(X_train, y_train, X_test, y_test, cat_features=None, n_trials=30):
-    """Создание ансамбля моделей"""
+def find_ensemble_weights(lgb_pred, xgb_pred, cb_pred, y_test):
+    """Перебор весов ансамбля по сетке с шагом 0.1 (предсказания в исходной шкале, y_test - в логарифмической)"""
+    from sklearn.metrics import mean_squared_error
+    # Определяем диапазон весов для поиска
+    weights_range = np.linspace(0, 1, 11)
+    best_rmse = float('inf')
+    best_weights = (1/3, 1/3, 1/3)  # Равные веса по умолчанию
+    true_values = np.expm1(y_test)
+    
+    # Перебираем всевозможные комбинации весов
+    for w1 in weights_range:
+        for w2 in weights_range:
+            if w1 + w2 <= 1:  # Проверка, что веса в сумме не превышают 1
+                w3 = 1 - w1 - w2
+                
+                # Считаем взвешенный ансамбль
+                ensemble_pred = w1 * lgb_pred + w2 * xgb_pred + w3 * cb_pred
+                
+                # Оцениваем RMSE
+                current_rmse = np.sqrt(mean_squared_error(true_values, ensemble_pred))
+                
+                if current_rmse < best_rmse:
+                    best_rmse = current_rmse
+                    best_weights = (w1, w2, w3)
+    
+    return best_weights
+
+def create_ensemble(X_train, y_train, X_test, y_test, cat_features=None, n_trials=30, binned_datasets=False,
+                    xgb_native_categorical=False, optuna_storage=None, final_fit='refit'):
+    """
+    Создание ансамбля моделей.
+    binned_datasets: бинаризовать обучающие данные один раз для всех трех библиотек (с кэшем на диске)
+    xgb_native_categorical: XGBoost на нативных категориях с теми же словарями, что у LightGBM и CatBoost
+    optuna_storage: постоянное хранилище исследований ('sqlite:///optuna_studies.db' или файл журнала *.log)
+    final_fit: 'refit' - переобучение с числом раундов по лучшим итерациям фолдов, 'bagging' - среднее моделей фолдов
+    """
+    from sklearn.metrics import mean_absolute_error, mean_squared_error
     print("DEBUG: Создание ансамбля моделей")
     
+    datasets = prepare_binned_datasets(
+        X_train, y_train, cat_features, xgb_native=xgb_native_categorical
+    ) if binned_datasets else None
+    
+    # Имена исследований привязаны к данным: тот же набор - продолжение, новый - теплый старт
+    fingerprint = None
+    if optuna_storage:
+        fingerprint = datasets['fingerprint'] if datasets else features_fingerprint(X_train, y_train, cat_features)
+    tuning = {'storage': optuna_storage, 'fingerprint': fingerprint, 'final_fit': final_fit}
+    
     # Оптимизация и обучение отдельных моделей
     print("DEBUG: Начало оптимизации LightGBM")
-    lgb_model, lgb_params, lgb_pred = optimize_lightgbm(X_train, y_train, X_test, y_test, cat_features, n_trials)
+    lgb_model, lgb_params, lgb_pred = optimize_lightgbm(
+        X_train, y_train, X_test, y_test, cat_features, n_trials, datasets=datasets, **tuning
+    )
     gc.collect()
     print("DEBUG: LightGBM завершен, начинаем XGBoost")
-    xgb_model, xgb_params, xgb_pred = optimize_xgboost(X_train, y_train, X_test, y_test, n_trials)
+    xgb_model, xgb_params, xgb_pred = optimize_xgboost(
+        X_train, y_train, X_test, y_test, n_trials, datasets=datasets, native_categorical=xgb_native_categorical,
+        **tuning
+    )
     gc.collect()
     print("DEBUG: XGBoost завершен, начинаем CatBoost")
-    cb_model, cb_params, cb_pred = optimize_catboost(X_train, y_train, X_test, y_test, cat_features, n_trials)
+    cb_model, cb_params, cb_pred = optimize_catboost(
+        X_train, y_train, X_test, y_test, cat_features, n_trials, datasets=datasets, **tuning
+    )
     gc.collect()
     print("DEBUG: CatBoost завершен, начинаем ансамблирование")
     
@@ -895,34 +1715,8 @@ def create_ensemble(X_train, y_train, X_test, y_test, cat_features=None, n_trial
     def inverse_transform(y_pred):
         return np.expm1(y_pred)
     
-    # Находим оптимальные веса для ансамбля
-    def find_optimal_weights():
-        # Определяем диапазон весов для поиска
-        weights_range = np.linspace(0, 1, 11)
-        best_rmse = float('inf')
-        best_weights = (1/3, 1/3, 1/3)  # Равные веса по умолчанию
-        
-        # Перебираем всевозможные комбинации весов
-        for w1 in weights_range:
-            for w2 in weights_range:
-                if w1 + w2 <= 1:  # Проверка, что веса в сумме не превышают 1
-                    w3 = 1 - w1 - w2
-                    
-                    # Считаем взвешенный ансамбль
-                    ensemble_pred = w1 * lgb_pred + w2 * xgb_pred + w3 * cb_pred
-                    true_values = inverse_transform(y_test)
-                    
-                    # Оцениваем RMSE
-                    current_rmse = np.sqrt(mean_squared_error(true_values, ensemble_pred))
-                    
-                    if current_rmse < best_rmse:
-                        best_rmse = current_rmse
-                        best_weights = (w1, w2, w3)
-        
-        return best_weights
-    
     # Находим оптимальные веса
-    weights = find_optimal_weights()
+    weights = find_ensemble_weights(lgb_pred, xgb_pred, cb_pred, y_test)
     print(f"DEBUG: Оптимальные веса ансамбля: {weights}")
     
     # Создаем взвешенный ансамбль
@@ -951,6 +1745,9 @@ def create_ensemble(X_train, y_train, X_test, y_test, cat_features=None, n_trial
             'cb': cb_params
         },
         'weights': weights,
+        'feature_list': X_train.columns.tolist(),
+        'categories': X_train.attrs.get('categories'),
+        'vocabularies': category_vocabularies(X_train),
         'metrics': {
             'rmse': ensemble_rmse,
             'mae': ensemble_mae,
@@ -960,11 +1757,171 @@ def create_ensemble(X_train, y_train, X_test, y_test, cat_features=None, n_trial
     
     return ensemble_results, ensemble_pred
 
+def continue_boosting(library, model, params, X_new, y_new, cat_features=None, rounds=100, vocabularies=None):
+    """
+    Дообучение модели на новом окне данных с сохраненными гиперпараметрами:
+    LightGBM - init_model, XGBoost - xgb_model, CatBoost - init_model.
+    Модель из бэггинга фолдов дообучается по каждой модели фолда.
+    """
+    import lightgbm as lgb
+    import xgboost as xgb
+    import catboost as cb
+    if isinstance(model, FoldBaggedModel):
+        return FoldBaggedModel([
+            continue_boosting(library, fold_model, params, X_new, y_new, cat_features, rounds, vocabularies)
+            for fold_model in model.models
+        ])
+    
+    # Коды категорий нового окна - по словарям обучения: новые SKU и магазины не сдвигают коды,
+    # по которым разбиваются прежние деревья (неизвестная категория = пропуск / -1)
+    X_new = apply_category_vocabularies(X_new, vocabularies)
+    
+    if library == 'lgb':
+        train_data = lgb.Dataset(X_new, label=y_new, categorical_feature=cat_features if cat_features else 'auto')
+        return lgb.train(params, train_data, num_boost_round=rounds, init_model=model)
+    if library == 'xgb':
+        dnew = xgb_matrix(X_new, label=y_new, native=xgb_is_native_categorical(model), vocabularies=vocabularies)
+        return xgb.train(params, dnew, num_boost_round=rounds, xgb_model=model, verbose_eval=False)
+    if library == 'cb':
+        # CatBoost при дообучении заново строит хэши категорий пула: значение вне словаря обучения
+        # (даже единый код неизвестной категории) сдвигает прежние - такие строки не используются
+        cat_cols = [col for col in (cat_features or []) if col in X_new.columns]
+        known = ~X_new[cat_cols].isna().any(axis=1).to_numpy() if cat_cols else np.ones(len(X_new), dtype=bool)
+        if not known.all():
+            print(f"DEBUG: CatBoost: {int((~known).sum())} строк с новыми категориями не участвуют в дообучении")
+            if not known.any():
+                return model
+            X_new, y_new = X_new[known], np.asarray(y_new)[known]
+        X_cb = to_catboost_frame(X_new, cat_features)
+        cb_cat_features = [
+            col for col in X_cb.columns
+            if isinstance(X_cb[col].dtype, pd.CategoricalDtype) or col in (cat_features or [])
+        ]
+        cb_params = dict(params, iterations=rounds, verbose=0)
+        new_model = cb.CatBoostRegressor(**cb_params)
+        new_model.fit(cb.Pool(X_cb, label=y_new, cat_features=cb_cat_features), init_model=model)
+        return new_model
+    raise ValueError(f"Неизвестная библиотека: {library}")
+
+def ensemble_member_predictions(ensemble_results, X, cat_features=None):
+    """
+    Предсказания LightGBM, XGBoost и CatBoost в исходной шкале (expm1).
+    Категории перекодируются по словарям обучения один раз - все три модели видят коды обучения
+    """
+    models = ensemble_results['models']
+    X = apply_category_vocabularies(X, ensemble_results.get('vocabularies'))
+    dmatrix = xgb_matrix(X, native=xgb_is_native_categorical(models['xgb']))
+    return (
+        np.expm1(models['lgb'].predict(X)),
+        np.expm1(models['xgb'].predict(dmatrix)),
+        np.expm1(models['cb'].predict(to_catboost_frame(X, cat_features)))
+    )
+
+def update_ensemble(previous_results, X_new, y_new, X_test, y_test, cat_features=None,
+                    update_rounds=100, max_degradation=0.15):
+    """
+    Инкрементальное обновление сохраненного ансамбля вместо полного переобучения:
+    каждая модель дообучается на новом окне (X_new, y_new) с сохраненными гиперпараметрами,
+    заново подбираются только веса смешивания.
+    Возвращает (ensemble_results, ensemble_pred) или None, если нужно полное переобучение:
+    - признаки изменились;
+    - дрейф: RMSE старого ансамбля на новом тесте хуже сохраненного больше чем на max_degradation;
+    - точность: обновленный ансамбль на тесте хуже старого.
+    """
+    from sklearn.metrics import mean_absolute_error, mean_squared_error
+    print(f"DEBUG: Инкрементальное обновление ансамбля на {len(X_new)} новых строках")
+    
+    if previous_results.get('feature_list') != X_new.columns.tolist():
+        print("DEBUG: Набор признаков изменился - требуется полное переобучение")
+        return None
+    if len(X_new) == 0:
+        print("DEBUG: Нет новых данных для дообучения - требуется полное переобучение")
+        return None
+    
+    true_values = np.expm1(y_test)
+    
+    # Проверка дрейфа: старый ансамбль на новом тестовом окне
+    old_preds = ensemble_member_predictions(previous_results, X_test, cat_features)
+    old_weights = previous_results['weights']
+    old_pred = sum(w * pred for w, pred in zip(old_weights, old_preds))
+    old_rmse = np.sqrt(mean_squared_error(true_values, old_pred))
+    stored_rmse = (previous_results.get('metrics') or {}).get('rmse')
+    print(f"DEBUG: RMSE сохраненного ансамбля на новом тесте: {old_rmse:.4f} (при обучении: {stored_rmse})")
+    if stored_rmse is not None and old_rmse > stored_rmse * (1 + max_degradation):
+        print("DEBUG: Обнаружен дрейф - требуется полное переобучение")
+        return None
+    
+    # Дообучение моделей на новом окне
+    vocabularies = previous_results.get('vocabularies')
+    models = {
+        library: continue_boosting(
+            library, previous_results['models'][library], previous_results['params'][library],
+            X_new, y_new, cat_features, update_rounds, vocabularies
+        )
+        for library in ('lgb', 'xgb', 'cb')
+    }
+    ensemble_results = dict(previous_results, models=models)
+    
+    # Только веса смешивания подбираются заново
+    lgb_pred, xgb_pred, cb_pred = ensemble_member_predictions(ensemble_results, X_test, cat_features)
+    weights = find_ensemble_weights(lgb_pred, xgb_pred, cb_pred, y_test)
+    ensemble_pred = weights[0] * lgb_pred + weights[1] * xgb_pred + weights[2] * cb_pred
+    
+    ensemble_rmse = np.sqrt(mean_squared_error(true_values, ensemble_pred))
+    print(f"DEBUG: Веса после обновления: {weights}, RMSE: {ensemble_rmse:.4f} (до обновления: {old_rmse:.4f})")
+    if ensemble_rmse > old_rmse:
+        print("DEBUG: Обновление ухудшило точность - требуется полное переобучение")
+        return None
+    
+    ensemble_results['weights'] = weights
+    ensemble_results['metrics'] = {
+        'rmse': ensemble_rmse,
+        'mae': mean_absolute_error(true_values, ensemble_pred),
+        'mapd': np.mean(np.abs((true_values - ensemble_pred) / (true_values + 1e-7))) * 100
+    }
+    return ensemble_results, ensemble_pred
+
+def train_or_update_ensemble(processed_df, X_train, y_train, X_test, y_test, cat_features=None, n_trials=30,
+                             test_size_days=30, incremental=False, file_prefix='retail_sales_', **ensemble_kwargs):
+    """
+    Полное обучение ансамбля (create_ensemble) или, при incremental=True, дообучение сохраненного
+    ансамбля на строках после его обучающего периода (update_ensemble) с откатом к полному обучению.
+    ensemble_kwargs передаются в create_ensemble.
+    """
+    split_date = processed_df['Дата'].max() - pd.Timedelta(days=test_size_days)
+    updated = None
+    if incremental:
+        previous_results = load_models(file_prefix)
+        if (previous_results is not None and previous_results.get('train_end') is not None
+                and set(previous_results['models']) == set(ENSEMBLE_MEMBERS)):
+            # Обучающая выборка упорядочена по дате: новое окно - ее хвост
+            dates = processed_df['Дата']
+            n_new = int(((dates > previous_results['train_end']) & (dates <= split_date)).sum())
+            updated = update_ensemble(
+                previous_results, X_train.iloc[len(X_train) - n_new:], y_train.iloc[len(y_train) - n_new:],
+                X_test, y_test, cat_features
+            )
+        else:
+            print("DEBUG: Нет сохраненного полного ансамбля с периодом обучения - полное переобучение")
+    
+    if updated is not None:
+        ensemble_results, ensemble_pred = updated
+    else:
+        ensemble_results, ensemble_pred = create_ensemble(
+            X_train, y_train, X_test, y_test, cat_features, n_trials, **ensemble_kwargs
+        )
+    ensemble_results['train_end'] = split_date
+    return ensemble_results, ensemble_pred
+
 # ================================================
 # 6. Функции для анализа и интерпретации моделей
 # ================================================
+# Сегменты для таблиц и графиков ошибок
+DIAGNOSTIC_SEGMENTS = ['Весовой', 'Акция_активна', 'День_недели', 'Магазин']
+
 def analyze_model_performance(ensemble_results, test_df, ensemble_pred, y_test_original):
     """Анализ производительности модели"""
+    from sklearn.metrics import mean_absolute_error, mean_squared_error
     print("DEBUG: Анализ производительности модели")
     
     # Добавляем предсказания в тестовый датафрейм
@@ -1000,18 +1957,14 @@ def analyze_model_performance(ensemble_results, test_df, ensemble_pred, y_test_o
                 
                 print(f"{promo_type}: RMSE={rmse:.4f}, MAE={mae:.4f}, MAPD={mapd:.4f}%")
     
+    # Ошибки по сегментам одним проходом (агрегаты для печати и графиков)
+    segments = {col: test_df[col] for col in DIAGNOSTIC_SEGMENTS if col in test_df.columns}
+    errors = segment_errors(test_df['Чистые_продажи'], test_df['Предсказано'], segments)
+    
     # Анализ ошибок по дням недели
-    if 'День_недели' in test_df.columns:
+    if 'День_недели' in errors:
         print("\nАнализ по дням недели:")
-        weekday_errors = test_df.groupby('День_недели').apply(
-            lambda x: pd.Series({
-                'RMSE': np.sqrt(mean_squared_error(x['Чистые_продажи'], x['Предсказано'])),
-                'MAE': mean_absolute_error(x['Чистые_продажи'], x['Предсказано']),
-                'MAPD': np.mean(np.abs((x['Чистые_продажи'] - x['Предсказано']) / 
-                                        (x['Чистые_продажи'] + 1e-7))) * 100
-            })
-        )
-        print(weekday_errors)
+        print(errors['День_недели'][['RMSE', 'MAE', 'MAPD']])
     
     # Анализ 10 товаров с наибольшей и наименьшей ошибкой
     test_df['Абс_ошибка'] = np.abs(test_df['Чистые_продажи'] - test_df['Предсказано'])
@@ -1026,17 +1979,12 @@ def analyze_model_performance(ensemble_results, test_df, ensemble_pred, y_test_o
     best_items = test_df.groupby('SKU')['Абс_ошибка'].mean().sort_values().head(10)
     print(best_items)
     
-    # Визуализация предсказаний vs фактических значений (если запускается в интерактивном режиме)
+    # Визуализация предсказаний vs фактических значений - по двумерной гистограмме, а не по каждой строке
     try:
-        import matplotlib.pyplot as plt
-        plt.figure(figsize=(12, 6))
-        plt.scatter(test_df['Чистые_продажи'], test_df['Предсказано'], alpha=0.3)
-        plt.plot([0, test_df['Чистые_продажи'].max()], [0, test_df['Чистые_продажи'].max()], 'r--')
-        plt.xlabel('Фактические продажи')
-        plt.ylabel('Предсказанные продажи')
-        plt.title('Предсказанные vs Фактические продажи')
-        plt.savefig('prediction_vs_actual.png')
-        print("\nГрафик сохранен в файл 'prediction_vs_actual.png'")
+        histogram = prediction_histogram(test_df['Чистые_продажи'], test_df['Предсказано'])
+        plot_prediction_histogram(histogram, 'prediction_vs_actual.png')
+        plot_segment_errors(errors, 'segment_errors.png')
+        print("\nГрафики сохранены в файлы 'prediction_vs_actual.png' и 'segment_errors.png'")
     except Exception as e:
         print(f"Не удалось создать визуализацию: {e}")
         
@@ -1098,18 +2046,116 @@ def feature_importance_analysis(ensemble_results, X_test):
     
     # Визуализация (если запускается в интерактивном режиме)
     try:
-        import matplotlib.pyplot as plt
-        plt.figure(figsize=(12, 10))
-        importance_df['Mean_Importance'].head(20).sort_values().plot(kind='barh')
-        plt.title('Топ-20 важных признаков')
-        plt.savefig('feature_importance.png')
+        plot_feature_importance(importance_df['Mean_Importance'], 'feature_importance.png', top=20)
         print("\nГрафик важности признаков сохранен в файл 'feature_importance.png'")
     except Exception as e:
         print(f"Не удалось создать визуализацию важности признаков: {e}")
     
     return importance_df
 
-def save_models(ensemble_results, file_prefix='retail_sales_'):
+def ensemble_feature_importance(ensemble_results, columns):
+    """
+    Нормированная важность признаков ансамбля: gain каждой модели делится на сумму
+    (шкалы LightGBM, XGBoost и CatBoost несопоставимы), затем усредняется по моделям
+    """
+    models = ensemble_results['models']
+    scores = [
+        pd.Series(models['lgb'].feature_importance(importance_type='gain'), index=columns),
+        pd.Series(models['xgb'].get_score(importance_type='gain'), dtype='float64').reindex(columns),
+        pd.Series(models['cb'].get_feature_importance(), index=columns),
+    ]
+    normalized = [score.fillna(0) / max(score.fillna(0).sum(), 1e-12) for score in scores]
+    return (sum(normalized) / len(normalized)).sort_values(ascending=False)
+
+def select_features(X_train, y_train, X_test, y_test, cat_features=None, importance=None, lgb_params=None,
+                    tolerance=0.01, fractions=(0.25, 0.5, 0.75), permutation_check=False, num_boost_round=300):
+    """
+    Отбор компактного набора признаков по важности в пределах допуска по точности.
+    importance: сохраненная важность (ensemble_feature_importance прошлой модели); если нет -
+    считается по gain быстрой модели LightGBM на всех признаках.
+    Для долей fractions (по возрастанию) берутся самые важные признаки и обучается такая же
+    быстрая модель; выбирается наименьший набор, у которого RMSE на отложенной выборке
+    не хуже базового больше чем на tolerance.
+    permutation_check: отсеянные признаки, перемешивание которых на отложенной выборке
+    ухудшает RMSE базовой модели больше чем на tolerance, возвращаются в набор.
+    Возвращает список признаков в исходном порядке колонок.
+    """
+    import lightgbm as lgb
+    from sklearn.metrics import mean_squared_error
+    print("DEBUG: Отбор признаков по важности")
+    t0 = datetime.now()
+    params = dict(lgb_params or {'objective': 'regression', 'learning_rate': 0.05, 'num_leaves': 63})
+    params.update({'verbosity': -1, 'random_state': 42})
+    true_values = np.expm1(y_test)
+    
+    def fit_and_score(columns):
+        cats = [col for col in (cat_features or []) if col in columns]
+        train_data = lgb.Dataset(X_train[columns], label=y_train, categorical_feature=cats if cats else 'auto')
+        model = lgb.train(params, train_data, num_boost_round=num_boost_round)
+        pred = np.expm1(model.predict(X_test[columns]))
+        return model, np.sqrt(mean_squared_error(true_values, pred))
+    
+    all_columns = X_train.columns.tolist()
+    base_model, base_rmse = fit_and_score(all_columns)
+    if importance is None:
+        importance = pd.Series(base_model.feature_importance(importance_type='gain'), index=all_columns)
+    
+    # Новые признаки (нет в сохраненной важности) не отсеиваются
+    ranked = [col for col in importance.sort_values(ascending=False).index if col in all_columns]
+    unranked = [col for col in all_columns if col not in importance.index]
+    
+    selected = all_columns
+    for fraction in sorted(fractions):
+        top = ranked[:max(1, int(np.ceil(len(ranked) * fraction)))] + unranked
+        _, rmse = fit_and_score([col for col in all_columns if col in top])
+        print(f"DEBUG: Топ {len(top)} признаков: RMSE {rmse:.4f} (все признаки: {base_rmse:.4f})")
+        if rmse <= base_rmse * (1 + tolerance):
+            selected = [col for col in all_columns if col in top]
+            break
+    
+    if permutation_check and len(selected) < len(all_columns):
+        rng = np.random.default_rng(42)
+        X_perm = X_test.copy()
+        restored = []
+        for col in all_columns:
+            if col in selected:
+                continue
+            original = X_perm[col]
+            X_perm[col] = original.to_numpy()[rng.permutation(len(X_perm))]
+            if isinstance(original.dtype, pd.CategoricalDtype):
+                X_perm[col] = X_perm[col].astype(original.dtype)
+            rmse = np.sqrt(mean_squared_error(true_values, np.expm1(base_model.predict(X_perm))))
+            X_perm[col] = original
+            if rmse > base_rmse * (1 + tolerance):
+                restored.append(col)
+        if restored:
+            print(f"DEBUG: Возвращены по перестановочной проверке: {restored}")
+            selected = [col for col in all_columns if col in selected or col in restored]
+    
+    print(f"DEBUG: Отобрано {len(selected)} из {len(all_columns)} признаков "
+          f"за {(datetime.now() - t0).total_seconds():.1f}s")
+    return selected
+
+def prune_train_test_data(df, prepared, test_size_days=30, zero_copy=False, tolerance=0.01, permutation_check=False,
+                          file_prefix='retail_sales_'):
+    """
+    Этап отбора признаков перед обучением: важность берется из сохраненной модели
+    (feature_importance.pkl), выборки пересобираются только из отобранных признаков.
+    prepared: результат prepare_train_test_data на всех признаках
+    """
+    X_train, y_train, X_test, y_test, _, cat_features, _, _ = prepared
+    importance_path = f"{file_prefix}feature_importance.pkl"
+    importance = joblib.load(importance_path) if os.path.exists(importance_path) else None
+    selected = select_features(
+        X_train, y_train, X_test, y_test, cat_features, importance,
+        tolerance=tolerance, permutation_check=permutation_check
+    )
+    return prepare_train_test_data(df, test_size_days=test_size_days, zero_copy=zero_copy, features=selected)
+
+# Модели ансамбля в порядке весов (w_lgb, w_xgb, w_cb)
+ENSEMBLE_MEMBERS = ['lgb', 'xgb', 'cb']
+
+def save_models(ensemble_results, X_train, file_prefix='retail_sales_'):
     """Сохранение обученных моделей"""
     print("DEBUG: Сохранение моделей")
     
@@ -1125,6 +2171,11 @@ def save_models(ensemble_results, file_prefix='retail_sales_'):
             joblib.dump(model, f"{file_prefix}cb_model.pkl")
             #model.save_model(f"{file_prefix}cb_model.cbm")
     
+    # Файлы моделей, которых нет в ансамбле, остались бы от предыдущего обучения
+    for model_name in ENSEMBLE_MEMBERS:
+        if model_name not in ensemble_results['models'] and os.path.exists(f"{file_prefix}{model_name}_model.pkl"):
+            os.remove(f"{file_prefix}{model_name}_model.pkl")
+    
     # Сохранение параметров и весов ансамбля
     joblib.dump(ensemble_results['params'], f"{file_prefix}model_params.pkl")
     joblib.dump(ensemble_results['weights'], f"{file_prefix}ensemble_weights.pkl")
@@ -1133,10 +2184,33 @@ def save_models(ensemble_results, file_prefix='retail_sales_'):
     feature_list = X_train.columns.tolist()
     joblib.dump(feature_list, f"{file_prefix}feature_list.pkl")
 
-    # Сохранение списка категориальных признаков
-    cat_features = X_train.select_dtypes(include='category').columns.tolist()
+    # Сохранение списка категориальных признаков (и словарей категорий для float32-блока)
+    categories = ensemble_results.get('categories')
+    cat_features = list(categories) if categories else X_train.select_dtypes(include='category').columns.tolist()
     joblib.dump(cat_features, f"{file_prefix}cat_features.pkl")
+    if categories:
+        joblib.dump(categories, f"{file_prefix}categories.pkl")
+    elif os.path.exists(f"{file_prefix}categories.pkl"):
+        # Файл от предыдущей модели на float32-блоке: иначе load_models примет новую модель за блочную
+        os.remove(f"{file_prefix}categories.pkl")
+    
+    # Словари категорий обучения - одна кодировка для обучения и инференса (в т.ч. claude_predict)
+    vocabularies = ensemble_results.get('vocabularies') or category_vocabularies(X_train)
+    joblib.dump(vocabularies, f"{file_prefix}category_vocab.pkl")
+    
+    # Важность признаков - для отбора признаков при следующем обучении (select_features)
+    joblib.dump(ensemble_feature_importance(ensemble_results, feature_list), f"{file_prefix}feature_importance.pkl")
+    
+    # Конец обучающего периода и метрики - для инкрементального обновления (update_ensemble)
+    joblib.dump(
+        {'train_end': ensemble_results.get('train_end'), 'metrics': ensemble_results.get('metrics'),
+         'time_series_backend': ensemble_results.get('time_series_backend', 'pandas'),
+         'daily_grain': ensemble_results.get('daily_grain', True)},
+        f"{file_prefix}ensemble_meta.pkl"
+    )
     
+    # Версия артефакта - ключ кэша прогнозов (claude_prediction_cache)
+    ensemble_results['artifact_version'] = artifact_version(file_prefix)
     print(f"DEBUG: Модели сохранены с префиксом '{file_prefix}'")
 
 def load_models(file_prefix='retail_sales_'):
@@ -1149,20 +2223,24 @@ def load_models(file_prefix='retail_sales_'):
     try:
         ensemble_results['params'] = joblib.load(f"{file_prefix}model_params.pkl")
         ensemble_results['weights'] = joblib.load(f"{file_prefix}ensemble_weights.pkl")
+        ensemble_results['feature_list'] = joblib.load(f"{file_prefix}feature_list.pkl")
+        if os.path.exists(f"{file_prefix}categories.pkl"):
+            ensemble_results['categories'] = joblib.load(f"{file_prefix}categories.pkl")
+        if os.path.exists(f"{file_prefix}category_vocab.pkl"):
+            ensemble_results['vocabularies'] = joblib.load(f"{file_prefix}category_vocab.pkl")
+        if os.path.exists(f"{file_prefix}ensemble_meta.pkl"):
+            ensemble_results.update(joblib.load(f"{file_prefix}ensemble_meta.pkl"))
+        if os.path.exists(f"{file_prefix}feature_importance.pkl"):
+            ensemble_results['feature_importance'] = joblib.load(f"{file_prefix}feature_importance.pkl")
         
-        # Загрузка LightGBM модели
-        lgb_model = lgb.Booster(model_file=f"{file_prefix}lgb_model.txt")
-        ensemble_results['models']['lgb'] = lgb_model
-        
-        # Загрузка XGBoost модели
-        xgb_model = xgb.Booster()
-        xgb_model.load_model(f"{file_prefix}xgb_model.json")
-        ensemble_results['models']['xgb'] = xgb_model
-        
-        # Загрузка CatBoost модели
-        cb_model = cb.CatBoostRegressor()
-        cb_model.load_model(f"{file_prefix}cb_model.cbm")
-        ensemble_results['models']['cb'] = cb_model
+        # Загрузка моделей в том же формате, в котором их сохраняет save_models.
+        # Модели без файла или с нулевым весом не загружаются (и их библиотека не импортируется)
+        for name, weight in zip(ENSEMBLE_MEMBERS, ensemble_results['weights']):
+            if weight and os.path.exists(f"{file_prefix}{name}_model.pkl"):
+                ensemble_results['models'][name] = joblib.load(f"{file_prefix}{name}_model.pkl")
+        if not ensemble_results['models']:
+            raise FileNotFoundError(f"Нет моделей ансамбля с префиксом '{file_prefix}'")
+        ensemble_results['artifact_version'] = artifact_version(file_prefix)
         
         print("DEBUG: Модели успешно загружены")
         return ensemble_results
@@ -1171,20 +2249,65 @@ def load_models(file_prefix='retail_sales_'):
         print(f"DEBUG: Ошибка при загрузке моделей: {e}")
         return None
 
-def prepare_data_for_prediction(data, holidays_df, promotions_df):
-    """Подготовка данных для прогнозирования"""
+def inference_feature_plan(features):
+    """
+    Какие лаги, скользящие статистики, тренды и праздничные признаки нужны модели
+    с отобранным набором признаков (с учетом зависимостей трендов).
+    features=None - считать все, как при обучении.
+    """
+    if features is None:
+        return {'lags': LAG_DAYS, 'windows': ROLLING_WINDOWS, 'rolling_columns': None,
+                'trends': None, 'holidays': True}
+    
+    needed = set(features)
+    for trend, dependencies in TREND_DEPENDENCIES.items():
+        if trend in needed:
+            needed.update(dependencies)
+    
+    rolling_columns = [
+        f'{stat}_{window}' for window in ROLLING_WINDOWS for stat in ROLLING_STATS
+        if f'{stat}_{window}' in needed
+    ]
+    return {
+        'lags': [lag for lag in LAG_DAYS if f'Lag_{lag}' in needed],
+        'windows': [window for window in ROLLING_WINDOWS if any(col.endswith(f'_{window}') for col in rolling_columns)],
+        'rolling_columns': rolling_columns,
+        'trends': [trend for trend in TREND_DEPENDENCIES if trend in needed],
+        'holidays': any(
+            col.startswith('Дней_до_') or col.startswith('Дней_после_') or col == 'Сезон_распродаж'
+            for col in needed
+        ),
+    }
+
+def prepare_data_for_prediction(data, holidays_df, promotions_df, features=None, time_series_backend='pandas',
+                                stage_cache=False):
+    """
+    Подготовка данных для прогнозирования.
+    features: признаки модели (после отбора) - отсеянные лаги, окна, тренды и праздничные
+    признаки не вычисляются
+    time_series_backend: тот же способ расчета временных признаков, что при обучении
+    stage_cache: этапы из дискового кэша claude_stages (например, при повторном прогнозе на новый горизонт)
+    """
+    if stage_cache:
+        from claude_stages import cached_prediction_features
+        return cached_prediction_features(data, holidays_df, promotions_df, features, time_series_backend)
+    
     print("DEBUG: Подготовка данных для прогнозирования")
+    plan = inference_feature_plan(features)
     
     # Применяем все те же преобразования, что и при обучении
     data = create_price_features(data)
     data = create_time_features(data)
     data = create_promotion_features(data, promotions_df)
-    data = add_holiday_features(data, holidays_df)
+    if plan['holidays']:
+        data = add_holiday_features(data, holidays_df)
     data = create_advanced_volume_features(data)
+    data = fill_unknown_target(data)
     data = create_store_features(data)
-    data = create_lags_vectorized(data)
-    data = create_rolling_vectorized(data)
-    data = compute_trends(data)
+    data = time_series_features(
+        data, time_series_backend, lags=plan['lags'], windows=plan['windows'],
+        rolling_columns=plan['rolling_columns'], trends=plan['trends']
+    )
     data = create_cross_features(data)
     
     # Target encoding не применяем, так как нам неизвестны будущие значения целевой переменной
@@ -1193,10 +2316,42 @@ def prepare_data_for_prediction(data, holidays_df, promotions_df):
     print("DEBUG: Данные подготовлены для прогнозирования")
     return data
 
-def predict_future_sales(ensemble_results, last_data, holidays_df, promotions_df, days_ahead=30):
-    """Прогнозирование продаж на будущие даты"""
+def predict_future_sales(ensemble_results, last_data, holidays_df, promotions_df, days_ahead=30, stage_cache=False,
+                         prediction_cache=None):
+    """
+    Прогнозирование продаж на будущие даты.
+    prediction_cache: кэш прогнозов (claude_prediction_cache) - повторный запрос с теми же моделями,
+    историей, праздниками, акциями и горизонтом возвращается без пересчета
+    """
+    if prediction_cache is not None:
+        return cached_prediction(
+            prediction_cache, 'predict_future_sales',
+            *future_sales_key(ensemble_results, last_data, holidays_df, promotions_df, days_ahead),
+            lambda: predict_future_sales(
+                ensemble_results, last_data, holidays_df, promotions_df, days_ahead, stage_cache
+            )
+        )
+    
     print(f"DEBUG: Прогнозирование продаж на {days_ahead} дней вперед")
     
+    future_df = prepare_future_features(ensemble_results, last_data, holidays_df, promotions_df, days_ahead, stage_cache)
+    future_df['Прогноз_продаж'] = score_future_features(ensemble_results, future_df)
+    
+    # Выбираем нужные колонки для результата
+    result_df = future_df[['Дата', 'SKU', 'Магазин', 'Прогноз_продаж']]
+    
+    print("DEBUG: Прогноз выполнен")
+    return result_df
+
+# Колонки строк горизонта, переносимые с последней строки ряда: весовой товар, цена и состояние акции
+# (продолжаются до конца горизонта; сценарии claude_scenarios их подменяют)
+FUTURE_CARRY_COLUMNS = [
+    'Весовой', 'Цена_со_скидкой', 'Цена_без_скидки', 'Номер_акции', 'Тип_акции', 'Процент_скидки', 'Это_уценка',
+    'Акция_активна',
+]
+
+def prepare_future_features(ensemble_results, last_data, holidays_df, promotions_df, days_ahead=30, stage_cache=False):
+    """Признаки будущих дат для каждой пары SKU-Магазин из last_data (строки горизонта прогноза)"""
     # Копируем данные, чтобы не изменять оригинал
     future_data = last_data.copy()
     
@@ -1218,60 +2373,108 @@ def predict_future_sales(ensemble_results, last_data, holidays_df, promotions_df
         how='cross'
     )
     
-    # Копируем атрибуты товаров из последних известных данных
-    product_attrs = future_data.drop_duplicates(subset=['SKU']).set_index('SKU')
-    for col in product_attrs.columns:
-        if col not in ['Дата', 'Чистые_продажи', 'Магазин'] and col in future_df.columns:
-            future_df[col] = future_df['SKU'].map(product_attrs[col])
+    # Свойства товара, последняя цена и состояние акции - с последней строки того же ряда (SKU, Магазин)
+    series_last = future_data.sort_values('Дата', kind='stable').drop_duplicates(['SKU', 'Магазин'], keep='last')
+    carry = [col for col in FUTURE_CARRY_COLUMNS if col in series_last.columns]
+    future_df = future_df.merge(series_last[['SKU', 'Магазин'] + carry], on=['SKU', 'Магазин'], how='left')
+    
+    # Праздники будущих дат - из календаря праздников (как в load_data)
+    holiday_days = holidays_df.drop_duplicates('Дата').set_index('Дата')
+    if 'Праздник' in future_data.columns:
+        future_df['Праздник'] = future_df['Дата'].map(holiday_days['Название_праздника']).notnull().astype('int8')
+    if 'Праздник_тип' in future_data.columns:
+        future_df['Праздник_тип'] = future_df['Дата'].map(holiday_days['Тип_праздника']).fillna('Нет')
+    if 'Выходной_день' in future_data.columns:
+        future_df['Выходной_день'] = future_df['Дата'].map(holiday_days['Выходной']).fillna(0).astype('int8')
+    
+    # Таргет-энкодинги - по значению ключа (словарь обучения), для дня недели и месяца - по будущей дате
+    future_df['День_недели'] = future_df['Дата'].dt.dayofweek.astype('int8')
+    future_df['Месяц'] = future_df['Дата'].dt.month.astype('int8')
+    for col in future_data.columns:
+        key = col[:-len('_target_mean')]
+        if col.endswith('_target_mean') and key in future_data.columns and key in future_df.columns:
+            last = future_data.drop_duplicates(key, keep='last')
+            encoding = pd.Series(last[col].to_numpy(), index=last[key].astype(str).to_numpy())
+            future_df[col] = future_df[key].astype(str).map(encoding).astype('float32')
+    # Исходы операций (Количество, суммы чека, возвраты, промокоды) в будущих строках неизвестны - пропуски
     
     # Объединяем исторические и будущие данные для корректного создания лаговых признаков
     combined_df = pd.concat([future_data, future_df], ignore_index=True)
     combined_df = combined_df.sort_values(['SKU', 'Магазин', 'Дата'])
     
-    # Подготавливаем данные
-    prepared_df = prepare_data_for_prediction(combined_df, holidays_df, promotions_df)
+    # Подготавливаем данные (только признаки, нужные модели)
+    prepared_df = prepare_data_for_prediction(
+        combined_df, holidays_df, promotions_df, features=ensemble_results.get('feature_list'),
+        time_series_backend=ensemble_results.get('time_series_backend', 'pandas'), stage_cache=stage_cache
+    )
     
     # Извлекаем только будущие даты для прогноза
-    future_df = prepared_df[prepared_df['Дата'] > last_date]
-    
+    return prepared_df[prepared_df['Дата'] > last_date]
+
+def score_future_features(ensemble_results, future_df):
+    """Прогноз ансамбля (исходная шкала, штучные товары округлены) для готовых признаков future_df"""
     # Получаем список признаков для прогноза (исключаем целевую переменную и связанные с ней)
-    exclude_cols = ['Дата', 'Чистые_продажи', 'log_Чистые_продажи', 'boxcox_Чистые_продажи']
-    feature_cols = [col for col in future_df.columns if col not in exclude_cols]
-    
-    # Прогнозирование с помощью каждой модели
-    lgb_pred = ensemble_results['models']['lgb'].predict(future_df[feature_cols])
-    xgb_pred = ensemble_results['models']['xgb'].predict(xgb.DMatrix(future_df[feature_cols]))
-    cb_pred = ensemble_results['models']['cb'].predict(future_df[feature_cols])
-    
-    # Взвешенный ансамбль
-    weights = ensemble_results['weights']
-    ensemble_pred = weights[0] * lgb_pred + weights[1] * xgb_pred + weights[2] * cb_pred
+    exclude_cols = ['Дата', 'Чистые_продажи', 'log_Чистые_продажи', 'boxcox_Чистые_продажи', 'Прогноз_продаж']
+    feature_cols = ensemble_results.get('feature_list') or [col for col in future_df.columns if col not in exclude_cols]
+    
+    # Категориальные признаки приводим так же, как при обучении
+    X_future = future_df[feature_cols].copy()
+    categories = ensemble_results.get('categories')
+    if categories:
+        # Модели обучены на float32-блоке: коды категорий по словарям обучения
+        for col, vocab in categories.items():
+            codes = pd.Categorical(X_future[col], categories=vocab).codes.astype('float32')
+            codes[codes < 0] = np.nan
+            X_future[col] = codes
+        X_future = X_future.astype('float32')
+        X_future.attrs['categories'] = categories
+        X_future_cb = to_catboost_frame(X_future, list(categories))
+    else:
+        for col in X_future.select_dtypes(include='object').columns:
+            X_future[col] = X_future[col].astype('category')
+        X_future_cb = X_future
+    
+    # Прогнозирование каждой загруженной моделью и взвешенный ансамбль
+    models, weights = ensemble_results['models'], ensemble_results['weights']
+    ensemble_pred = np.zeros(len(X_future))
+    if 'lgb' in models:
+        ensemble_pred += weights[0] * models['lgb'].predict(X_future)
+    if 'xgb' in models:
+        dfuture = xgb_matrix(
+            X_future, native=xgb_is_native_categorical(models['xgb']), vocabularies=ensemble_results.get('vocabularies')
+        )
+        ensemble_pred += weights[1] * models['xgb'].predict(dfuture)
+    if 'cb' in models:
+        ensemble_pred += weights[2] * models['cb'].predict(X_future_cb)
     
     # Обратное преобразование логарифма
-    future_df['Прогноз_продаж'] = np.expm1(ensemble_pred)
+    forecast = np.expm1(ensemble_pred)
     
     # Округляем прогноз для штучных товаров
     if 'Весовой' in future_df.columns:
-        future_df.loc[future_df['Весовой'] == 0, 'Прогноз_продаж'] = future_df.loc[future_df['Весовой'] == 0, 'Прогноз_продаж'].round()
-    
-    # Выбираем нужные колонки для результата
-    result_df = future_df[['Дата', 'SKU', 'Магазин', 'Прогноз_продаж']]
+        piece = (future_df['Весовой'] == 0).to_numpy()
+        forecast[piece] = np.round(forecast[piece])
     
-    print("DEBUG: Прогноз выполнен")
-    return result_df
+    return forecast
 
-def anomaly_detection(df, window=30, std_threshold=3.0):
-    """Обнаружение аномалий в продажах"""
+def anomaly_detection(df, window=30, std_threshold=3.0, time_series_backend='pandas'):
+    """
+    Обнаружение аномалий в продажах.
+    time_series_backend='panel': окно window календарных дней на плотной панели рядов
+    """
     print("DEBUG: Поиск аномалий в продажах")
     
     # Копируем данные
     anomalies_df = df.copy()
     
     # Вычисляем скользящее среднее и стандартное отклонение
-    anomalies_df['MA'] = df.groupby(['SKU', 'Магазин'])['Чистые_продажи'].transform(
-        lambda x: x.rolling(window=window, min_periods=5).mean())
-    anomalies_df['STD'] = df.groupby(['SKU', 'Магазин'])['Чистые_продажи'].transform(
-        lambda x: x.rolling(window=window, min_periods=5).std())
+    if time_series_backend == 'panel':
+        anomalies_df['MA'], anomalies_df['STD'] = panel_anomaly_stats(df, window=window, min_periods=5)
+    else:
+        anomalies_df['MA'] = df.groupby(['SKU', 'Магазин'])['Чистые_продажи'].transform(
+            lambda x: x.rolling(window=window, min_periods=5).mean())
+        anomalies_df['STD'] = df.groupby(['SKU', 'Магазин'])['Чистые_продажи'].transform(
+            lambda x: x.rolling(window=window, min_periods=5).std())
     
     # Вычисляем Z-score (стандартизованное отклонение)
     anomalies_df['Z_score'] = (anomalies_df['Чистые_продажи'] - anomalies_df['MA']) / anomalies_df['STD'].replace(0, 1)
@@ -1291,6 +2494,7 @@ def anomaly_detection(df, window=30, std_threshold=3.0):
 
 def forecast_evaluation(test_df):
     """Оценка точности прогноза с разными метриками"""
+    from sklearn.metrics import mean_absolute_error, mean_squared_error
     print("DEBUG: Расширенная оценка прогноза")
     
     # Основные метрики
@@ -1333,13 +2537,23 @@ def forecast_evaluation(test_df):
     
     return metrics
 
-def seasonality_analysis(df):
-    """Анализ сезонности продаж"""
+def seasonality_analysis(df, cube=None):
+    """Анализ сезонности продаж (при переданном кубе - по агрегатам куба)"""
     print("DEBUG: Анализ сезонности продаж")
     
+    if cube is not None:
+        weekday_sales, monthly_sales, near_holiday_sales = cube_seasonality_tables(cube)
+        has_weekday = has_month = True
+        has_holidays = near_holiday_sales is not None
+    else:
+        has_weekday = 'День_недели' in df.columns
+        has_month = 'Месяц' in df.columns
+        has_holidays = 'Дней_до_праздника' in df.columns and 'Дней_после_праздника' in df.columns
+    
     # Анализ по дням недели
-    if 'День_недели' in df.columns:
-        weekday_sales = df.groupby('День_недели')['Чистые_продажи'].agg(['mean', 'median', 'std']).reset_index()
+    if has_weekday:
+        if cube is None:
+            weekday_sales = df.groupby('День_недели')['Чистые_продажи'].agg(['mean', 'median', 'std']).reset_index()
         weekday_sales['День'] = weekday_sales['День_недели'].map({
             0: 'Понедельник', 1: 'Вторник', 2: 'Среда', 3: 'Четверг', 
             4: 'Пятница', 5: 'Суббота', 6: 'Воскресенье'
@@ -1354,8 +2568,9 @@ def seasonality_analysis(df):
             print(f"{day}: {weekday_ratio.iloc[i]:.2f}")
     
     # Анализ по месяцам
-    if 'Месяц' in df.columns:
-        monthly_sales = df.groupby('Месяц')['Чистые_продажи'].agg(['mean', 'median', 'std']).reset_index()
+    if has_month:
+        if cube is None:
+            monthly_sales = df.groupby('Месяц')['Чистые_продажи'].agg(['mean', 'median', 'std']).reset_index()
         monthly_sales['Месяц_название'] = monthly_sales['Месяц'].map({
             1: 'Январь', 2: 'Февраль', 3: 'Март', 4: 'Апрель', 5: 'Май', 6: 'Июнь',
             7: 'Июль', 8: 'Август', 9: 'Сентябрь', 10: 'Октябрь', 11: 'Ноябрь', 12: 'Декабрь'
@@ -1370,54 +2585,55 @@ def seasonality_analysis(df):
             print(f"{month}: {monthly_ratio.iloc[i]:.2f}")
     
     # Анализ перед/во время/после праздников
-    if 'Дней_до_праздника' in df.columns and 'Дней_после_праздника' in df.columns:
-        # Группировка по дням до ближайшего праздника
-        near_holiday_sales = []
+    if has_holidays:
+        if cube is None:
+            # Группировка по дням до ближайшего праздника
+            near_holiday_sales = []
         
-        # Перед праздником (1-7 дней)
-        before = df[(df['Дней_до_праздника'] >= 1) & (df['Дней_до_праздника'] <= 7)]
-        if not before.empty:
-            near_holiday_sales.append({
-                'Период': 'За 1-7 дней до праздника',
-                'Средние продажи': before['Чистые_продажи'].mean(),
-                'Отношение к среднему': before['Чистые_продажи'].mean() / df['Чистые_продажи'].mean()
-            })
+            # Перед праздником (1-7 дней)
+            before = df[(df['Дней_до_праздника'] >= 1) & (df['Дней_до_праздника'] <= 7)]
+            if not before.empty:
+                near_holiday_sales.append({
+                    'Период': 'За 1-7 дней до праздника',
+                    'Средние продажи': before['Чистые_продажи'].mean(),
+                    'Отношение к среднему': before['Чистые_продажи'].mean() / df['Чистые_продажи'].mean()
+                })
         
-        # В день праздника
-        on_holiday = df[df['Праздник'] == 1]
-        if not on_holiday.empty:
-            near_holiday_sales.append({
-                'Период': 'В день праздника',
-                'Средние продажи': on_holiday['Чистые_продажи'].mean(),
-                'Отношение к среднему': on_holiday['Чистые_продажи'].mean() / df['Чистые_продажи'].mean()
-            })
+            # В день праздника
+            on_holiday = df[df['Праздник'] == 1]
+            if not on_holiday.empty:
+                near_holiday_sales.append({
+                    'Период': 'В день праздника',
+                    'Средние продажи': on_holiday['Чистые_продажи'].mean(),
+                    'Отношение к среднему': on_holiday['Чистые_продажи'].mean() / df['Чистые_продажи'].mean()
+                })
         
-        # После праздника (1-7 дней)
-        after = df[(df['Дней_после_праздника'] >= 1) & (df['Дней_после_праздника'] <= 7)]
-        if not after.empty:
-            near_holiday_sales.append({
-                'Период': 'В течение 1-7 дней после праздника',
-                'Средние продажи': after['Чистые_продажи'].mean(),
-                'Отношение к среднему': after['Чистые_продажи'].mean() / df['Чистые_продажи'].mean()
-            })
+            # После праздника (1-7 дней)
+            after = df[(df['Дней_после_праздника'] >= 1) & (df['Дней_после_праздника'] <= 7)]
+            if not after.empty:
+                near_holiday_sales.append({
+                    'Период': 'В течение 1-7 дней после праздника',
+                    'Средние продажи': after['Чистые_продажи'].mean(),
+                    'Отношение к среднему': after['Чистые_продажи'].mean() / df['Чистые_продажи'].mean()
+                })
         
-        # Обычные дни (не вблизи праздников)
-        normal_days = df[(df['Дней_до_праздника'] > 7) & (df['Дней_после_праздника'] > 7)]
-        if not normal_days.empty:
-            near_holiday_sales.append({
-                'Период': 'Обычные дни',
-                'Средние продажи': normal_days['Чистые_продажи'].mean(),
-                'Отношение к среднему': normal_days['Чистые_продажи'].mean() / df['Чистые_продажи'].mean()
-            })
+            # Обычные дни (не вблизи праздников)
+            normal_days = df[(df['Дней_до_праздника'] > 7) & (df['Дней_после_праздника'] > 7)]
+            if not normal_days.empty:
+                near_holiday_sales.append({
+                    'Период': 'Обычные дни',
+                    'Средние продажи': normal_days['Чистые_продажи'].mean(),
+                    'Отношение к среднему': normal_days['Чистые_продажи'].mean() / df['Чистые_продажи'].mean()
+                })
         
         print("\nВлияние праздников на продажи:")
         for item in near_holiday_sales:
             print(f"{item['Период']}: {item['Средние продажи']:.2f} (x{item['Отношение к среднему']:.2f})")
     
     return {
-        'weekday_analysis': weekday_sales if 'День_недели' in df.columns else None,
-        'monthly_analysis': monthly_sales if 'Месяц' in df.columns else None,
-        'holiday_analysis': near_holiday_sales if 'Праздник' in df.columns else None
+        'weekday_analysis': weekday_sales if has_weekday else None,
+        'monthly_analysis': monthly_sales if has_month else None,
+        'holiday_analysis': near_holiday_sales if has_holidays else None
     }
 
 def generate_sales_report(test_df, ensemble_results, importance_df, metrics, seasonality_analysis):
@@ -1519,29 +2735,66 @@ def generate_sales_report(test_df, ensemble_results, importance_df, metrics, sea
 # ================================================
 # 7. Основная функция запуска прогнозирования
 # ================================================
-def run_sales_forecast(test_size_days=30, forecast_days=30, n_trials=30, save_model=True):
-    """Основная функция запуска процесса прогнозирования продаж"""
+def run_sales_forecast(test_size_days=30, forecast_days=30, n_trials=30, save_model=True, zero_copy=False, binned_datasets=False,
+                       xgb_native_categorical=False, optuna_storage=None, final_fit='refit', incremental=False,
+                       prune_features=False, prune_tolerance=0.01, permutation_check=False, daily_grain=True,
+                       time_series_backend='pandas', feature_engine='pandas', feature_jobs=1, stage_cache=False,
+                       keep_forecast_runs=7, forecast_csv=False):
+    """
+    Основная функция запуска процесса прогнозирования продаж.
+    incremental: дообучить сохраненный ансамбль на данных после его обучающего периода
+    (update_ensemble); при провале проверок дрейфа/точности - полное переобучение
+    prune_features: отобрать компактный набор признаков в пределах prune_tolerance по RMSE
+    (select_features); набор сохраняется с моделью и определяет признаки на инференсе
+    daily_grain: перед признаками свернуть строки чеков до (SKU, Магазин, Дата) - aggregate_daily_sales
+    time_series_backend: 'panel' - лаги/окна/тренды на плотной панели рядов по календарю (нужен daily_grain)
+    feature_engine: 'polars' - признаки одним ленивым запросом Polars (нужен пакет polars)
+    feature_jobs: процессов для лагов/окон/трендов (None - по числу ядер)
+    stage_cache: кэш этапов признаков на диске (cache/stages) для обучения и прогноза
+    keep_forecast_runs: сколько последних запусков держать в хранилище прогнозов (claude_forecast_store)
+    forecast_csv: дополнительно выгрузить прогноз в future_sales_forecast.csv (прежний формат)
+    """
     print("DEBUG: Запуск прогнозирования продаж")
     
     # 1. Загрузка и обработка данных
     sales_df, holidays_df, promotions_df = load_data()
+    if daily_grain:
+        sales_df = aggregate_daily_sales(sales_df)
     
     # 2. Инженерия признаков
-    processed_df = feature_engineering(sales_df, holidays_df, promotions_df)
+    processed_df = feature_engineering(
+        sales_df, holidays_df, promotions_df, time_series_backend, feature_engine, n_jobs=feature_jobs,
+        stage_cache=stage_cache
+    )
+    
+    # Куб для интерактивных сводок: сохраненный куб дополняется новыми днями
+    sales_cube = refresh_sales_cube(processed_df)
     
     # 3. Подготовка данных для обучения
-    X_train, y_train, X_test, y_test, y_test_original, cat_features, train_df, test_df = prepare_train_test_data(
-        processed_df, test_size_days=test_size_days
-    )
+    prepared = prepare_train_test_data(processed_df, test_size_days=test_size_days, zero_copy=zero_copy)
+    if prune_features:
+        prepared = prune_train_test_data(
+            processed_df, prepared, test_size_days=test_size_days, zero_copy=zero_copy,
+            tolerance=prune_tolerance, permutation_check=permutation_check
+        )
+    X_train, y_train, X_test, y_test, y_test_original, cat_features, train_df, test_df = prepared
     
     # 4. Обучение и оптимизация ансамбля моделей
-    ensemble_results, ensemble_pred = create_ensemble(
-        X_train, y_train, X_test, y_test, cat_features, n_trials
+    ensemble_results, ensemble_pred = train_or_update_ensemble(
+        processed_df, X_train, y_train, X_test, y_test, cat_features, n_trials,
+        test_size_days=test_size_days, incremental=incremental, binned_datasets=binned_datasets,
+        xgb_native_categorical=xgb_native_categorical, optuna_storage=optuna_storage, final_fit=final_fit
     )
+    ensemble_results['time_series_backend'] = time_series_backend
+    ensemble_results['daily_grain'] = daily_grain
     
     # 5. Сохранение моделей
     if save_model:
-        save_models(ensemble_results)
+        save_models(ensemble_results, X_train)
+        # Снимок последнего состояния рядов для точечного прогноза (claude_predict)
+        save_state_snapshot(
+            processed_df, holidays_df, X_train.columns.tolist(), cat_features, time_series_backend=time_series_backend
+        )
     
     # 6. Анализ результатов
     test_df['Предсказано'] = ensemble_pred
@@ -1554,10 +2807,10 @@ def run_sales_forecast(test_size_days=30, forecast_days=30, n_trials=30, save_mo
     metrics = forecast_evaluation(test_with_pred)
     
     # 9. Анализ сезонности
-    seasonality_data = seasonality_analysis(processed_df)
+    seasonality_data = seasonality_analysis(processed_df, cube=sales_cube)
     
     # 10. Поиск аномалий
-    anomalies = anomaly_detection(processed_df)
+    anomalies = anomaly_detection(processed_df, time_series_backend=time_series_backend)
     
     # 11. Генерация отчета
     generate_sales_report(test_with_pred, ensemble_results, importance_df, metrics, seasonality_data)
@@ -1565,10 +2818,15 @@ def run_sales_forecast(test_size_days=30, forecast_days=30, n_trials=30, save_mo
     # 12. Прогноз на будущее
     if forecast_days > 0:
         future_forecast = predict_future_sales(
-            ensemble_results, processed_df, holidays_df, promotions_df, days_ahead=forecast_days
+            ensemble_results, processed_df, holidays_df, promotions_df, days_ahead=forecast_days,
+            stage_cache=stage_cache
         )
-        future_forecast.to_csv('future_sales_forecast.csv', index=False)
-        print(f"DEBUG: Прогноз на {forecast_days} дней вперед сохранен в 'future_sales_forecast.csv'")
+        run_id = save_forecast(future_forecast, model_version=ensemble_results.get('artifact_version'))
+        compact_forecast_store(keep_runs=keep_forecast_runs)
+        print(f"DEBUG: Прогноз на {forecast_days} дней вперед сохранен в хранилище прогнозов (запуск {run_id})")
+        if forecast_csv:
+            future_forecast.to_csv('future_sales_forecast.csv', index=False)
+            print("DEBUG: Прогноз также сохранен в 'future_sales_forecast.csv'")
     
     print("DEBUG: Процесс прогнозирования завершен")
     return {
@@ -1577,14 +2835,51 @@ def run_sales_forecast(test_size_days=30, forecast_days=30, n_trials=30, save_mo
         'importance': importance_df,
         'metrics': metrics,
         'seasonality': seasonality_data,
-        'anomalies': anomalies
+        'anomalies': anomalies,
+        'cube': sales_cube
     }
 
+def forecast_with_saved_models(days_ahead=30, model_prefix='retail_sales_', daily_grain=None, stage_cache=False,
+                               keep_forecast_runs=7, forecast_csv=False):
+    """
+    Прогноз сохраненным ансамблем без обучения: загрузка данных, признаки, predict_future_sales
+    и запись в хранилище прогнозов. Загружаются только модели ансамбля с ненулевым весом
+    daily_grain: None - зерно данных, на котором обучен ансамбль (ensemble_meta.pkl)
+    """
+    ensemble_results = load_models(model_prefix)
+    if ensemble_results is None:
+        raise RuntimeError(f"Не удалось загрузить модели с префиксом '{model_prefix}'")
+    if daily_grain is None:
+        daily_grain = ensemble_results.get('daily_grain', True)
+    
+    sales_df, holidays_df, promotions_df = load_data()
+    if daily_grain:
+        sales_df = aggregate_daily_sales(sales_df)
+    processed_df = feature_engineering(
+        sales_df, holidays_df, promotions_df, ensemble_results.get('time_series_backend', 'pandas'),
+        stage_cache=stage_cache
+    )
+    
+    refresh_sales_cube(processed_df)
+    
+    future_forecast = predict_future_sales(
+        ensemble_results, processed_df, holidays_df, promotions_df, days_ahead=days_ahead, stage_cache=stage_cache
+    )
+    run_id = save_forecast(future_forecast, model_version=ensemble_results.get('artifact_version'))
+    compact_forecast_store(keep_runs=keep_forecast_runs)
+    print(f"DEBUG: Прогноз на {days_ahead} дней вперед сохранен в хранилище прогнозов (запуск {run_id})")
+    if forecast_csv:
+        future_forecast.to_csv('future_sales_forecast.csv', index=False)
+    return future_forecast
+
 # ================================================
 # 8. Дополнительные функции для интерактивного использования
 # ================================================
-def get_store_performance_summary(df):
-    """Получение сводки по магазинам"""
+def get_store_performance_summary(df, cube=None):
+    """Получение сводки по магазинам (при переданном кубе - по агрегатам куба)"""
+    if cube is not None:
+        return cube_store_performance_summary(cube)
+    
     if 'Магазин' not in df.columns:
         return "Информация о магазинах недоступна"
     
@@ -1600,8 +2895,11 @@ def get_store_performance_summary(df):
     
     return store_summary
 
-def get_product_performance_summary(df):
-    """Получение сводки по товарам"""
+def get_product_performance_summary(df, cube=None):
+    """Получение сводки по товарам (при переданном кубе - по агрегатам куба)"""
+    if cube is not None:
+        return cube_product_performance_summary(cube)
+    
     if 'SKU' not in df.columns:
         return "Информация о товарах недоступна"
     
@@ -1619,8 +2917,11 @@ def get_product_performance_summary(df):
     
     return product_summary
 
-def analyze_promotion_effectiveness(df):
-    """Анализ эффективности акций"""
+def analyze_promotion_effectiveness(df, cube=None):
+    """Анализ эффективности акций (при переданном кубе - по агрегатам куба)"""
+    if cube is not None:
+        return cube_promotion_effectiveness(cube)
+    
     if 'Акция_активна' not in df.columns or 'Тип_акции' not in df.columns:
         return "Информация об акциях недоступна"
     
@@ -1678,31 +2979,85 @@ def analyze_promotion_effectiveness(df):
     
     return {'promo_effect_by_sku': promo_effect_summary, 'promo_effect_by_type': promo_type_effect}
 
-def interactive_forecast_query(ensemble_results, holidays_df, promotions_df):
-    """Интерактивный запрос для прогнозирования продаж по конкретным параметрам"""
+def stored_forecast(ensemble_results, store_id, sku, data_end, days_ahead):
+    """
+    Прогноз ряда из хранилища прогнозов, если он построен по данным до data_end включительно моделями
+    текущей версии и покрывает days_ahead дней; иначе None (хранилище не создается)
+    """
+    model_version = ensemble_results.get('artifact_version')
+    if model_version is None:
+        return None
+    forecast_store = open_forecast_store(read_only=True)
+    if forecast_store is None:
+        return None
+    try:
+        stored = lookup_forecast(
+            forecast_store, store_id=store_id, sku=sku, data_end=data_end, model_version=model_version
+        )
+    finally:
+        close_forecast_store(forecast_store)
+    if len(stored) < days_ahead:
+        return None
+    return stored.head(days_ahead)
+
+def interactive_forecast_query(ensemble_results, holidays_df, promotions_df, session=None):
+    """
+    Интерактивный запрос для прогнозирования продаж по конкретным параметрам.
+    session: теплая сессия из claude_session.create_forecast_session - данные и признаки
+    берутся из памяти, пересчитывается только запрошенный ряд.
+    Если в хранилище прогнозов есть запуск по тем же данным (последний день истории) и той же
+    версии моделей и он покрывает запрошенный горизонт, прогноз берется из него поиском по
+    индексу без пересчета. Хранилище открывается только для чтения.
+    """
     print("\nИнтерактивный прогноз продаж")
     
     try:
         # Запрос данных для прогноза
-        store_id = int(input("Введите ID магазина: "))
-        sku = input("Введите SKU товара: ")
+        store_id = input("Введите ID магазина: ").strip()
+        sku = input("Введите SKU товара: ").strip()
         
         days_ahead = int(input("На сколько дней вперед построить прогноз? [1-100]: "))
         days_ahead = max(1, min(100, days_ahead))  # Ограничиваем диапазон
         
-        # Получаем последние данные о продажах этого SKU в этом магазине
-        sales_df, _, _ = load_data()
+        # Последний день данных: из сессии или из загруженных продаж
+        if session is not None:
+            data_end = session['processed_df']['Дата'].max()
+        else:
+            sales_df, _, _ = load_data()
+            # То же зерно данных, что при обучении ансамбля
+            if ensemble_results.get('daily_grain', True):
+                sales_df = aggregate_daily_sales(sales_df)
+            data_end = sales_df['Дата'].max()
+        
+        # Готовый прогноз по тем же данным и моделям из хранилища - без пересчета
+        stored = stored_forecast(ensemble_results, store_id, sku, data_end, days_ahead)
+        if stored is not None:
+            print(f"\nПрогноз продаж для SKU {sku} в магазине {store_id} на {days_ahead} дней (хранилище прогнозов):")
+            print(stored[['Дата', 'Прогноз_продаж']])
+            return stored
+        
+        if session is not None:
+            from claude_session import session_forecast
+            forecast_result = session_forecast(session, sku, store_id, days_ahead)
+            if forecast_result is None:
+                print(f"Нет данных для SKU {sku} в магазине {store_id}")
+                return None
+            print(f"\nПрогноз продаж для SKU {sku} в магазине {store_id} на {days_ahead} дней:")
+            print(forecast_result[['Дата', 'Прогноз_продаж']])
+            return forecast_result
         
         # Фильтруем данные по запрошенному магазину и SKU
-        item_data = sales_df[(sales_df['Магазин'] == store_id) & (sales_df['SKU'] == sku)].copy()
+        item_data = sales_df[(sales_df['Магазин'].astype(str) == store_id) & (sales_df['SKU'] == sku)].copy()
         
         if item_data.empty:
             print(f"Нет данных для SKU {sku} в магазине {store_id}")
             return None
         
         # Подготавливаем данные и делаем прогноз
-        processed_df = feature_engineering(sales_df, holidays_df, promotions_df)
-        item_data_processed = processed_df[(processed_df['Магазин'] == store_id) & (processed_df['SKU'] == sku)].copy()
+        processed_df = feature_engineering(
+            sales_df, holidays_df, promotions_df, ensemble_results.get('time_series_backend', 'pandas')
+        )
+        item_data_processed = processed_df[(processed_df['Магазин'].astype(str) == store_id) & (processed_df['SKU'] == sku)].copy()
         
         forecast_result = predict_future_sales(
             ensemble_results, item_data_processed, holidays_df, promotions_df, days_ahead=days_ahead
@@ -1717,7 +3072,8 @@ def interactive_forecast_query(ensemble_results, holidays_df, promotions_df):
         print(f"Ошибка при выполнении интерактивного запроса: {e}")
         return None
 
-if __name__ == "__main__":
+def main(argv=None):
+    """Обучение ансамбля из командной строки (python claude.py или claude_cli.py train)"""
     import argparse
 
     parser = argparse.ArgumentParser(description="Прогнозирование продаж")
@@ -1725,31 +3081,72 @@ if __name__ == "__main__":
     parser.add_argument("--forecast_days", type=int, default=30, help="Горизонт прогноза")
     parser.add_argument("--trials", type=int, default=30, help="Количество итераций Optuna")
     parser.add_argument("--interactive", action="store_true", help="Режим анализа и визуализации")
-
-    args = parser.parse_args()
+    parser.add_argument("--zero_copy", action="store_true", help="Единый float32-блок признаков без копий train/test")
+    parser.add_argument("--binned_datasets", action="store_true", help="Бинаризовать данные один раз (кэш в cache/datasets)")
+    parser.add_argument("--xgb_native_categorical", action="store_true", help="Нативные категории XGBoost вместо кодов")
+    parser.add_argument("--optuna_storage", default=None,
+                        help="Хранилище Optuna для продолжения и параллельных воркеров (sqlite:///optuna_studies.db или файл .log)")
+    parser.add_argument("--final_fit", choices=['refit', 'bagging'], default='refit',
+                        help="Финальная модель: переобучение по лучшим итерациям фолдов или среднее моделей фолдов")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Дообучить сохраненный ансамбль на новых данных (при дрейфе - полное переобучение)")
+    parser.add_argument("--prune_features", action="store_true", help="Отбор признаков по важности перед обучением")
+    parser.add_argument("--prune_tolerance", type=float, default=0.01, help="Допустимое ухудшение RMSE при отборе признаков")
+    parser.add_argument("--permutation_check", action="store_true", help="Перестановочная проверка отсеянных признаков")
+    parser.add_argument("--transaction_grain", action="store_true",
+                        help="Признаки по строкам чеков без агрегации до дней (прежнее поведение)")
+    parser.add_argument("--panel_features", action="store_true",
+                        help="Лаги, окна и тренды на плотной панели рядов по календарным дням")
+    parser.add_argument("--polars", action="store_true", help="Инженерия признаков ленивым запросом Polars")
+    parser.add_argument("--feature_jobs", type=int, default=1,
+                        help="Процессов для лагов, окон и трендов (0 - по числу ядер)")
+    parser.add_argument("--stage_cache", action="store_true", help="Кэш этапов признаков на диске (cache/stages)")
+
+    args = parser.parse_args(argv)
 
     # 1. Загрузка данных
     sales_df, holidays_df, promotions_df = load_data()
+    if not args.transaction_grain:
+        sales_df = aggregate_daily_sales(sales_df)
 
     # 2. Feature engineering
-    sales_df = feature_engineering(sales_df, holidays_df, promotions_df)
+    time_series_backend = 'panel' if args.panel_features else 'pandas'
+    sales_df = feature_engineering(
+        sales_df, holidays_df, promotions_df, time_series_backend, 'polars' if args.polars else 'pandas',
+        n_jobs=args.feature_jobs or None, stage_cache=args.stage_cache
+    )
+    # Куб для сводок (claude_cli.py report) - как в run_sales_forecast
+    refresh_sales_cube(sales_df)
 
     # 3. Подготовка данных
-    X_train, y_train, X_test, y_test, y_test_original, cat_features, train_df, test_df = prepare_train_test_data(
-        sales_df, test_size_days=args.test_days
-    )
+    prepared = prepare_train_test_data(sales_df, test_size_days=args.test_days, zero_copy=args.zero_copy)
+    if args.prune_features:
+        prepared = prune_train_test_data(
+            sales_df, prepared, test_size_days=args.test_days, zero_copy=args.zero_copy,
+            tolerance=args.prune_tolerance, permutation_check=args.permutation_check
+        )
+    X_train, y_train, X_test, y_test, y_test_original, cat_features, train_df, test_df = prepared
 
     # 4. Обучение и ансамблирование
-    ensemble_results, ensemble_pred = create_ensemble(
-        X_train, y_train, X_test, y_test, cat_features=cat_features, n_trials=args.trials
+    ensemble_results, ensemble_pred = train_or_update_ensemble(
+        sales_df, X_train, y_train, X_test, y_test, cat_features=cat_features, n_trials=args.trials,
+        test_size_days=args.test_days, incremental=args.incremental,
+        binned_datasets=args.binned_datasets, xgb_native_categorical=args.xgb_native_categorical,
+        optuna_storage=args.optuna_storage, final_fit=args.final_fit
     )
+    ensemble_results['time_series_backend'] = time_series_backend
+    ensemble_results['daily_grain'] = not args.transaction_grain
 
     # 5. Анализ, если включён интерактивный режим
     if args.interactive:
         test_df = analyze_model_performance(ensemble_results, test_df, ensemble_pred, y_test_original)
         feature_importance_analysis(ensemble_results, X_test)
         forecast_evaluation(test_df)
-        seasonality_analysis(train_df)
+        seasonality_analysis(train_df if train_df is not None else sales_df)
 
-    # 6. Сохранение моделей
-    save_models(ensemble_results)
+    # 6. Сохранение моделей и снимка состояния рядов
+    save_models(ensemble_results, X_train)
+    save_state_snapshot(sales_df, holidays_df, X_train.columns.tolist(), cat_features, time_series_backend=time_series_backend)
+
+if __name__ == "__main__":
+    main()
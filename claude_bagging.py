@@ -0,0 +1,27 @@
+import numpy as np
+
+# ================================================
+# Бэггинг моделей фолдов кросс-валидации
+# ================================================
+# Модели фолдов лучшего триала Optuna уже обучены с ранней остановкой на своих
+# валидационных частях, поэтому вместо финального переобучения их предсказания
+# можно просто усреднить. Класс вынесен в отдельный модуль, чтобы сохраненные
+# через joblib модели загружались и из claude.py, и из claude_predict.py.
+
+class FoldBaggedModel:
+    """
+    Усредняет предсказания моделей фолдов одной библиотеки (LightGBM Booster,
+    XGBoost Booster или CatBoostRegressor) - интерфейс predict тот же, что у исходных моделей.
+    """
+
+    def __init__(self, models):
+        self.models = list(models)
+
+    def predict(self, data, *args, **kwargs):
+        return np.mean([model.predict(data, *args, **kwargs) for model in self.models], axis=0)
+
+    def __getattr__(self, name):
+        # Важности признаков, типы признаков и т.п. - от модели последнего (самого большого) фолда
+        if name == 'models':
+            raise AttributeError(name)
+        return getattr(self.models[-1], name)
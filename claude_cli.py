@@ -0,0 +1,223 @@
+import sys
+import time
+
+# ================================================
+# Единая точка входа с подкомандами
+# ================================================
+# Каждая подкоманда импортирует только то, что ей нужно, и только внутри своего
+# обработчика: train - весь пайплайн (Optuna, scikit-learn и все три бустинга),
+# forecast/serve - признаки и загруженные модели ансамбля, predict - claude_predict
+# и снимок состояния рядов без claude.py, report - куб продаж или хранилище прогнозов
+# без библиотек моделей. Библиотека модели импортируется при загрузке ее файла
+# (joblib), поэтому артефакт только с LightGBM (или с нулевыми весами остальных
+# моделей) не загружает XGBoost и CatBoost.
+#
+# Использование:
+#   python claude_cli.py [--timing] train [аргументы claude.py]
+#   python claude_cli.py [--timing] forecast --days 30
+#   python claude_cli.py [--timing] predict --sku 369314 --store E14 --date 2025-04-11 [--set Акция_активна=1]
+#       [--cache_dir cache/predictions]
+#   python claude_cli.py [--timing] report stores|products|promotions|forecast [--store ...] [--sku ...]
+#   python claude_cli.py [--timing] serve [--repl] [--port 8765] [--cache_entries 4096] [--cache_dir cache/predictions]
+# --timing: время импорта, загрузки и первого прогноза/результата от старта модуля и список
+# загруженных библиотек моделей.
+
+_START = time.perf_counter()
+
+# Тяжелые библиотеки, загрузку которых показывает --timing
+ENGINE_MODULES = ['lightgbm', 'xgboost', 'catboost', 'optuna', 'sklearn', 'matplotlib']
+
+TIMING_LABELS = {
+    'import': 'импорт',
+    'load': 'загрузка',
+    'first_prediction': 'первый прогноз',
+    'result': 'результат',
+}
+
+def _mark(timings, name):
+    timings[name] = time.perf_counter() - _START
+
+def loaded_engines():
+    """Какие из тяжелых библиотек уже импортированы в процесс"""
+    return [name for name in ENGINE_MODULES if name in sys.modules]
+
+def report_timings(command, timings):
+    """Время этапов подкоманды (секунды от старта модуля) и загруженные библиотеки"""
+    stages = ', '.join(f"{TIMING_LABELS.get(name, name)} {seconds:.3f}s" for name, seconds in timings.items())
+    print(f"DEBUG: [{command}] {stages}; библиотеки моделей: {', '.join(loaded_engines()) or 'нет'}")
+
+def _parse_value(value):
+    """Значение признака из --set: число, если разбирается, иначе строка"""
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+def cmd_train(args, extra, timings):
+    import claude
+    _mark(timings, 'import')
+    claude.main(extra)
+    _mark(timings, 'result')
+
+def cmd_forecast(args, extra, timings):
+    import claude
+    _mark(timings, 'import')
+    forecast = claude.forecast_with_saved_models(
+        days_ahead=args.days, model_prefix=args.model_prefix, daily_grain=False if args.transaction_grain else None,
+        stage_cache=args.stage_cache, keep_forecast_runs=args.keep_forecast_runs, forecast_csv=args.forecast_csv
+    )
+    _mark(timings, 'first_prediction')
+    print(f"Прогноз: {len(forecast)} строк, {forecast['Дата'].min():%Y-%m-%d} - {forecast['Дата'].max():%Y-%m-%d}")
+
+def cmd_predict(args, extra, timings):
+    from claude_predict import load_all_models_and_meta, predict_sales
+    from claude_snapshot import load_state_snapshot
+    from claude_prediction_cache import artifact_version, create_prediction_cache, prediction_cache_stats
+    _mark(timings, 'import')
+
+    models = load_all_models_and_meta(args.model_prefix)
+    snapshot = load_state_snapshot(args.model_prefix)
+    if snapshot is None:
+        print("Снимок состояния рядов не найден - признаки истории будут нулевыми")
+    _mark(timings, 'load')
+
+    user_input = {'SKU': args.sku, 'Магазин': _parse_value(args.store)}
+    if args.date:
+        user_input['Дата'] = args.date
+    for assignment in args.set or []:
+        name, _, value = assignment.partition('=')
+        user_input[name] = _parse_value(value)
+    # Кэш на диске переживает процесс: повторный запрос к тем же моделям не строит признаки заново
+    cache = create_prediction_cache(disk_dir=args.cache_dir) if args.cache_dir else None
+    result = predict_sales(
+        user_input, *models, snapshot=snapshot, prediction_cache=cache, model_version=artifact_version(args.model_prefix)
+    )
+    _mark(timings, 'first_prediction')
+
+    for name, value in result.items():
+        print(f"{name + ':':<10} {value:.3f}")
+    if cache is not None and args.timing:
+        stats = prediction_cache_stats(cache)
+        print(f"DEBUG: Кэш прогнозов: попаданий {stats['hits']}, промахов {stats['misses']}")
+
+def cmd_report(args, extra, timings):
+    if args.kind == 'forecast':
+        from claude_forecast_store import open_forecast_store, close_forecast_store, lookup_forecast
+        _mark(timings, 'import')
+        forecast_store = open_forecast_store(read_only=True)
+        if forecast_store is None:
+            table = "Хранилище прогнозов не найдено"
+        else:
+            try:
+                table = lookup_forecast(
+                    forecast_store, store_id=args.store, sku=args.sku, start=args.start, end=args.end
+                )
+            finally:
+                close_forecast_store(forecast_store)
+    else:
+        from claude_cube import (
+            load_sales_cube, cube_store_performance_summary, cube_product_performance_summary,
+            cube_promotion_effectiveness
+        )
+        _mark(timings, 'import')
+        try:
+            cube = load_sales_cube(args.cube)
+        except FileNotFoundError:
+            print(f"Куб продаж '{args.cube}' не найден: он создается командами train и forecast")
+            return
+        table = {
+            'stores': cube_store_performance_summary,
+            'products': cube_product_performance_summary,
+            'promotions': cube_promotion_effectiveness,
+        }[args.kind](cube)
+    _mark(timings, 'result')
+    print(table.head(args.top).to_string() if hasattr(table, 'head') else table)
+
+def cmd_serve(args, extra, timings):
+    from claude_session import create_forecast_session, session_forecast, serve_forecast_session, run_forecast_repl
+    _mark(timings, 'import')
+    session = create_forecast_session(
+        model_prefix=args.model_prefix, cache_entries=args.cache_entries, cache_dir=args.cache_dir
+    )
+    _mark(timings, 'load')
+
+    # Первый запрос прогревает модели - его задержку видит первый клиент
+    sku, store = next(iter(session['series_index']))
+    session_forecast(session, sku, store, args.days)
+    _mark(timings, 'first_prediction')
+    if args.timing:
+        report_timings(args.command, timings)
+
+    if args.repl:
+        run_forecast_repl(session)
+    else:
+        serve_forecast_session(session, host=args.host, port=args.port)
+
+COMMANDS = {
+    'train': cmd_train,
+    'forecast': cmd_forecast,
+    'predict': cmd_predict,
+    'report': cmd_report,
+    'serve': cmd_serve,
+}
+
+def build_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Прогнозирование продаж: обучение, прогноз, отчеты и сервер")
+    parser.add_argument("--timing", action="store_true", help="Время импорта и первого прогноза, загруженные библиотеки")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("train", add_help=False, help="Обучение ансамбля (аргументы claude.py, см. train --help)")
+
+    forecast = subparsers.add_parser("forecast", help="Прогноз сохраненными моделями в хранилище прогнозов")
+    forecast.add_argument("--days", type=int, default=30, help="Горизонт прогноза")
+    forecast.add_argument("--model_prefix", default="retail_sales_", help="Префикс файлов сохраненных моделей")
+    forecast.add_argument("--transaction_grain", action="store_true", help="Без агрегации до дней (по умолчанию - зерно обучения из ensemble_meta.pkl)")
+    forecast.add_argument("--stage_cache", action="store_true", help="Кэш этапов признаков на диске (cache/stages)")
+    forecast.add_argument("--keep_forecast_runs", type=int, default=7, help="Сколько запусков хранить")
+    forecast.add_argument("--forecast_csv", action="store_true", help="Также выгрузить future_sales_forecast.csv")
+
+    predict = subparsers.add_parser("predict", help="Точечный прогноз (SKU, Магазин, Дата) по снимку состояния")
+    predict.add_argument("--sku", required=True, help="SKU товара")
+    predict.add_argument("--store", required=True, help="Магазин")
+    predict.add_argument("--date", default=None, help="Дата прогноза (по умолчанию - день после истории)")
+    predict.add_argument("--set", action="append", metavar="ПРИЗНАК=ЗНАЧЕНИЕ", help="Значение признака вручную")
+    predict.add_argument("--model_prefix", default="retail_sales_", help="Префикс файлов сохраненных моделей")
+    predict.add_argument("--cache_dir", default=None, help="Каталог кэша прогнозов на диске")
+
+    report = subparsers.add_parser("report", help="Сводки по кубу продаж или выборка из хранилища прогнозов")
+    report.add_argument("kind", choices=["stores", "products", "promotions", "forecast"], help="Вид отчета")
+    report.add_argument("--cube", default="retail_sales_cube.pkl", help="Файл куба продаж")
+    report.add_argument("--store", default=None, help="Магазин (для forecast)")
+    report.add_argument("--sku", default=None, help="SKU (для forecast)")
+    report.add_argument("--start", default=None, help="Начало периода (для forecast)")
+    report.add_argument("--end", default=None, help="Конец периода (для forecast)")
+    report.add_argument("--top", type=int, default=20, help="Сколько строк показать")
+
+    serve = subparsers.add_parser("serve", help="Теплая сессия прогнозов: сокет-сервер или консоль")
+    serve.add_argument("--model_prefix", default="retail_sales_", help="Префикс файлов сохраненных моделей")
+    serve.add_argument("--repl", action="store_true", help="Консоль вместо сокет-сервера")
+    serve.add_argument("--host", default="127.0.0.1", help="Адрес сервера")
+    serve.add_argument("--port", type=int, default=8765, help="Порт сервера")
+    serve.add_argument("--days", type=int, default=30, help="Горизонт прогревочного прогноза")
+    serve.add_argument("--cache_entries", type=int, default=4096, help="Размер кэша прогнозов в памяти")
+    serve.add_argument("--cache_dir", default=None, help="Каталог кэша прогнозов на диске")
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args, extra = parser.parse_known_args(argv)
+    if extra and args.command != 'train':
+        parser.error(f"неизвестные аргументы: {' '.join(extra)}")
+
+    timings = {}
+    COMMANDS[args.command](args, extra, timings)
+    if args.timing and args.command != 'serve':
+        report_timings(args.command, timings)
+
+if __name__ == "__main__":
+    main()
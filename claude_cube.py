@@ -0,0 +1,349 @@
+import os
+import pandas as pd
+import numpy as np
+import joblib
+from datetime import datetime
+
+# ================================================
+# Агрегированный куб продаж для интерактивного анализа
+# ================================================
+# Зерно куба: (SKU, Магазин, Дата, Акция_активна, Тип_акции).
+# Аддитивные меры (кол-во строк, сумма, сумма квадратов) складываются при
+# инкрементальном обновлении, а количества уникальных значений хранятся
+# в виде HyperLogLog-скетчей, которые объединяются поэлементным максимумом.
+# При p=10 (1024 регистра на группу) относительная ошибка оценки ~3%.
+# Куб помнит первую и последнюю дату данных: обновление добавляет только строки
+# после последней даты, поэтому повторная подача уже учтенного дня не удваивает
+# меры (refresh_sales_cube - загрузка сохраненного куба и дополнение его новыми днями).
+
+CUBE_KEYS = ['SKU', 'Магазин', 'Дата', 'Акция_активна', 'Тип_акции']
+CUBE_TARGET = 'Чистые_продажи'
+
+# Признаки, однозначно определяемые датой (нужны для анализа праздников)
+CUBE_DATE_ATTRS = ['Дней_до_праздника', 'Дней_после_праздника', 'Праздник']
+
+# Скетчи уникальных значений: имя -> (ключи группировки, колонка для подсчета)
+CUBE_SKETCHES = {
+    'sku_per_store': (['Магазин'], 'SKU'),
+    'stores_per_sku': (['SKU'], 'Магазин'),
+    'days_per_sku': (['SKU'], 'Дата'),
+    'days_per_sku_promo': (['SKU', 'Акция_активна'], 'Дата'),
+    'sku_per_promo_type': (['Тип_акции'], 'SKU'),
+    'days_per_promo_type': (['Тип_акции'], 'Дата'),
+}
+
+def _hll_alpha(m):
+    """Поправочный коэффициент HyperLogLog для m регистров"""
+    if m == 16:
+        return 0.673
+    if m == 32:
+        return 0.697
+    if m == 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / m)
+
+def _bit_length(values):
+    """Векторизованная длина в битах для uint64 (через две 32-битные половины)"""
+    hi = (values >> np.uint64(32)).astype('float64')
+    lo = (values & np.uint64(0xFFFFFFFF)).astype('float64')
+    hi_bits = np.frexp(hi)[1]
+    lo_bits = np.frexp(lo)[1]
+    return np.where(hi_bits > 0, hi_bits + 32, lo_bits).astype('int64')
+
+def hll_build(group_codes, n_groups, values, p=10):
+    """Построение HyperLogLog-регистров (n_groups x 2**p) для значений values по группам"""
+    m = 1 << p
+    registers = np.zeros((n_groups, m), dtype='uint8')
+    if len(values) == 0:
+        return registers
+
+    hashes = pd.util.hash_pandas_object(pd.Series(values), index=False).to_numpy(dtype='uint64')
+    idx = (hashes >> np.uint64(64 - p)).astype('int64')
+    rest = hashes & np.uint64((1 << (64 - p)) - 1)
+    rho = ((64 - p) - _bit_length(rest) + 1).astype('uint8')
+
+    np.maximum.at(registers, (np.asarray(group_codes, dtype='int64'), idx), rho)
+    return registers
+
+def hll_estimate(registers):
+    """Оценка количества уникальных значений по каждой строке регистров"""
+    m = registers.shape[1]
+    raw = _hll_alpha(m) * m * m / np.power(2.0, -registers.astype('float64')).sum(axis=1)
+    zeros = (registers == 0).sum(axis=1)
+    # Коррекция для малых кардинальностей (linear counting)
+    with np.errstate(divide='ignore'):
+        linear = m * np.log(m / np.maximum(zeros, 1))
+    estimate = np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+    return np.rint(estimate).astype('int64')
+
+def _build_sketch(df, keys, value_col, p):
+    """Скетч уникальных значений value_col в разрезе keys"""
+    group_codes, uniques = pd.MultiIndex.from_frame(df[keys]).factorize()
+    registers = hll_build(group_codes, len(uniques), df[value_col].to_numpy(), p=p)
+    return {'keys': uniques.to_frame(index=False), 'registers': registers}
+
+def _merge_sketch(old, new):
+    """Объединение двух скетчей с одинаковыми ключами группировки"""
+    keys = old['keys'].columns.tolist()
+    all_keys = pd.concat([old['keys'], new['keys']], ignore_index=True)
+    codes, uniques = pd.MultiIndex.from_frame(all_keys).factorize()
+    registers = np.zeros((len(uniques), old['registers'].shape[1]), dtype='uint8')
+    n_old = len(old['keys'])
+    registers[codes[:n_old]] = old['registers']
+    np.maximum.at(registers, codes[n_old:], new['registers'])
+    return {'keys': uniques.to_frame(index=False)[keys], 'registers': registers}
+
+def _sketch_counts(sketch, name):
+    """Оценки уникальных значений скетча в виде Series с индексом по ключам"""
+    index = pd.MultiIndex.from_frame(sketch['keys'])
+    if index.nlevels == 1:
+        index = index.get_level_values(0)
+    return pd.Series(hll_estimate(sketch['registers']), index=index, name=name)
+
+def _aggregate_cells(df):
+    """Аддитивные меры на зерне куба"""
+    target = df[CUBE_TARGET].astype('float64')
+    cells = pd.DataFrame({key: df[key] for key in CUBE_KEYS})
+    cells['n'] = 1
+    cells['sum'] = target
+    cells['sumsq'] = target * target
+    cells = cells.groupby(CUBE_KEYS, observed=True, sort=False).agg(
+        n=('n', 'sum'), sum=('sum', 'sum'), sumsq=('sumsq', 'sum')
+    ).reset_index()
+    cells['n'] = cells['n'].astype('int32')
+    return cells
+
+def build_sales_cube(df, p=10):
+    """Построение агрегированного куба продаж по строковым данным"""
+    print("DEBUG: Построение куба продаж")
+
+    missing = [col for col in CUBE_KEYS + [CUBE_TARGET] if col not in df.columns]
+    if missing:
+        raise ValueError(f"Для построения куба не хватает колонок: {missing}")
+
+    date_attrs = [col for col in CUBE_DATE_ATTRS if col in df.columns]
+    cube = {
+        'cells': _aggregate_cells(df),
+        'dates': df.groupby('Дата')[date_attrs].first().reset_index() if date_attrs else None,
+        'sketches': {
+            name: _build_sketch(df, keys, value_col, p)
+            for name, (keys, value_col) in CUBE_SKETCHES.items()
+        },
+        'weight_map': df.groupby('SKU', observed=True)['Весовой'].first() if 'Весовой' in df.columns else None,
+        'p': p,
+        'min_date': df['Дата'].min(),
+        'max_date': df['Дата'].max(),
+        'built_at': datetime.now(),
+        'version': 1,
+    }
+
+    print(f"DEBUG: Куб построен. Ячеек: {len(cube['cells'])} (строк в исходных данных: {len(df)})")
+    return cube
+
+def cube_date_range(cube):
+    """Первая и последняя дата данных куба (у кубов прежних версий - по ячейкам)"""
+    if 'max_date' in cube:
+        return cube['min_date'], cube['max_date']
+    return cube['cells']['Дата'].min(), cube['cells']['Дата'].max()
+
+def update_sales_cube(cube, new_df):
+    """
+    Инкрементальное обновление куба строками продаж после его последней даты.
+    Строки за уже учтенные даты пропускаются - их ячейки в кубе уже посчитаны
+    """
+    min_date, max_date = cube_date_range(cube)
+    new_df = new_df[new_df['Дата'] > max_date]
+    if new_df.empty:
+        print(f"DEBUG: Куб продаж актуален (данные по {max_date:%Y-%m-%d})")
+        return cube
+    print(f"DEBUG: Обновление куба продаж ({len(new_df)} новых строк после {max_date:%Y-%m-%d})")
+    delta = build_sales_cube(new_df, p=cube['p'])
+
+    cells = pd.concat([cube['cells'], delta['cells']], ignore_index=True)
+    cube['cells'] = cells.groupby(CUBE_KEYS, observed=True, sort=False).agg(
+        n=('n', 'sum'), sum=('sum', 'sum'), sumsq=('sumsq', 'sum')
+    ).reset_index()
+
+    for name in CUBE_SKETCHES:
+        cube['sketches'][name] = _merge_sketch(cube['sketches'][name], delta['sketches'][name])
+
+    if delta['dates'] is not None:
+        dates = delta['dates'] if cube['dates'] is None else pd.concat([cube['dates'], delta['dates']])
+        cube['dates'] = dates.drop_duplicates(subset='Дата', keep='last').sort_values('Дата').reset_index(drop=True)
+
+    if delta['weight_map'] is not None:
+        weight_map = delta['weight_map'] if cube['weight_map'] is None else pd.concat([cube['weight_map'], delta['weight_map']])
+        cube['weight_map'] = weight_map[~weight_map.index.duplicated(keep='first')]
+
+    cube['min_date'], cube['max_date'] = min_date, delta['max_date']
+    cube['built_at'] = datetime.now()
+    cube['version'] += 1
+    return cube
+
+def refresh_sales_cube(df, path='retail_sales_cube.pkl', p=10):
+    """
+    Куб по загруженным данным с сохранением в path: сохраненный куб дополняется днями после его
+    последней даты; без сохраненного куба или если история другая (другое начало данных, куб
+    новее данных) - полное построение
+    """
+    cube = None
+    if os.path.exists(path):
+        cube = load_sales_cube(path)
+        min_date, max_date = cube_date_range(cube)
+        if cube['p'] != p or min_date != df['Дата'].min() or max_date > df['Дата'].max():
+            print("DEBUG: Сохраненный куб построен по другой истории - полное построение")
+            cube = None
+    cube = build_sales_cube(df, p) if cube is None else update_sales_cube(cube, df)
+    save_sales_cube(cube, path)
+    return cube
+
+def save_sales_cube(cube, path='retail_sales_cube.pkl'):
+    """Сохранение куба на диск"""
+    joblib.dump(cube, path)
+    print(f"DEBUG: Куб продаж сохранен в '{path}'")
+
+def load_sales_cube(path='retail_sales_cube.pkl'):
+    """Загрузка сохраненного куба"""
+    cube = joblib.load(path)
+    print(f"DEBUG: Куб продаж загружен из '{path}' (версия {cube['version']}, ячеек: {len(cube['cells'])})")
+    return cube
+
+# ================================================
+# Сводки по кубу (тот же формат, что у функций в claude.py)
+# ================================================
+def _rollup(cells, keys):
+    """Свертка аддитивных мер куба по заданным ключам"""
+    return cells.groupby(keys, observed=True).agg(n=('n', 'sum'), sum=('sum', 'sum'), sumsq=('sumsq', 'sum'))
+
+def _moments(rollup):
+    """Среднее и выборочное стандартное отклонение по аддитивным мерам"""
+    n = rollup['n'].astype('float64')
+    mean = rollup['sum'] / n
+    var = (rollup['sumsq'] - rollup['sum'] * mean) / (n - 1)
+    std = np.sqrt(var.clip(lower=0)).where(n > 1)
+    return mean, std
+
+def _weighted_median(cells, keys):
+    """Медиана по средним значениям ячеек, взвешенным количеством строк в ячейке"""
+    values = cells[keys].copy()
+    values['value'] = cells['sum'] / cells['n']
+    values['n'] = cells['n']
+    values = values.sort_values(keys + ['value'])
+    cum = values.groupby(keys, observed=True)['n'].cumsum()
+    half = values.groupby(keys, observed=True)['n'].transform('sum') / 2
+    return values[cum >= half].groupby(keys, observed=True)['value'].first()
+
+def cube_store_performance_summary(cube):
+    """Сводка по магазинам по кубу"""
+    rollup = _rollup(cube['cells'], ['Магазин'])
+    store_summary = pd.DataFrame({
+        'Средний_объем_продаж': rollup['sum'] / rollup['n'],
+        'Общий_объем_продаж': rollup['sum'],
+        'Кол_во_SKU': _sketch_counts(cube['sketches']['sku_per_store'], 'Кол_во_SKU'),
+        'Кол_во_транзакций': rollup['n'],
+    }).rename_axis('Магазин')
+    store_summary = store_summary.sort_values('Общий_объем_продаж', ascending=False).reset_index()
+    store_summary['Рейтинг'] = store_summary['Общий_объем_продаж'].rank(pct=True).round(3)
+    return store_summary
+
+def cube_product_performance_summary(cube):
+    """Сводка по товарам по кубу"""
+    rollup = _rollup(cube['cells'], ['SKU'])
+    product_summary = pd.DataFrame({
+        'Средний_объем_продаж': rollup['sum'] / rollup['n'],
+        'Общий_объем_продаж': rollup['sum'],
+        'Кол_во_магазинов': _sketch_counts(cube['sketches']['stores_per_sku'], 'Кол_во_магазинов'),
+        'Кол_во_дней_продаж': _sketch_counts(cube['sketches']['days_per_sku'], 'Кол_во_дней_продаж'),
+    }).rename_axis('SKU')
+    product_summary = product_summary.sort_values('Общий_объем_продаж', ascending=False).reset_index()
+
+    if cube['weight_map'] is not None:
+        product_summary['Весовой'] = product_summary['SKU'].map(cube['weight_map'])
+
+    return product_summary
+
+def cube_promotion_effectiveness(cube):
+    """Анализ эффективности акций по кубу"""
+    cells = cube['cells']
+    rollup = _rollup(cells, ['SKU', 'Акция_активна'])
+    days = _sketch_counts(cube['sketches']['days_per_sku_promo'], 'Кол_во_дней')
+    promo_effect = pd.DataFrame({
+        'Средние_продажи': rollup['sum'] / rollup['n'],
+        'Кол_во_дней': days.reindex(rollup.index),
+    }).reset_index()
+
+    promo_effect_pivot = promo_effect.pivot(
+        index='SKU',
+        columns='Акция_активна',
+        values=['Средние_продажи', 'Кол_во_дней']
+    ).fillna(0)
+    promo_effect_pivot.columns = [
+        'Продажи_без_акции' if col == ('Средние_продажи', 0)
+        else 'Продажи_с_акцией' if col == ('Средние_продажи', 1)
+        else 'Дней_без_акции' if col == ('Кол_во_дней', 0)
+        else 'Дней_с_акцией'
+        for col in promo_effect_pivot.columns
+    ]
+    promo_effect_pivot['Эффект_акции'] = (
+        promo_effect_pivot['Продажи_с_акцией'] /
+        promo_effect_pivot['Продажи_без_акции'].replace(0, 1)
+    )
+    promo_effect_summary = promo_effect_pivot[promo_effect_pivot['Дней_с_акцией'] >= 5].reset_index()
+    promo_effect_summary = promo_effect_summary.sort_values('Эффект_акции', ascending=False)
+
+    type_rollup = _rollup(cells, ['Тип_акции'])
+    promo_type_effect = pd.DataFrame({
+        'Средние_продажи': type_rollup['sum'] / type_rollup['n'],
+        'Кол_во_SKU': _sketch_counts(cube['sketches']['sku_per_promo_type'], 'Кол_во_SKU'),
+        'Кол_во_дней': _sketch_counts(cube['sketches']['days_per_promo_type'], 'Кол_во_дней'),
+    }).rename_axis('Тип_акции').dropna(subset=['Средние_продажи']).reset_index()
+
+    no_promo = cells[cells['Акция_активна'] == 0]
+    avg_sales_no_promo = no_promo['sum'].sum() / no_promo['n'].sum()
+    promo_type_effect['Эффект_типа_акции'] = promo_type_effect['Средние_продажи'] / avg_sales_no_promo
+    promo_type_effect = promo_type_effect.sort_values('Эффект_типа_акции', ascending=False)
+
+    return {'promo_effect_by_sku': promo_effect_summary, 'promo_effect_by_type': promo_type_effect}
+
+def cube_seasonality_tables(cube):
+    """
+    Таблицы сезонности по кубу: по дням недели, по месяцам и по близости к праздникам.
+    Медиана считается по средним значениям ячеек куба (взвешенно), поэтому для
+    транзакционных данных она приближенная; среднее и std точные.
+    """
+    cells = cube['cells'][['Дата', 'n', 'sum', 'sumsq']].copy()
+    cells['День_недели'] = cells['Дата'].dt.dayofweek.astype('int8')
+    cells['Месяц'] = cells['Дата'].dt.month.astype('int8')
+
+    tables = {}
+    for key in ['День_недели', 'Месяц']:
+        rollup = _rollup(cells, [key])
+        mean, std = _moments(rollup)
+        tables[key] = pd.DataFrame({
+            'mean': mean,
+            'median': _weighted_median(cells, [key]),
+            'std': std,
+        }).reset_index()
+
+    holiday_rows = None
+    if cube['dates'] is not None and {'Дней_до_праздника', 'Дней_после_праздника', 'Праздник'} <= set(cube['dates'].columns):
+        daily = _rollup(cells, ['Дата']).reset_index().merge(cube['dates'], on='Дата', how='left')
+        overall = daily['sum'].sum() / daily['n'].sum()
+        periods = [
+            ('За 1-7 дней до праздника', (daily['Дней_до_праздника'] >= 1) & (daily['Дней_до_праздника'] <= 7)),
+            ('В день праздника', daily['Праздник'] == 1),
+            ('В течение 1-7 дней после праздника', (daily['Дней_после_праздника'] >= 1) & (daily['Дней_после_праздника'] <= 7)),
+            ('Обычные дни', (daily['Дней_до_праздника'] > 7) & (daily['Дней_после_праздника'] > 7)),
+        ]
+        holiday_rows = []
+        for name, mask in periods:
+            n = daily.loc[mask, 'n'].sum()
+            if n > 0:
+                period_mean = daily.loc[mask, 'sum'].sum() / n
+                holiday_rows.append({
+                    'Период': name,
+                    'Средние продажи': period_mean,
+                    'Отношение к среднему': period_mean / overall
+                })
+
+    return tables['День_недели'], tables['Месяц'], holiday_rows
@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+
+# ================================================
+# Диагностика прогноза по агрегатам
+# ================================================
+# Точечный график «предсказано vs факт» рисует каждую строку теста: на месяце
+# данных это минуты и нечитаемое облако точек. Здесь данные сначала сводятся
+# NumPy в двумерную гистограмму (bins x bins счетчиков в логарифмической шкале
+# продаж) и в таблицы ошибок по сегментам (bincount по кодам сегментов), а графики
+# строятся только по этим массивам - время и память отрисовки не зависят от числа
+# строк. matplotlib импортируется один раз при первой отрисовке, с бэкендом Agg
+# (без дисплея - для серверов обучения).
+
+_PYPLOT = None
+
+def _pyplot():
+    """matplotlib.pyplot с бэкендом без дисплея (импорт при первом вызове)"""
+    global _PYPLOT
+    if _PYPLOT is None:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        _PYPLOT = plt
+    return _PYPLOT
+
+def signed_log1p(values):
+    """log1p с сохранением знака: продажи с возвратами бывают отрицательными"""
+    values = np.asarray(values, dtype='float64')
+    return np.sign(values) * np.log1p(np.abs(values))
+
+def prediction_histogram(actual, predicted, bins=100):
+    """
+    Двумерная гистограмма (факт, прогноз) в шкале signed_log1p с общими границами по осям.
+    Возвращает словарь counts (bins x bins), edges, rows
+    """
+    x, y = signed_log1p(actual), signed_log1p(predicted)
+    finite = np.isfinite(x) & np.isfinite(y)
+    x, y = x[finite], y[finite]
+    if not len(x):
+        return {'counts': np.zeros((bins, bins), dtype='int64'), 'edges': np.linspace(0, 1, bins + 1), 'rows': 0}
+    low, high = min(x.min(), y.min()), max(x.max(), y.max())
+    if high <= low:
+        high = low + 1
+    edges = np.linspace(low, high, bins + 1)
+    counts, _, _ = np.histogram2d(x, y, bins=[edges, edges])
+    return {'counts': counts.astype('int64'), 'edges': edges, 'rows': int(len(x))}
+
+def segment_errors(actual, predicted, segments):
+    """
+    Ошибки по сегментам одним проходом bincount на сегмент.
+    segments: {имя: значения сегмента по строкам}; возвращает {имя: DataFrame (Строк, RMSE, MAE, MAPD, Смещение)}
+    """
+    actual = np.asarray(actual, dtype='float64')
+    predicted = np.asarray(predicted, dtype='float64')
+    error = predicted - actual
+    relative = np.abs(error / (actual + 1e-7)) * 100
+
+    result = {}
+    for name, values in segments.items():
+        codes, labels = pd.factorize(pd.Series(values).reset_index(drop=True), sort=True)
+        valid = codes >= 0
+        codes, n = codes[valid], len(labels)
+        rows = np.bincount(codes, minlength=n)
+        with np.errstate(all='ignore'):
+            table = pd.DataFrame({
+                'Строк': rows,
+                'RMSE': np.sqrt(np.bincount(codes, weights=error[valid] ** 2, minlength=n) / rows),
+                'MAE': np.bincount(codes, weights=np.abs(error[valid]), minlength=n) / rows,
+                'MAPD': np.bincount(codes, weights=relative[valid], minlength=n) / rows,
+                'Смещение': np.bincount(codes, weights=error[valid], minlength=n) / rows,
+            }, index=pd.Index(labels, name=name))
+        result[name] = table
+    return result
+
+def plot_prediction_histogram(histogram, path='prediction_vs_actual.png'):
+    """Тепловая карта двумерной гистограммы (логарифм числа строк) и диагональ идеального прогноза"""
+    plt = _pyplot()
+    edges = histogram['edges']
+    counts = np.ma.masked_equal(histogram['counts'].T, 0)
+    fig, ax = plt.subplots(figsize=(10, 8))
+    mesh = ax.pcolormesh(edges, edges, np.ma.log10(counts), cmap='viridis', shading='flat')
+    fig.colorbar(mesh, ax=ax, label='log10(число строк)')
+    ax.plot([edges[0], edges[-1]], [edges[0], edges[-1]], 'r--', linewidth=1)
+    ax.set_xlabel('Фактические продажи, sign·log1p')
+    ax.set_ylabel('Предсказанные продажи, sign·log1p')
+    ax.set_title(f"Предсказанные vs Фактические продажи ({histogram['rows']} строк)")
+    fig.savefig(path, dpi=100, bbox_inches='tight')
+    plt.close(fig)
+    return path
+
+def plot_segment_errors(errors, path='segment_errors.png', metric='MAE', top=30):
+    """Столбцы ошибки metric по сегментам (не более top значений на сегмент - с наибольшей ошибкой)"""
+    plt = _pyplot()
+    fig, axes = plt.subplots(len(errors), 1, figsize=(12, 3.5 * len(errors)), squeeze=False)
+    for ax, (name, table) in zip(axes[:, 0], errors.items()):
+        if len(table) > top:
+            table = table.nlargest(top, metric)
+        ax.bar([str(label) for label in table.index], table[metric].to_numpy())
+        ax.set_title(f'{metric} по сегменту {name}')
+        ax.tick_params(axis='x', labelrotation=90 if len(table) > 12 else 0)
+    fig.tight_layout()
+    fig.savefig(path, dpi=100)
+    plt.close(fig)
+    return path
+
+def plot_feature_importance(importance, path='feature_importance.png', top=20):
+    """Горизонтальные столбцы top важнейших признаков (Series: признак -> важность)"""
+    plt = _pyplot()
+    fig, ax = plt.subplots(figsize=(12, 10))
+    importance.head(top).sort_values().plot(kind='barh', ax=ax)
+    ax.set_title(f'Топ-{top} важных признаков')
+    fig.savefig(path, dpi=100, bbox_inches='tight')
+    plt.close(fig)
+    return path
+
+def prediction_diagnostics(actual, predicted, segments=None, bins=100, histogram_path='prediction_vs_actual.png',
+                           segments_path='segment_errors.png'):
+    """Агрегаты (гистограмма и ошибки по сегментам) и графики по ним; возвращает агрегаты"""
+    histogram = prediction_histogram(actual, predicted, bins)
+    errors = segment_errors(actual, predicted, segments or {})
+    plot_prediction_histogram(histogram, histogram_path)
+    if errors:
+        plot_segment_errors(errors, segments_path)
+    return {'histogram': histogram, 'segments': errors}
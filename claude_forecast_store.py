@@ -0,0 +1,331 @@
+import os
+import re
+import shutil
+import sqlite3
+import joblib
+import pandas as pd
+
+# ================================================
+# Хранилище прогнозов с индексом
+# ================================================
+# Вместо одного future_sales_forecast.csv на весь горизонт x SKU x магазины прогноз
+# пишется частями по мере готовности: каждая часть делится по магазинам и
+# сохраняется колоночным файлом (словарь массивов joblib) в каталоге
+#   forecast_store/run_date=<дата>/run=<запуск>/store=<магазин>/part-<n>.pkl
+# а локальный индекс SQLite хранит для каждого (запуск, Магазин, SKU, Дата) файл
+# части и номер строки. Поиск по магазину, SKU и диапазону дат читает из индекса
+# только нужные строки и загружает только их части. Старые запуски удаляются по
+# правилам хранения, части оставшихся объединяются в один файл на магазин.
+# Каждая часть помнит последний день данных, по которым построен прогноз (день
+# перед началом горизонта), и версию моделей (artifact_version): поиск с этими
+# фильтрами не отдаст прогноз по устаревшим данным или другим моделям. Без run_id
+# для каждого магазина берется последний завершенный запуск, где он есть, - так
+# запуски шардов с разных машин читаются как один прогноз.
+
+FORECAST_STORE_DIR = 'forecast_store'
+FORECAST_COLUMNS = ['Дата', 'SKU', 'Магазин', 'Прогноз_продаж']
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY, run_date TEXT, created_at TEXT, status TEXT, rows INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS parts (
+    part_id INTEGER PRIMARY KEY AUTOINCREMENT, run_id TEXT, store TEXT, path TEXT, rows INTEGER,
+    data_end TEXT, model_version TEXT
+);
+CREATE TABLE IF NOT EXISTS forecast_index (
+    run_id TEXT, store TEXT, sku TEXT, date TEXT, part_id INTEGER, row INTEGER,
+    PRIMARY KEY (run_id, store, sku, date)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS forecast_index_sku ON forecast_index (run_id, sku, date);
+CREATE INDEX IF NOT EXISTS parts_run ON parts (run_id, store);
+"""
+
+# Колонки, добавленные к таблицам хранилищ прежних версий
+_MIGRATIONS = {'parts': [('data_end', 'TEXT'), ('model_version', 'TEXT')]}
+
+def _part_columns(connection):
+    return {row[1] for row in connection.execute('PRAGMA table_info(parts)')}
+
+def open_forecast_store(root=FORECAST_STORE_DIR, read_only=False):
+    """
+    Хранилище: каталог частей и соединение с индексом root/index.sqlite.
+    read_only: только чтение - каталог и индекс не создаются; None, если хранилища нет
+    (или оно записано до версий частей и не годится для поиска с фильтрами)
+    """
+    path = os.path.join(root, 'index.sqlite')
+    if read_only:
+        if not os.path.exists(path):
+            return None
+        connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        if not {'data_end', 'model_version'} <= _part_columns(connection):
+            connection.close()
+            return None
+        return {'root': root, 'db': connection}
+
+    os.makedirs(root, exist_ok=True)
+    connection = sqlite3.connect(path)
+    connection.executescript(_SCHEMA)
+    for table, columns in _MIGRATIONS.items():
+        existing = _part_columns(connection)
+        for column, column_type in columns:
+            if column not in existing:
+                connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+    connection.commit()
+    return {'root': root, 'db': connection}
+
+def close_forecast_store(forecast_store):
+    forecast_store['db'].close()
+
+def _safe_name(value):
+    return re.sub(r'[^\w.-]', '_', str(value))
+
+def _run_dir(forecast_store, run_id):
+    run_date = forecast_store['db'].execute('SELECT run_date FROM runs WHERE run_id = ?', (run_id,)).fetchone()[0]
+    return os.path.join(forecast_store['root'], f'run_date={run_date}', f'run={run_id}')
+
+def begin_forecast_run(forecast_store, run_date=None, run_id=None):
+    """
+    Новый запуск (статус 'writing'); run_date - дата формирования прогноза (по умолчанию сегодня).
+    run_id: общий идентификатор запуска для нескольких машин (шарды) - если запуск уже есть,
+    запись продолжается в него, а уже записанные магазины остаются доступны
+    """
+    now = pd.Timestamp.now()
+    run_date = pd.Timestamp(run_date or now).strftime('%Y-%m-%d')
+    run_id = run_id or now.strftime('%Y%m%dT%H%M%S%f')
+    with forecast_store['db']:
+        forecast_store['db'].execute(
+            'INSERT OR IGNORE INTO runs (run_id, run_date, created_at, status) VALUES (?, ?, ?, ?)',
+            (run_id, run_date, now.isoformat(timespec='seconds'), 'writing')
+        )
+        forecast_store['db'].execute(
+            'UPDATE runs SET created_at = ? WHERE run_id = ?', (now.isoformat(timespec='seconds'), run_id)
+        )
+    print(f"DEBUG: Хранилище прогнозов: запуск {run_id} ({run_date})")
+    return run_id
+
+def _write_part(forecast_store, run_id, store_id, frame, data_end=None, model_version=None):
+    """Колоночный файл части одного магазина и строки индекса; возвращает part_id"""
+    db = forecast_store['db']
+    frame = frame.sort_values(['SKU', 'Дата'], kind='stable')
+    cursor = db.execute(
+        'INSERT INTO parts (run_id, store, path, rows, data_end, model_version) VALUES (?, ?, ?, ?, ?, ?)',
+        (run_id, str(store_id), '', len(frame), data_end, model_version)
+    )
+    part_id = cursor.lastrowid
+    directory = os.path.join(_run_dir(forecast_store, run_id), f'store={_safe_name(store_id)}')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'part-{part_id:06d}.pkl')
+    joblib.dump({col: frame[col].to_numpy() for col in FORECAST_COLUMNS}, path)
+    db.execute('UPDATE parts SET path = ? WHERE part_id = ?', (os.path.relpath(path, forecast_store['root']), part_id))
+
+    # Повтор ключа в более поздней части заменяет прежнюю строку индекса
+    db.executemany(
+        'INSERT OR REPLACE INTO forecast_index (run_id, store, sku, date, part_id, row) VALUES (?, ?, ?, ?, ?, ?)',
+        zip([run_id] * len(frame), [str(store_id)] * len(frame), frame['SKU'].astype(str),
+            frame['Дата'].dt.strftime('%Y-%m-%d'), [part_id] * len(frame), range(len(frame)))
+    )
+    return part_id
+
+def forecast_data_end(forecast):
+    """Последний день данных прогноза: горизонт начинается со следующего дня"""
+    return (pd.to_datetime(forecast['Дата']).min() - pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+
+def write_forecast_batch(forecast_store, run_id, forecast, model_version=None):
+    """
+    Потоковая запись части прогноза (например, готового шарда): по файлу на магазин + индекс.
+    model_version: версия моделей прогноза (artifact_version); день данных берется из горизонта
+    """
+    forecast = forecast[FORECAST_COLUMNS].copy()
+    forecast['Дата'] = pd.to_datetime(forecast['Дата'])
+    if forecast.empty:
+        return
+    data_end = forecast_data_end(forecast)
+    with forecast_store['db']:
+        for store_id, frame in forecast.groupby('Магазин', observed=True, sort=True):
+            _write_part(forecast_store, run_id, store_id, frame, data_end, model_version)
+        forecast_store['db'].execute('UPDATE runs SET rows = rows + ? WHERE run_id = ?', (len(forecast), run_id))
+    print(f"DEBUG: Хранилище прогнозов: записано {len(forecast)} строк в запуск {run_id}")
+
+def finish_forecast_run(forecast_store, run_id):
+    """Запуск полностью записан - доступен для чтения по умолчанию"""
+    with forecast_store['db']:
+        forecast_store['db'].execute("UPDATE runs SET status = 'complete' WHERE run_id = ?", (run_id,))
+
+def _version_conditions(data_end, model_version, alias='p'):
+    conditions, params = [], []
+    if data_end is not None:
+        conditions.append(f'{alias}.data_end = ?')
+        params.append(pd.Timestamp(data_end).strftime('%Y-%m-%d'))
+    if model_version is not None:
+        conditions.append(f'{alias}.model_version = ?')
+        params.append(str(model_version))
+    return conditions, params
+
+def latest_forecast_run(forecast_store, store_id=None, data_end=None, model_version=None):
+    """
+    Последний завершенный запуск (None - нет). store_id - только запуски с этим магазином;
+    data_end / model_version - только части по этим данным и моделям
+    """
+    conditions, params = _version_conditions(data_end, model_version)
+    if store_id is not None:
+        conditions.append('p.store = ?')
+        params.append(str(store_id))
+    row = forecast_store['db'].execute(
+        "SELECT r.run_id FROM runs AS r WHERE r.status = 'complete' AND EXISTS "
+        f"(SELECT 1 FROM parts AS p WHERE {' AND '.join(['p.run_id = r.run_id'] + conditions)}) "
+        "ORDER BY r.created_at DESC, r.run_id DESC LIMIT 1", params
+    ).fetchone()
+    return row[0] if row else None
+
+def latest_store_runs(forecast_store, data_end=None, model_version=None):
+    """{магазин: последний завершенный запуск с этим магазином} - объединение запусков шардов"""
+    conditions, params = _version_conditions(data_end, model_version)
+    conditions = ["r.status = 'complete'"] + conditions
+    # Запуски по возрастанию: для магазина в словаре остается последний
+    rows = forecast_store['db'].execute(
+        "SELECT p.store, r.run_id FROM parts AS p JOIN runs AS r ON r.run_id = p.run_id "
+        f"WHERE {' AND '.join(conditions)} GROUP BY p.store, r.run_id ORDER BY r.created_at, r.run_id", params
+    ).fetchall()
+    return dict(rows)
+
+_INDEX_QUERY = """
+SELECT i.part_id, i.row, p.path FROM forecast_index AS i JOIN parts AS p ON p.part_id = i.part_id WHERE {}
+"""
+
+def _gather(forecast_store, conditions, params):
+    """Строки прогноза по индексу: каждая нужная часть загружается один раз"""
+    index_rows = forecast_store['db'].execute(_INDEX_QUERY.format(' AND '.join(conditions)), params).fetchall()
+    if not index_rows:
+        return pd.DataFrame(columns=FORECAST_COLUMNS)
+    frames = []
+    for (part_id, path), part_rows in pd.DataFrame(index_rows, columns=['part_id', 'row', 'path']).groupby(
+            ['part_id', 'path'], sort=True):
+        columns = joblib.load(os.path.join(forecast_store['root'], path))
+        positions = part_rows['row'].to_numpy()
+        frames.append(pd.DataFrame({col: columns[col][positions] for col in FORECAST_COLUMNS}))
+    return pd.concat(frames, ignore_index=True).sort_values(['Магазин', 'SKU', 'Дата'], ignore_index=True)
+
+def lookup_forecast(forecast_store, store_id=None, sku=None, start=None, end=None, run_id=None, data_end=None,
+                    model_version=None):
+    """
+    Точечный или диапазонный поиск без загрузки всего запуска.
+    store_id / sku / [start, end] - любые сочетания; run_id - по умолчанию для каждого магазина
+    последний завершенный запуск с ним; data_end / model_version - только прогноз по этим данным и моделям
+    """
+    if run_id is None and store_id is None:
+        runs = {}
+        for store, store_run in latest_store_runs(forecast_store, data_end, model_version).items():
+            runs.setdefault(store_run, []).append(store)
+        frames = [
+            _lookup_run(forecast_store, store_run, stores, sku, start, end, data_end, model_version)
+            for store_run, stores in runs.items()
+        ]
+        frames = [frame for frame in frames if len(frame)]
+        if not frames:
+            return pd.DataFrame(columns=FORECAST_COLUMNS)
+        return pd.concat(frames, ignore_index=True).sort_values(['Магазин', 'SKU', 'Дата'], ignore_index=True)
+
+    run_id = run_id or latest_forecast_run(forecast_store, store_id, data_end, model_version)
+    if run_id is None:
+        return pd.DataFrame(columns=FORECAST_COLUMNS)
+    stores = None if store_id is None else [store_id]
+    return _lookup_run(forecast_store, run_id, stores, sku, start, end, data_end, model_version)
+
+def _lookup_run(forecast_store, run_id, stores, sku, start, end, data_end, model_version):
+    """Строки одного запуска по фильтрам lookup_forecast (stores - список магазинов или None)"""
+    conditions, params = _version_conditions(data_end, model_version)
+    conditions, params = ['i.run_id = ?'] + conditions, [run_id] + params
+    if stores is not None:
+        conditions.append(f"i.store IN ({', '.join('?' * len(stores))})")
+        params.extend(str(store) for store in stores)
+    if sku is not None:
+        conditions.append('i.sku = ?')
+        params.append(str(sku))
+    if start is not None:
+        conditions.append('i.date >= ?')
+        params.append(pd.Timestamp(start).strftime('%Y-%m-%d'))
+    if end is not None:
+        conditions.append('i.date <= ?')
+        params.append(pd.Timestamp(end).strftime('%Y-%m-%d'))
+    return _gather(forecast_store, conditions, params)
+
+def load_forecast_run(forecast_store, run_id=None):
+    """Весь запуск (например, для выгрузки в CSV)"""
+    return lookup_forecast(forecast_store, run_id=run_id)
+
+def save_forecast(forecast, root=FORECAST_STORE_DIR, run_date=None, stores_per_batch=50, model_version=None):
+    """
+    Сохранение готового прогноза одним запуском (частями по stores_per_batch магазинов).
+    model_version: версия моделей прогноза (ensemble_results['artifact_version'])
+    """
+    forecast_store = open_forecast_store(root)
+    try:
+        run_id = begin_forecast_run(forecast_store, run_date)
+        stores = forecast['Магазин'].drop_duplicates().tolist()
+        for begin in range(0, len(stores), stores_per_batch):
+            batch = forecast[forecast['Магазин'].isin(stores[begin:begin + stores_per_batch])]
+            write_forecast_batch(forecast_store, run_id, batch, model_version)
+        finish_forecast_run(forecast_store, run_id)
+    finally:
+        close_forecast_store(forecast_store)
+    return run_id
+
+def _delete_run(forecast_store, run_id):
+    directory = _run_dir(forecast_store, run_id)
+    with forecast_store['db']:
+        for table in ['forecast_index', 'parts', 'runs']:
+            forecast_store['db'].execute(f'DELETE FROM {table} WHERE run_id = ?', (run_id,))
+    shutil.rmtree(directory, ignore_errors=True)
+    print(f"DEBUG: Хранилище прогнозов: удален запуск {run_id}")
+
+def _compact_run(forecast_store, run_id):
+    """
+    Объединение частей каждого магазина запуска в одну (актуальные по индексу строки).
+    Части с разными днем данных или версией моделей не объединяются
+    """
+    db = forecast_store['db']
+    groups = db.execute(
+        'SELECT store, data_end, model_version FROM parts WHERE run_id = ? '
+        'GROUP BY store, data_end, model_version HAVING COUNT(*) > 1', (run_id,)
+    ).fetchall()
+    for store_id, data_end, model_version in groups:
+        group = 'run_id = ? AND store = ? AND data_end IS ? AND model_version IS ?'
+        params = [run_id, store_id, data_end, model_version]
+        old_parts = db.execute(f'SELECT part_id, path FROM parts WHERE {group}', params).fetchall()
+        frame = _gather(forecast_store, ['i.run_id = ?', 'i.store = ?', 'p.data_end IS ?', 'p.model_version IS ?'],
+                        params)
+        with db:
+            db.executemany('DELETE FROM forecast_index WHERE part_id = ?', [(part_id,) for part_id, _ in old_parts])
+            db.executemany('DELETE FROM parts WHERE part_id = ?', [(part_id,) for part_id, _ in old_parts])
+            _write_part(forecast_store, run_id, store_id, frame, data_end, model_version)
+        for _, path in old_parts:
+            os.remove(os.path.join(forecast_store['root'], path))
+    return len(groups)
+
+def compact_forecast_store(root=FORECAST_STORE_DIR, keep_runs=7, keep_days=None, stale_hours=24):
+    """
+    Правила хранения: остаются keep_runs последних завершенных запусков (и не старше keep_days дней);
+    незавершенные запуски старше stale_hours часов удаляются. Части оставшихся запусков объединяются
+    """
+    forecast_store = open_forecast_store(root)
+    try:
+        db, now = forecast_store['db'], pd.Timestamp.now()
+        runs = pd.read_sql_query('SELECT run_id, run_date, created_at, status FROM runs', db)
+        runs['created_at'] = pd.to_datetime(runs['created_at'])
+        complete = runs[runs['status'] == 'complete'].sort_values(['created_at', 'run_id'], ascending=False)
+
+        expired = set(complete['run_id'].iloc[keep_runs:])
+        if keep_days is not None:
+            expired |= set(complete.loc[pd.to_datetime(complete['run_date']) < now.normalize() - pd.Timedelta(days=keep_days),
+                                        'run_id'])
+        stale = runs[(runs['status'] != 'complete') & (runs['created_at'] < now - pd.Timedelta(hours=stale_hours))]
+        for run_id in sorted(expired | set(stale['run_id'])):
+            _delete_run(forecast_store, run_id)
+
+        compacted = sum(_compact_run(forecast_store, run_id) for run_id in complete['run_id'] if run_id not in expired)
+        db.execute('VACUUM')
+        print(f"DEBUG: Хранилище прогнозов: удалено запусков {len(expired) + len(stale)}, "
+              f"объединено магазинов {compacted}")
+    finally:
+        close_forecast_store(forecast_store)
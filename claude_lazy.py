@@ -0,0 +1,342 @@
+import math
+import numpy as np
+import pandas as pd
+import polars as pl
+from sklearn.preprocessing import PowerTransformer
+from claude_promo_calendar import build_promotion_calendar, promotion_lookup, count_active_promotions
+from claude_rolling import rolling_distinct_count
+
+# ================================================
+# Ленивый (Polars LazyFrame) план инженерии признаков
+# ================================================
+# Те же этапы, что в claude.feature_engineering, записаны выражениями одного
+# ленивого запроса. Оптимизатор Polars объединяет одинаковые подвыражения
+# (групповые средние/суммы по одним ключам считаются один раз), вспомогательные
+# величины (медианы для заполнения лагов, квантили групп, ранги магазинов) не
+# становятся колонками, а запрос выполняется многопоточно. Результат - pandas
+# DataFrame с теми же колонками, типами, порядком строк и индексом, что у pandas-пути.
+# Модуль необязательный: импортируется только при engine='polars'.
+
+c = pl.col
+
+SERIES_KEYS = ['SKU', 'Магазин']
+CROSS_FEATURES = ['SKU_Магазин', 'День_недели_Весовой', 'Акция_Весовой', 'Выходной_Акция']
+TARGET_ENCODED = ['SKU', 'Магазин', 'Тип_акции', 'День_недели', 'Месяц', 'Весовой']
+
+def _float(expr):
+    return expr.cast(pl.Float32)
+
+def _fill(expr, value):
+    """fillna pandas: пропуски и NaN (бесконечности остаются)"""
+    return expr.fill_nan(value).fill_null(value)
+
+def _finite_or(expr, value):
+    """fillna(value).replace([inf, -inf], value)"""
+    return pl.when(expr.is_finite()).then(expr).otherwise(pl.lit(value, dtype=pl.Float64))
+
+def to_lazy_frame(df):
+    """pandas -> LazyFrame: NaN -> null, категории -> строки, коды SKU и исходный индекс - служебные колонки"""
+    columns = {'_index': df.index.to_numpy()}
+    for col in df.columns:
+        series = df[col]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            columns[col] = pl.Series(col, series.astype(str).to_numpy(dtype=object), dtype=pl.String)
+        elif series.dtype == object:
+            columns[col] = pl.Series(
+                col, series.map(lambda v: None if pd.isna(v) else str(v)).to_numpy(dtype=object), dtype=pl.String
+            )
+        elif series.dtype.kind == 'f':
+            columns[col] = pl.Series(col, series.to_numpy(), nan_to_null=True)
+        else:
+            columns[col] = pl.Series(col, series.to_numpy())
+    columns['_sku_code'] = pl.Series('_sku_code', df['SKU'].cat.codes.to_numpy() if
+                                     isinstance(df['SKU'].dtype, pd.CategoricalDtype) else df['SKU'].to_numpy())
+    return pl.DataFrame(columns).lazy()
+
+def to_pandas_frame(frame, sku_dtype):
+    """Результат запроса -> pandas с типами pandas-пути"""
+    data = {}
+    for col in frame.columns:
+        if col.startswith('_'):
+            continue
+        series = frame[col]
+        if col == 'SKU':
+            data[col] = pd.Categorical(series.to_numpy(), dtype=sku_dtype)
+        elif series.dtype == pl.String:
+            data[col] = series.to_numpy().astype(object)
+        else:
+            data[col] = series.to_numpy()
+    result = pd.DataFrame(data, index=frame['_index'].to_numpy())
+    for col in CROSS_FEATURES:
+        if col in result.columns:
+            result[col] = result[col].astype('category')
+    return result
+
+# ------------------------------------------------
+# Этапы плана (повторяют create_* из claude.py)
+# ------------------------------------------------
+def price_stage(lf):
+    price, full_price = c('Цена_со_скидкой'), c('Цена_без_скидки')
+    lf = lf.with_columns(
+        _float(_fill(1 - price / pl.when(full_price != 0).then(full_price.cast(pl.Float64)), 0).clip(0, 1))
+        .alias('Скидка_фактическая'),
+        (price < full_price).cast(pl.Int8).alias('Была_ли_скидка'),
+    )
+    filled = price.forward_fill()
+    return lf.with_columns(
+        _float(_fill(price / price.mean().over('SKU'), 1)).alias('Цена_относительно_среднего'),
+        _float(_fill((filled / filled.shift(1) - 1).over(SERIES_KEYS), 0)).alias('Цена_изменение'),
+        _float(price - price.mean().over(['Магазин', 'Дата'])).alias('Цена_отклонение_от_магазина'),
+    )
+
+def time_stage(lf):
+    date = c('Дата')
+    lf = lf.with_columns(
+        (date.dt.weekday() - 1).cast(pl.Int8).alias('День_недели'),
+        date.dt.month().cast(pl.Int8).alias('Месяц'),
+        date.dt.year().cast(pl.Int16).alias('Год'),
+    )
+    lf = lf.with_columns(
+        (c('День_недели') >= 5).cast(pl.Int8).alias('Выходной'),
+        (date - date.min()).dt.total_days().cast(pl.Int32).alias('Дни_с_начала'),
+        date.dt.ordinal_day().cast(pl.Int16).alias('День_года'),
+        date.dt.week().cast(pl.Int8).alias('Неделя_года'),
+        date.dt.quarter().cast(pl.Int8).alias('Квартал'),
+    )
+    cycles = [('День', 'День_года', 365), ('Неделя', 'День_недели', 7), ('Месяц', 'Месяц', 12)]
+    lf = lf.with_columns([
+        _float(getattr((2 * math.pi * c(source) / period), func)()).alias(f'{name}_{suffix}')
+        for suffix, source, period in cycles
+        for name, func in [('Sin', 'sin'), ('Cos', 'cos')]
+    ])
+    lf = lf.with_columns(date.dt.day().cast(pl.Int8).alias('День_месяца'))
+    day = c('День_месяца')
+    return lf.with_columns(
+        (day <= 5).cast(pl.Int8).alias('Начало_месяца'),
+        (day >= 25).cast(pl.Int8).alias('Конец_месяца'),
+        (((day >= 14) & (day <= 16)) | ((day >= 29) | (day <= 1))).cast(pl.Int8).alias('Зарплатный_день'),
+    )
+
+def _calendar_columns(calendar, by_store, days=30):
+    """Тип акции, уценка и число акций за days дней - поиском по календарю акций, как в pandas-пути"""
+    def lookup(batch):
+        frame = batch.struct.unnest()
+        dates = frame['Дата'].to_numpy()
+        stores = frame['Магазин'].to_numpy() if by_store else None
+        promo = promotion_lookup(calendar, frame['Номер_акции'].to_numpy(), dates, stores)
+        return pl.DataFrame({
+            'Тип_акции_расширенный': pd.Series(promo['type']).fillna('Нет акции').astype(str).tolist(),
+            'Является_уценкой': np.nan_to_num(promo['clearance']).astype('int8'),
+            f'Акций_в_календаре_{days}д': count_active_promotions(calendar, dates, days, stores),
+        }).to_struct()
+    return_dtype = pl.Struct({
+        'Тип_акции_расширенный': pl.String, 'Является_уценкой': pl.Int8, f'Акций_в_календаре_{days}д': pl.Int16,
+    })
+    keys = ['Номер_акции', 'Дата'] + (['Магазин'] if by_store else [])
+    return pl.struct(keys).map_batches(lookup, return_dtype=return_dtype).alias('_calendar')
+
+def _distinct_promotions(days):
+    """Число различных активных акций товара за days дней - ядром claude_rolling, как в pandas-пути"""
+    def count(batch):
+        frame = batch.struct.unnest()
+        promo = frame['Номер_акции'].to_numpy().astype('float64')
+        promo[frame['Акция_активна'].to_numpy() != 1] = np.nan
+        return pl.Series(rolling_distinct_count(
+            frame['_sku_code'].to_numpy(), frame['Дата'].to_numpy(), promo, days
+        ).astype('int16'))
+    return pl.struct(['_sku_code', 'Дата', 'Номер_акции', 'Акция_активна']).map_batches(count, return_dtype=pl.Int16)
+
+def promotion_stage(lf, promotions_df):
+    calendar = build_promotion_calendar(promotions_df)
+    active = c('Акция_активна')
+    lf = lf.with_columns(_calendar_columns(calendar, 'Магазин' in promotions_df.columns)).unnest('_calendar')
+    lf = lf.with_columns(
+        active.sum().over(['Магазин', 'Дата']).cast(pl.Int16).alias('Кол_акций_в_магазине'),
+        _distinct_promotions(30).alias('Акций_за_30д_товар'),
+        _float(c('Скидка_фактическая').mean().over('SKU')).alias('Скидка_средняя_товар'),
+        # Сдвиг по всей таблице, а не внутри ряда - как в pandas-пути
+        active.cast(pl.Float64).rolling_max(7, min_samples=1).over(SERIES_KEYS).shift(1)
+        .fill_null(0).cast(pl.Int8).alias('Был_на_акции_7д'),
+        c('Чистые_продажи').mean().over(SERIES_KEYS + ['Акция_активна']).alias('Продажи_на_акции'),
+    )
+    promo_sales = c('Продажи_на_акции')
+    efficiency = promo_sales / pl.when(active == 0).then(promo_sales)
+    return lf.with_columns(_float(_finite_or(efficiency, 1)).alias('Эффективность_акции'))
+
+def _days_to_holiday(dates, holidays, after):
+    """Дней до ближайшего праздника (after=False) или после прошедшего (after=True); нет праздника - 999"""
+    if len(holidays) == 0:
+        return pl.lit(999, dtype=pl.Int16)
+    holidays = pl.Series(sorted(holidays), dtype=pl.Date)
+    if after:
+        position = pl.lit(holidays).search_sorted(dates, side='right') - 1
+        valid = position >= 0
+        nearest = pl.lit(holidays).gather(position.clip(lower_bound=0))
+        days = (dates - nearest).dt.total_days()
+    else:
+        position = pl.lit(holidays).search_sorted(dates, side='left')
+        valid = position < len(holidays)
+        nearest = pl.lit(holidays).gather(position.clip(upper_bound=len(holidays) - 1))
+        days = (nearest - dates).dt.total_days()
+    return pl.when(valid).then(days).otherwise(999).cast(pl.Int16)
+
+def holiday_stage(lf, holidays_df):
+    dates = c('Дата').cast(pl.Date)
+    holidays_set = set(holidays_df['Дата'].dt.date)
+    columns = [
+        _days_to_holiday(dates, holidays_set, after=False).alias('Дней_до_праздника'),
+        _days_to_holiday(dates, holidays_set, after=True).alias('Дней_после_праздника'),
+    ]
+    if 'Тип_праздника' in holidays_df.columns:
+        for h_type in holidays_df['Тип_праздника'].dropna().unique():
+            specific = set(holidays_df[holidays_df['Тип_праздника'] == h_type]['Дата'].dt.date)
+            columns.append(_days_to_holiday(dates, specific, after=False).alias(f'Дней_до_{h_type}'))
+    lf = lf.with_columns(columns)
+    return lf.with_columns(((c('Месяц') == 11) | (c('Месяц') == 12)).cast(pl.Int8).alias('Сезон_распродаж'))
+
+def volume_stage(lf, weight_groups):
+    sales, price = c('Чистые_продажи'), c('Цена_со_скидкой')
+    group = ['Весовой', 'Магазин']
+    lf = lf.with_columns(c('Весовой').cast(pl.Int8))
+    lf = lf.with_columns(_float(sales.mean().over(group)).alias('Среднее_по_весовой_группе'))
+    lf = lf.with_columns(_float(_fill(sales / c('Среднее_по_весовой_группе'), 1)).alias('Отношение_к_среднему_группы'))
+    produced = ['Среднее_по_весовой_группе', 'Отношение_к_среднему_группы']
+
+    for is_weighted in [0, 1]:
+        if is_weighted not in weight_groups:
+            continue
+        weight_type = 'весовой' if is_weighted else 'штучный'
+        in_group = c('Весовой') == is_weighted
+        q75 = sales.quantile(0.75, 'linear').over(group)
+        q25 = sales.quantile(0.25, 'linear').over(group)
+        spread = q75 - q25
+        quantile = _fill((sales - q25) / pl.when(spread == 0).then(1).otherwise(spread), 0.5).clip(0, 1)
+        lf = lf.with_columns(
+            pl.when(in_group).then(_float(price / price.mean().over(group))).alias(f'Цена_отн_средней_{weight_type}'),
+            pl.when(in_group).then(_float(quantile)).alias(f'Продажи_квантиль_{weight_type}'),
+        )
+        produced += [f'Цена_отн_средней_{weight_type}', f'Продажи_квантиль_{weight_type}']
+
+    # Пропуски только в колонках этапа - 0
+    return lf.with_columns(_fill(c(produced), 0).cast(pl.Float32))
+
+def store_stage(lf):
+    sales = c('Чистые_продажи')
+    daily_store_sales = sales.sum().over(['Магазин', 'Дата'])
+    store_ranks = (
+        lf.group_by('Магазин')
+        .agg(sales.mean().alias('_store_mean'))
+        .with_columns((c('_store_mean').rank('average') / pl.len()).cast(pl.Float32).alias('Ранг_магазина'))
+        .select('Магазин', 'Ранг_магазина')
+    )
+    lf = lf.with_columns(_float(daily_store_sales).alias('Активность_магазина'))
+    lf = lf.join(store_ranks, on='Магазин', how='left', maintain_order='left')
+    return lf.with_columns(
+        _float(_fill(sales / daily_store_sales, 0)).alias('Доля_в_магазине'),
+        _float(_finite_or(sales / sales.mean().over(['SKU', 'Дата']), 1)).alias('Продажи_относительно_среднего'),
+    )
+
+def time_series_stage(lf, lags, windows, target_col='Чистые_продажи'):
+    target = c(target_col)
+    sku_median = target.median().over('SKU')
+    lf = lf.with_columns([
+        _float(target.shift(lag).over(SERIES_KEYS).fill_null(sku_median)).alias(f'Lag_{lag}') for lag in lags
+    ])
+
+    # Как в create_rolling_vectorized: окна по отсортированным рядам
+    lf = lf.sort(['_sku_code', 'Магазин', 'Дата'], maintain_order=True)
+    rolling = []
+    for window in windows:
+        rolling += [
+            _float(target.rolling_mean(window, min_samples=1).over(SERIES_KEYS)).alias(f'MA_{window}'),
+            _float(target.rolling_median(window, min_samples=1).over(SERIES_KEYS)).alias(f'Median_{window}'),
+            _float(target.rolling_max(window, min_samples=1).over(SERIES_KEYS)).alias(f'Max_{window}'),
+            _float(target.rolling_min(window, min_samples=1).over(SERIES_KEYS)).alias(f'Min_{window}'),
+            _float(_fill(target.rolling_std(window, min_samples=1).over(SERIES_KEYS), 0)).alias(f'Std_{window}'),
+        ]
+    lf = lf.with_columns(rolling)
+
+    # Наклон МНК по последним 7 точкам ряда в закрытой форме (вместо polyfit в окне)
+    position = pl.int_range(pl.len()).over(SERIES_KEYS).cast(pl.Float64)
+    y = target.cast(pl.Float64)
+    k = pl.min_horizontal(position + 1, pl.lit(7.0))
+    start = position - k + 1
+    sum_y = y.rolling_sum(7, min_samples=1).over(SERIES_KEYS)
+    sum_iy = (position * y).rolling_sum(7, min_samples=1).over(SERIES_KEYS) - start * sum_y
+    sum_i = k * (k - 1) / 2
+    sum_ii = (k - 1) * k * (2 * k - 1) / 6
+    slope = (k * sum_iy - sum_i * sum_y) / (k * sum_ii - sum_i ** 2)
+    lf = lf.with_columns(
+        _float(c('Lag_1') - c('MA_7')).alias('Trend_1_7'),
+        _float(c('MA_7') - c('MA_30')).alias('Trend_7_30'),
+        _float(pl.when(k >= 3).then(slope).otherwise(0)).alias('Trend_slope_7'),
+    )
+    return lf.with_columns(
+        _float(c('Trend_slope_7').diff().over(SERIES_KEYS).fill_null(0)).alias('Acceleration_7'),
+        _float(_finite_or(target / target.shift(1).over(SERIES_KEYS + ['День_года']), 1)).alias('YoY_change'),
+    )
+
+def cross_stage(lf):
+    text = lambda name: c(name).cast(pl.String)
+    return lf.with_columns(
+        (text('SKU') + '_' + text('Магазин')).alias('SKU_Магазин'),
+        (text('День_недели') + '_' + text('Весовой')).alias('День_недели_Весовой'),
+        (text('Акция_активна') + '_' + text('Весовой')).alias('Акция_Весовой'),
+        (text('Выходной') + '_' + text('Акция_активна')).alias('Выходной_Акция'),
+    )
+
+def target_encoding_stage(lf, split_date, target_col='Чистые_продажи'):
+    columns = lf.collect_schema().names()
+    train = c('Дата') < split_date
+    train_target = pl.when(train).then(c(target_col))
+    return lf.with_columns([
+        _float(train_target.mean().over(feature)).fill_null(_float(train_target.mean())).alias(f'{feature}_target_mean')
+        for feature in TARGET_ENCODED if feature in columns
+    ])
+
+def target_stage(lf, target_col='Чистые_продажи'):
+    # Граница выбросов сохраняется: pandas оставляет float32 только если она точно представима в float32
+    target = c(target_col).cast(pl.Float64)
+    lf = lf.with_columns(target.quantile(0.995, 'linear').alias('_clip_upper'))
+    lf = lf.with_columns(target.clip(0, c('_clip_upper')))
+    return lf.with_columns(_float(c(target_col).log1p()).alias('log_Чистые_продажи'))
+
+def boxcox_target(df, target_col='Чистые_продажи'):
+    """Box-Cox для штучных товаров - eager-шаг после запроса (sklearn), как в transform_target_variable"""
+    try:
+        non_zero_mask = (df[target_col] > 0) & (df['Весовой'] == 0)
+        if non_zero_mask.sum() > 100:
+            pt = PowerTransformer(method='box-cox')
+            transformed = pt.fit_transform(df.loc[non_zero_mask, target_col].values.reshape(-1, 1))
+            df.loc[non_zero_mask, 'boxcox_Чистые_продажи'] = transformed.flatten()
+            df['boxcox_Чистые_продажи'] = df['boxcox_Чистые_продажи'].fillna(0).astype('float32')
+    except Exception as e:
+        print(f"Не удалось применить Box-Cox преобразование: {e}")
+        df['boxcox_Чистые_продажи'] = df['log_Чистые_продажи']
+    return df
+
+def feature_plan(sales_df, holidays_df, promotions_df, lags, windows):
+    """Ленивый план всех этапов feature_engineering"""
+    lf = to_lazy_frame(sales_df)
+    lf = price_stage(lf)
+    lf = time_stage(lf)
+    lf = promotion_stage(lf, promotions_df)
+    lf = holiday_stage(lf, holidays_df)
+    lf = volume_stage(lf, set(sales_df['Весовой'].unique()))
+    lf = store_stage(lf)
+    lf = time_series_stage(lf, lags, windows)
+    lf = cross_stage(lf)
+    lf = target_encoding_stage(lf, sales_df['Дата'].max() - pd.Timedelta(days=30))
+    return target_stage(lf)
+
+def lazy_feature_engineering(sales_df, holidays_df, promotions_df, lags, windows):
+    """Инженерия признаков одним многопоточным запросом Polars; результат совпадает с pandas-путем"""
+    print(f"DEBUG: Начало создания признаков (Polars, потоков: {pl.thread_pool_size()})")
+    frame = feature_plan(sales_df, holidays_df, promotions_df, lags, windows).collect()
+    df = to_pandas_frame(frame, sales_df['SKU'].dtype)
+    upper = frame['_clip_upper'][0] if len(frame) else 0.0
+    if sales_df['Чистые_продажи'].dtype == 'float32' and float(np.float32(upper)) == upper:
+        df['Чистые_продажи'] = df['Чистые_продажи'].astype('float32')
+    df = boxcox_target(df)
+    print("DEBUG: Завершение создания признаков. Размер DataFrame:", df.shape)
+    return df
@@ -0,0 +1,191 @@
+import warnings
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+# ================================================
+# Плотная панель рядов (ряд x календарный день)
+# ================================================
+# Каждый ряд (SKU, Магазин) - строка float32-матрицы по всем календарным дням
+# периода, дни без наблюдения отмечены в маске. Лаги - сдвиг по оси дней,
+# скользящие суммы/средние/std - через кумулятивные суммы, max/min/медиана -
+# через скользящее окно по блокам рядов, YoY - сдвиг ровно на 365 дней.
+# Все признаки считаются сразу по всем рядам и по календарю: пропущенный день
+# не сдвигает лаг и не расширяет окно. Результаты возвращаются в длинную таблицу
+# по индексам (ряд, день) ее строк.
+# Требуется одна строка на (SKU, Магазин, Дата) - дневное зерно (aggregate_daily_sales).
+
+PANEL_KEYS = ['SKU', 'Магазин']
+
+# Ограничение на размер временного массива окна (рядов x дней x окно) для max/min/медианы
+PANEL_WINDOW_CHUNK = 2 ** 25
+
+def build_series_panel(df, target_col='Чистые_продажи'):
+    """
+    Плотная панель целевой переменной.
+    Возвращает словарь: values (S x T float32, NaN без наблюдения), mask (S x T bool),
+    row_series/row_day - позиция каждой строки df в панели
+    """
+    row_series = df.groupby(PANEL_KEYS, observed=True, sort=False).ngroup().to_numpy()
+    start = df['Дата'].min()
+    row_day = (df['Дата'] - start).dt.days.to_numpy()
+    n_series, n_days = int(row_series.max()) + 1, int(row_day.max()) + 1
+
+    flat = row_series.astype('int64') * n_days + row_day
+    if len(np.unique(flat)) != len(flat):
+        raise ValueError("Для панели нужна одна строка на (SKU, Магазин, Дата) - сначала aggregate_daily_sales")
+
+    target = df[target_col].to_numpy(dtype='float32')
+    values = np.full((n_series, n_days), np.nan, dtype='float32')
+    values[row_series, row_day] = target
+    mask = ~np.isnan(values)
+
+    print(f"DEBUG: Панель рядов {n_series} x {n_days} дней, заполнено {mask.mean():.1%}")
+    return {
+        'values': values,
+        'mask': mask,
+        'row_series': row_series,
+        'row_day': row_day,
+        'start': start,
+    }
+
+def panel_shift(values, periods):
+    """Сдвиг по календарю: значение periods дней назад (NaN в начале ряда)"""
+    shifted = np.full_like(values, np.nan)
+    if periods < values.shape[1]:
+        shifted[:, periods:] = values[:, :values.shape[1] - periods]
+    return shifted
+
+def _window_sum(cumulative, window):
+    """Сумма за последние window дней (включая текущий) по кумулятивной сумме с нулевым столбцом"""
+    n_days = cumulative.shape[1] - 1
+    ends = np.arange(1, n_days + 1)
+    starts = np.maximum(ends - window, 0)
+    return cumulative[:, ends] - cumulative[:, starts]
+
+def _cumulative(values):
+    """Кумулятивная сумма по дням в float64 с ведущим нулевым столбцом"""
+    cumulative = np.zeros((values.shape[0], values.shape[1] + 1), dtype='float64')
+    np.cumsum(values, axis=1, out=cumulative[:, 1:])
+    return cumulative
+
+def panel_window_moments(panel, window):
+    """Число наблюдений, сумма и сумма квадратов за окно window дней"""
+    observed = np.where(panel['mask'], panel['values'], 0).astype('float64')
+    count = _window_sum(_cumulative(panel['mask'].astype('float64')), window)
+    total = _window_sum(_cumulative(observed), window)
+    total_sq = _window_sum(_cumulative(observed ** 2), window)
+    return count, total, total_sq
+
+def panel_window_reduce(values, window, reducer):
+    """max/min/медиана за окно window дней по блокам рядов (без учета дней без наблюдения)"""
+    n_series, n_days = values.shape
+    padded = np.concatenate([np.full((n_series, window - 1), np.nan, dtype=values.dtype), values], axis=1)
+    result = np.empty_like(values)
+    chunk = max(1, PANEL_WINDOW_CHUNK // max(n_days * window, 1))
+    with np.errstate(all='ignore'), warnings.catch_warnings():
+        # Окна без наблюдений дают NaN - предупреждения nanmax/nanmedian не нужны
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for begin in range(0, n_series, chunk):
+            view = sliding_window_view(padded[begin:begin + chunk], window, axis=1)
+            result[begin:begin + chunk] = reducer(view, axis=2)
+    return result
+
+def panel_rolling(panel, window, stats):
+    """Скользящие статистики окна window: {'MA': ..., 'Std': ..., 'Max': ..., 'Min': ..., 'Median': ...}"""
+    result = {}
+    if 'MA' in stats or 'Std' in stats:
+        count, total, total_sq = panel_window_moments(panel, window)
+        with np.errstate(all='ignore'):
+            if 'MA' in stats:
+                result['MA'] = np.where(count > 0, total / count, np.nan)
+            if 'Std' in stats:
+                # Несмещенная оценка, как в pandas; меньше двух наблюдений - 0
+                variance = (total_sq - total ** 2 / np.maximum(count, 1)) / np.maximum(count - 1, 1)
+                result['Std'] = np.where(count > 1, np.sqrt(np.maximum(variance, 0)), 0)
+    reducers = {'Max': np.nanmax, 'Min': np.nanmin, 'Median': np.nanmedian}
+    for stat, reducer in reducers.items():
+        if stat in stats:
+            result[stat] = panel_window_reduce(panel['values'], window, reducer)
+    return result
+
+def panel_trend_slope(panel, window=7, min_periods=3):
+    """Наклон МНК-прямой по наблюдениям за последние window дней (по календарным дням); иначе 0"""
+    mask = panel['mask']
+    days = np.broadcast_to(np.arange(mask.shape[1], dtype='float64'), mask.shape)
+    x = np.where(mask, days, 0)
+    y = np.where(mask, panel['values'], 0).astype('float64')
+    n = _window_sum(_cumulative(mask.astype('float64')), window)
+    sx = _window_sum(_cumulative(x), window)
+    sy = _window_sum(_cumulative(y), window)
+    sxy = _window_sum(_cumulative(x * y), window)
+    sxx = _window_sum(_cumulative(x * x), window)
+    with np.errstate(all='ignore'):
+        denominator = n * sxx - sx ** 2
+        slope = (n * sxy - sx * sy) / denominator
+    return np.where((n >= min_periods) & (denominator > 0), slope, 0)
+
+def panel_yoy(panel, days=365):
+    """Отношение к значению ровно days дней назад; без пары или при делении на 0 - 1"""
+    with np.errstate(all='ignore'):
+        ratio = panel['values'] / panel_shift(panel['values'], days)
+    return np.where(np.isfinite(ratio), ratio, 1)
+
+def scatter_to_rows(panel, matrix):
+    """Значения панели для строк длинной таблицы"""
+    return matrix[panel['row_series'], panel['row_day']].astype('float32')
+
+def panel_time_series_features(df, lags, windows, rolling_stats, rolling_columns=None, trends=None,
+                               target_col='Чистые_продажи'):
+    """
+    Лаги, скользящие статистики и тренды на панели с теми же именами колонок, что у
+    create_lags_vectorized / create_rolling_vectorized / compute_trends.
+    rolling_columns/trends: только перечисленные колонки (None - все)
+    """
+    print(f"DEBUG: Признаки временных рядов на панели: {len(lags)} лагов, {len(windows)} окон")
+    panel = build_series_panel(df, target_col)
+
+    # Лаги; пропуски - медианой по SKU, как в create_lags_vectorized
+    if lags:
+        sku_median = df.groupby('SKU', observed=True)[target_col].transform('median')
+        for lag in lags:
+            df[f'Lag_{lag}'] = pd.Series(
+                scatter_to_rows(panel, panel_shift(panel['values'], lag)), index=df.index
+            ).fillna(sku_median).astype('float32')
+
+    for window in windows:
+        stats = [stat for stat in rolling_stats if rolling_columns is None or f'{stat}_{window}' in rolling_columns]
+        for stat, matrix in panel_rolling(panel, window, stats).items():
+            df[f'{stat}_{window}'] = scatter_to_rows(panel, matrix)
+
+    def needed(name):
+        return trends is None or name in trends
+
+    if needed('Trend_1_7'):
+        df['Trend_1_7'] = (df['Lag_1'] - df['MA_7']).astype('float32')
+    if needed('Trend_7_30'):
+        df['Trend_7_30'] = (df['MA_7'] - df['MA_30']).astype('float32')
+    if needed('Trend_slope_7') or needed('Acceleration_7'):
+        slope = panel_trend_slope(panel, 7)
+        df['Trend_slope_7'] = scatter_to_rows(panel, slope)
+        if needed('Acceleration_7'):
+            acceleration = slope - np.nan_to_num(panel_shift(slope, 1))
+            acceleration[:, 0] = 0
+            df['Acceleration_7'] = scatter_to_rows(panel, acceleration)
+    if needed('YoY_change'):
+        df['YoY_change'] = scatter_to_rows(panel, panel_yoy(panel))
+
+    return df
+
+def panel_anomaly_stats(df, window=30, min_periods=5, target_col='Чистые_продажи'):
+    """Скользящие среднее и std за window календарных дней для anomaly_detection (NaN при < min_periods)"""
+    panel = build_series_panel(df, target_col)
+    count, total, total_sq = panel_window_moments(panel, window)
+    with np.errstate(all='ignore'):
+        mean = total / count
+        std = np.sqrt(np.maximum((total_sq - total ** 2 / count) / (count - 1), 0))
+    enough = count >= min_periods
+    return (
+        scatter_to_rows(panel, np.where(enough, mean, np.nan)),
+        scatter_to_rows(panel, np.where(enough, std, np.nan)),
+    )
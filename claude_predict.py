@@ -1,10 +1,11 @@
 import pandas as pd
 import numpy as np
 import joblib
-import lightgbm as lgb
-import xgboost as xgb
-import catboost as cb
+import os
 from datetime import datetime
+from claude_snapshot import load_state_snapshot, snapshot_features
+from claude_prediction_cache import normalize_inputs, cached_prediction, snapshot_version
+from claude import CATBOOST_UNKNOWN_CATEGORY
 
 # =======================
 # 1. Загрузка моделей и метаданных
@@ -13,30 +14,54 @@ def load_all_models_and_meta(prefix="retail_sales_"):
     """
     Загружает обученные модели, веса ансамбля, список признаков и список категориальных признаков.
     Все файлы должны быть созданы и сохранены при обучении!
+    Модель без файла или с нулевым весом не загружается (None) - ее библиотека не импортируется.
+    categories: словари категорий float32-блока (categories.pkl) - модели обучены на кодах категорий;
+    None - старый артефакт на pandas-категориях
     """
-    lgb_model = joblib.load(f"{prefix}lgb_model.pkl")
-    xgb_model = joblib.load(f"{prefix}xgb_model.pkl")
-    cb_model = joblib.load(f"{prefix}cb_model.pkl")
     ensemble_weights = joblib.load(f"{prefix}ensemble_weights.pkl")  # tuple/list (w_lgb, w_xgb, w_cb)
+    lgb_model, xgb_model, cb_model = [
+        joblib.load(f"{prefix}{name}_model.pkl") if weight and os.path.exists(f"{prefix}{name}_model.pkl") else None
+        for name, weight in zip(['lgb', 'xgb', 'cb'], ensemble_weights)
+    ]
     feature_list = joblib.load(f"{prefix}feature_list.pkl")  # Список фичей (колонки X_train)
     cat_features = joblib.load(f"{prefix}cat_features.pkl")  # Список категориальных признаков
-    return lgb_model, xgb_model, cb_model, ensemble_weights, feature_list, cat_features
+    # Словари категорий обучения {признак: categories}; у старых моделей файла нет
+    vocab_path = f"{prefix}category_vocab.pkl"
+    vocabularies = joblib.load(vocab_path) if os.path.exists(vocab_path) else None
+    categories_path = f"{prefix}categories.pkl"
+    categories = joblib.load(categories_path) if os.path.exists(categories_path) else None
+    return lgb_model, xgb_model, cb_model, ensemble_weights, feature_list, cat_features, vocabularies, categories
 
 # =======================
 # 2. Препроцессинг одного примера для предсказания
 # =======================
-def prepare_features_for_predict(user_input: dict, feature_list, cat_features, reference_df=None):
+def prepare_features_for_predict(user_input: dict, feature_list, cat_features, reference_df=None, vocabularies=None,
+                                 snapshot=None):
     """
     user_input: словарь {имя_признака: значение}, например {'SKU': '12345', 'Магазин': '1', 'Дата': '2025-05-10', ...}
     feature_list: список всех признаков, используемых в модели
     cat_features: список категориальных признаков (имена)
     reference_df: DataFrame с историей для генерации лагов и rolling (если нужно)
+    vocabularies: словари категорий обучения - коды совпадают с обучающими (неизвестное значение = NaN)
+    snapshot: снимок состояния рядов (load_state_snapshot) - лаги, окна, ранги и энкодинги ряда
+    вместо нулей; значения user_input имеют приоритет
     """
+    if snapshot is not None:
+        user_input = snapshot_features(snapshot, user_input)
     df = pd.DataFrame([user_input]).copy()
+    # Отсутствующие категориальные признаки - пропуск (тип category должен совпадать с обучением)
+    for col in cat_features:
+        if col in feature_list and col not in df.columns:
+            df[col] = None
     # Приведение типов
     for col in cat_features:
         if col in df.columns:
-            df[col] = df[col].astype("category")
+            if vocabularies and col in vocabularies:
+                vocab = pd.Index(vocabularies[col])
+                values = df[col].astype(str) if vocab.dtype == object else df[col].astype(vocab.dtype)
+                df[col] = pd.Categorical(values, categories=vocab)
+            else:
+                df[col] = df[col].astype("category")
     # Если даты есть в признаках — преобразуем
     if 'Дата' in df.columns:
         df['Дата'] = pd.to_datetime(df['Дата'])
@@ -51,6 +76,7 @@ def prepare_features_for_predict(user_input: dict, feature_list, cat_features, r
 def encode_cats_for_xgb(df, cat_features):
     """
     Для XGBoost: категориальные признаки кодируем в int.
+    Коды совпадают с обучающими, только если категории заданы словарями обучения (vocabularies).
     """
     df = df.copy()
     for col in cat_features:
@@ -58,6 +84,50 @@ def encode_cats_for_xgb(df, cat_features):
             df[col] = df[col].astype('category').cat.codes
     return df
 
+def block_frame_for_predict(df, categories):
+    """
+    Для моделей на float32-блоке (categories.pkl): коды категорий по словарям блока
+    (значение вне словаря = NaN), все признаки float32 - как при обучении.
+    """
+    df = df.copy()
+    for col, vocab in categories.items():
+        if col in df.columns:
+            codes = pd.Categorical(df[col], categories=vocab).codes.astype('float32')
+            codes[codes < 0] = np.nan
+            df[col] = codes
+    return df.astype('float32')
+
+def xgb_dmatrix_for_predict(X, xgb_model, cat_features, categories=None):
+    """
+    DMatrix для XGBoost: модель на нативных категориях (типы 'c' в бустере) получает категории
+    как есть, модель на кодах - коды категорий. categories: X - float32-блок (коды уже в X)
+    """
+    import xgboost as xgb
+    if 'c' in (xgb_model.feature_types or []):
+        if categories:
+            feature_types = ['c' if col in categories else 'q' for col in X.columns]
+            return xgb.DMatrix(X, enable_categorical=True, feature_types=feature_types)
+        return xgb.DMatrix(X, enable_categorical=True)
+    return xgb.DMatrix(encode_cats_for_xgb(X, cat_features))
+
+def catboost_frame_for_predict(df, cat_features, categories=None):
+    """
+    Для CatBoost: модель на float32-блоке (categories) обучена на int32-кодах категорий
+    (значение вне словаря -> -1, как claude.to_catboost_frame); старые артефакты - строки
+    (пропуск или значение вне словаря обучения -> CATBOOST_UNKNOWN_CATEGORY, как при обучении;
+    CatBoost не принимает NaN в категориальных признаках).
+    """
+    df = df.copy()
+    if categories:
+        for col in categories:
+            if col in df.columns:
+                df[col] = np.nan_to_num(df[col].to_numpy(), nan=-1).astype('int32')
+        return df
+    for col in cat_features:
+        if col in df.columns:
+            df[col] = df[col].astype(object).where(df[col].notna(), CATBOOST_UNKNOWN_CATEGORY).astype(str)
+    return df
+
 def inverse_target_transform(y_pred):
     """
     Обратное логарифмическое преобразование для целевой переменной, если использовалось log1p.
@@ -67,33 +137,44 @@ def inverse_target_transform(y_pred):
 # =======================
 # 3. Функция предсказания
 # =======================
-def predict_sales(user_input: dict, lgb_model, xgb_model, cb_model, ensemble_weights, feature_list, cat_features):
+def predict_sales(user_input: dict, lgb_model, xgb_model, cb_model, ensemble_weights, feature_list, cat_features,
+                  vocabularies=None, categories=None, snapshot=None, prediction_cache=None, model_version=None):
     """
     Выполняет предсказание продаж для одного примера по всем моделям и ансамблю.
     user_input: словарь с фичами
+    vocabularies: словари категорий обучения (category_vocab.pkl)
+    categories: словари float32-блока (categories.pkl) - модели получают коды категорий, как при обучении
+    snapshot: снимок состояния рядов (retail_sales_state_snapshot) - признаки по истории ряда
+    prediction_cache: кэш прогнозов (claude_prediction_cache); model_version - версия артефакта
+    (artifact_version), без нее кэш не используется; снимок входит в ключ своей версией (snapshot_version)
     """
+    if prediction_cache is not None:
+        return cached_prediction(
+            prediction_cache, 'predict_sales', model_version, snapshot_version(snapshot), normalize_inputs(user_input),
+            lambda: predict_sales(
+                user_input, lgb_model, xgb_model, cb_model, ensemble_weights, feature_list, cat_features,
+                vocabularies, categories, snapshot
+            )
+        )
     # Преобразуем вход к DataFrame
-    X = prepare_features_for_predict(user_input, feature_list, cat_features)
-    # LightGBM
-    lgb_pred = lgb_model.predict(X)
-    lgb_pred = inverse_target_transform(lgb_pred)
-    # XGBoost
-    X_xgb = encode_cats_for_xgb(X, cat_features)
-    dmatrix = xgb.DMatrix(X_xgb)
-    xgb_pred = xgb_model.predict(dmatrix)
-    xgb_pred = inverse_target_transform(xgb_pred)
-    # CatBoost
-    cb_pred = cb_model.predict(X)
-    cb_pred = inverse_target_transform(cb_pred)
+    X = prepare_features_for_predict(user_input, feature_list, cat_features, vocabularies=vocabularies or categories,
+                                     snapshot=snapshot)
+    if categories:
+        X = block_frame_for_predict(X, categories)
+    # Предсказания загруженных моделей (None - модели нет в артефакте)
+    result = {}
+    if lgb_model is not None:
+        result["LightGBM"] = float(inverse_target_transform(lgb_model.predict(X))[0])
+    if xgb_model is not None:
+        dmatrix = xgb_dmatrix_for_predict(X, xgb_model, cat_features, categories)
+        result["XGBoost"] = float(inverse_target_transform(xgb_model.predict(dmatrix))[0])
+    if cb_model is not None:
+        X_cb = catboost_frame_for_predict(X, cat_features, categories)
+        result["CatBoost"] = float(inverse_target_transform(cb_model.predict(X_cb))[0])
     # Ансамбль
-    w_lgb, w_xgb, w_cb = ensemble_weights
-    ensemble_pred = w_lgb * lgb_pred + w_xgb * xgb_pred + w_cb * cb_pred
-    return {
-        "LightGBM": float(lgb_pred[0]),
-        "XGBoost": float(xgb_pred[0]),
-        "CatBoost": float(cb_pred[0]),
-        "Ensemble": float(ensemble_pred[0])
-    }
+    weights = dict(zip(["LightGBM", "XGBoost", "CatBoost"], ensemble_weights))
+    result["Ensemble"] = sum(weights[name] * pred for name, pred in result.items())
+    return result
 
 # =======================
 # 4. Пример использования: консольный ввод
@@ -101,7 +182,12 @@ def predict_sales(user_input: dict, lgb_model, xgb_model, cb_model, ensemble_wei
 def main():
     print("==== ПРОГНОЗ ПРОДАЖ ПО ОДНОМУ ТОВАРУ ====")
     # Загрузка моделей и признаков
-    lgb_model, xgb_model, cb_model, ensemble_weights, feature_list, cat_features = load_all_models_and_meta()
+    (lgb_model, xgb_model, cb_model, ensemble_weights, feature_list, cat_features, vocabularies,
+     categories) = load_all_models_and_meta()
+    # Снимок последнего состояния рядов: без него лаги и окна признаков - нули
+    snapshot = load_state_snapshot()
+    if snapshot is None:
+        print("Снимок состояния рядов не найден - признаки истории будут нулевыми")
     # Пример диалога с пользователем
     print("Введите значения признаков для прогноза.")
     user_input = {
@@ -115,11 +201,14 @@ def main():
     # user_input["Весовой"] = input("Весовой (0/1): ")
     # и т.д.
     # Прогноз
-    result = predict_sales(user_input, lgb_model, xgb_model, cb_model, ensemble_weights, feature_list, cat_features)
+    result = predict_sales(
+        user_input, lgb_model, xgb_model, cb_model, ensemble_weights, feature_list, cat_features, vocabularies,
+        categories, snapshot
+    )
     print("\n--- Результаты прогноза ---")
-    print(f"LightGBM:  {result['LightGBM']:.3f}")
-    print(f"XGBoost:   {result['XGBoost']:.3f}")
-    print(f"CatBoost:  {result['CatBoost']:.3f}")
+    for name in ["LightGBM", "XGBoost", "CatBoost"]:
+        if name in result:
+            print(f"{name + ':':<10} {result[name]:.3f}")
     print(f"АНСАМБЛЬ:  {result['Ensemble']:.3f}")
 
 if __name__ == "__main__":
@@ -0,0 +1,214 @@
+import os
+import time
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+import joblib
+import numpy as np
+import pandas as pd
+
+# ================================================
+# Кэш результатов прогноза
+# ================================================
+# Один и тот же (SKU, Магазин, Дата) запрашивается многократно за день, а каждый
+# вызов predict_sales / predict_future_sales заново строит признаки и прогоняет
+# модели. Результат кэшируется по ключу
+#   (пространство, версия моделей, версия данных, нормализованные входы):
+#   - версия моделей - отпечаток файлов артефакта (размер и время изменения), ее
+#     ставят save_models и load_models; новое сохранение моделей дает новую версию,
+#     и записи прежней версии удаляются при первом обращении с новой;
+#   - версия данных - отпечаток содержимого всех колонок входной таблицы истории
+#     (продажи, цены, акции - prepare_future_features переносит их в строки горизонта)
+#     или версия снимка состояния рядов: новые продажи или цены дают другой ключ.
+# Память ограничена max_entries записей с вытеснением давно не использованных (LRU);
+# необязательный дисковый уровень (disk_dir) переживает перезапуск процесса.
+# Счетчики попаданий и задержек - prediction_cache_stats.
+
+# Файлы артефакта моделей, входящие в версию (относительно префикса). Снимок состояния рядов
+# пишется после save_models и в версию моделей не входит - у него своя версия (snapshot_version),
+# иначе версия, поставленная при сохранении, не совпала бы с версией после load_models
+ARTIFACT_FILES = [
+    'ensemble_weights.pkl', 'feature_list.pkl', 'cat_features.pkl', 'category_vocab.pkl', 'categories.pkl',
+    'lgb_model.pkl', 'xgb_model.pkl', 'cb_model.pkl', 'ensemble_meta.pkl',
+]
+
+def artifact_version(file_prefix='retail_sales_'):
+    """Отпечаток файлов артефакта: меняется при каждом новом сохранении моделей (None - файлов нет)"""
+    h = hashlib.md5()
+    found = False
+    for name in ARTIFACT_FILES:
+        path = f"{file_prefix}{name}"
+        if os.path.exists(path):
+            stat = os.stat(path)
+            h.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+            found = True
+    return h.hexdigest()[:16] if found else None
+
+def frame_version(df, columns=None):
+    """Отпечаток содержимого таблицы (по колонкам columns, None - по всем)"""
+    columns = list(df.columns) if columns is None else [col for col in columns if col in df.columns]
+    hashes = pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+    return hashlib.md5(hashes.tobytes()).hexdigest()[:16]
+
+def history_version(history_df, holidays_df, promotions_df):
+    """
+    Версия данных прогноза на горизонт: все колонки истории (последняя строка ряда -
+    цена, акция, признаки - копируется в будущие даты), праздники и акции
+    """
+    return '-'.join([frame_version(history_df), frame_version(holidays_df), frame_version(promotions_df)])
+
+def snapshot_version(snapshot):
+    """Версия снимка состояния рядов (load_state_snapshot); None - снимка нет"""
+    return None if snapshot is None else snapshot.get('version')
+
+def future_sales_key(ensemble_results, last_data, holidays_df, promotions_df, days_ahead):
+    """Версия моделей, версия данных и входы для кэширования predict_future_sales"""
+    data_version = history_version(last_data, holidays_df, promotions_df)
+    return ensemble_results.get('artifact_version'), data_version, (int(days_ahead),)
+
+def _normalize(value):
+    """Значение входа ключа: 1, 1.0 и '1' совпадают, даты - в виде ГГГГ-ММ-ДД"""
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        return pd.Timestamp(value).strftime('%Y-%m-%d')
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    return str(value)
+
+def normalize_inputs(user_input):
+    """Входы predict_sales в каноническом виде (порядок ключей и типы значений не важны)"""
+    items = dict(user_input)
+    if items.get('Дата') is not None:
+        items['Дата'] = pd.Timestamp(items['Дата'])
+    return tuple(sorted((str(name), _normalize(value)) for name, value in items.items()))
+
+def create_prediction_cache(max_entries=4096, disk_dir=None, max_disk_entries=100_000):
+    """
+    Кэш прогнозов: max_entries записей в памяти (LRU);
+    disk_dir - дисковый уровень (не более max_disk_entries файлов), None - только память
+    """
+    if disk_dir:
+        os.makedirs(disk_dir, exist_ok=True)
+    return {
+        'entries': OrderedDict(),
+        'max_entries': max_entries,
+        'disk_dir': disk_dir,
+        'max_disk_entries': max_disk_entries,
+        'model_versions': {},
+        'lock': threading.RLock(),
+        'stats': {
+            'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0,
+            'hit_seconds': 0.0, 'miss_seconds': 0.0,
+        },
+    }
+
+def _disk_path(cache, key):
+    namespace, model_version = key[0], key[1]
+    digest = hashlib.md5(repr(key).encode()).hexdigest()
+    return os.path.join(cache['disk_dir'], str(namespace), str(model_version), f"{digest}.pkl")
+
+def _purge_model_version(cache, namespace, model_version):
+    """Новая версия моделей в пространстве: записи прежних версий больше не нужны"""
+    previous = cache['model_versions'].get(namespace)
+    cache['model_versions'][namespace] = model_version
+    if previous is None or previous == model_version:
+        return
+    stale = [key for key in cache['entries'] if key[0] == namespace and key[1] != model_version]
+    for key in stale:
+        del cache['entries'][key]
+    cache['stats']['invalidations'] += len(stale)
+    if cache['disk_dir']:
+        directory = os.path.join(cache['disk_dir'], str(namespace))
+        for version in os.listdir(directory) if os.path.isdir(directory) else []:
+            if version != str(model_version):
+                shutil.rmtree(os.path.join(directory, version), ignore_errors=True)
+    print(f"DEBUG: Кэш прогнозов: новая версия моделей {model_version} ({namespace}), удалено записей {len(stale)}")
+
+def _copy(value):
+    return value.copy() if isinstance(value, (pd.DataFrame, dict)) else value
+
+def _store(cache, key, value):
+    entries = cache['entries']
+    entries[key] = value
+    entries.move_to_end(key)
+    while len(entries) > cache['max_entries']:
+        entries.popitem(last=False)
+        cache['stats']['evictions'] += 1
+    if cache['disk_dir']:
+        path = _disk_path(cache, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        joblib.dump(value, path)
+        cache['disk_entries'] = cache.get('disk_entries', 0) + 1
+        if cache['disk_entries'] > cache['max_disk_entries'] * 1.1:
+            _trim_disk(cache)
+
+def _trim_disk(cache):
+    """Дисковый уровень: удаление самых старых файлов сверх max_disk_entries"""
+    files = [
+        os.path.join(root, name) for root, _, names in os.walk(cache['disk_dir']) for name in names
+        if name.endswith('.pkl')
+    ]
+    files.sort(key=os.path.getmtime)
+    for path in files[:max(len(files) - cache['max_disk_entries'], 0)]:
+        os.remove(path)
+        cache['stats']['evictions'] += 1
+    cache['disk_entries'] = min(len(files), cache['max_disk_entries'])
+
+def cached_prediction(cache, namespace, model_version, data_version, inputs, compute):
+    """
+    Результат compute() из кэша по ключу (namespace, model_version, data_version, inputs).
+    cache=None или model_version=None (ансамбль не сохранен - версии нет) - без кэша
+    """
+    if cache is None or model_version is None:
+        return compute()
+    key = (namespace, model_version, data_version, inputs)
+    t0 = time.perf_counter()
+    with cache['lock']:
+        _purge_model_version(cache, namespace, model_version)
+        value = cache['entries'].get(key)
+        if value is not None:
+            cache['entries'].move_to_end(key)
+            cache['stats']['hits'] += 1
+            cache['stats']['hit_seconds'] += time.perf_counter() - t0
+            return _copy(value)
+        if cache['disk_dir'] and os.path.exists(_disk_path(cache, key)):
+            value = joblib.load(_disk_path(cache, key))
+            cache['entries'][key] = value
+            while len(cache['entries']) > cache['max_entries']:
+                cache['entries'].popitem(last=False)
+                cache['stats']['evictions'] += 1
+            cache['stats']['hits'] += 1
+            cache['stats']['disk_hits'] += 1
+            cache['stats']['hit_seconds'] += time.perf_counter() - t0
+            return _copy(value)
+
+    # Прогноз считается вне блокировки: параллельные промахи по разным ключам не ждут друг друга
+    value = compute()
+    with cache['lock']:
+        _store(cache, key, _copy(value))
+        cache['stats']['misses'] += 1
+        cache['stats']['miss_seconds'] += time.perf_counter() - t0
+    return value
+
+def invalidate_prediction_cache(cache):
+    """Полная очистка кэша (память и диск)"""
+    with cache['lock']:
+        cache['stats']['invalidations'] += len(cache['entries'])
+        cache['entries'].clear()
+        cache['model_versions'].clear()
+        if cache['disk_dir']:
+            shutil.rmtree(cache['disk_dir'], ignore_errors=True)
+            os.makedirs(cache['disk_dir'], exist_ok=True)
+            cache['disk_entries'] = 0
+
+def prediction_cache_stats(cache):
+    """Счетчики для выбора размера кэша: доля попаданий, средние задержки попадания и промаха (мс)"""
+    stats = dict(cache['stats'])
+    requests = stats['hits'] + stats['misses']
+    stats['size'] = len(cache['entries'])
+    stats['hit_rate'] = stats['hits'] / requests if requests else 0.0
+    stats['avg_hit_ms'] = 1000 * stats['hit_seconds'] / stats['hits'] if stats['hits'] else 0.0
+    stats['avg_miss_ms'] = 1000 * stats['miss_seconds'] / stats['misses'] if stats['misses'] else 0.0
+    return stats
@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+
+# ================================================
+# Календарь акций (индекс интервалов)
+# ================================================
+# Каждая акция - интервал [Дата_начала, Дата_окончания], при наличии колонки
+# Магазин в таблице акций - отдельно для каждого магазина. Интервалы хранятся
+# отсортированными массивами по составному ключу (код ключа, день), поэтому
+# тип, скидка, признак уценки и активность акции для всех строк продаж находятся
+# одним searchsorted без merge и без копирования колонок акций в таблицу продаж.
+# Запрос "сколько акций шло за последние N дней" считается по двум отсортированным
+# массивам (начала и окончания интервалов) - тоже без расширения таблицы.
+
+PROMO_KEY = 'Номер_акции'
+STORE_KEY = 'Магазин'
+
+# Сдвиг для составного ключа: код ключа * 2**32 + (день + 2**31)
+_KEY_SHIFT = np.int64(2 ** 32)
+_DAY_OFFSET = np.int64(2 ** 31)
+
+def _days(dates):
+    """Даты -> номер дня (int64)"""
+    dates = np.asarray(dates)
+    if dates.dtype.kind != 'M':
+        dates = np.asarray(pd.to_datetime(dates))
+    return dates.astype('datetime64[D]').astype('int64')
+
+def _composite(codes, days):
+    return codes.astype('int64') * _KEY_SHIFT + (days + _DAY_OFFSET)
+
+def build_promotion_calendar(promotions_df):
+    """
+    Индекс интервалов акций.
+    Ключ - Номер_акции (и Магазин, если он есть в таблице акций); у одного ключа может быть несколько интервалов
+    """
+    keys = [PROMO_KEY] + ([STORE_KEY] if STORE_KEY in promotions_df.columns else [])
+    promotions = promotions_df.sort_values(keys + ['Дата_начала'], kind='stable').reset_index(drop=True)
+
+    key_index = pd.MultiIndex.from_frame(promotions[keys]).unique() if len(keys) > 1 \
+        else pd.Index(promotions[PROMO_KEY]).unique()
+    key_code = key_index.get_indexer(
+        pd.MultiIndex.from_frame(promotions[keys]) if len(keys) > 1 else promotions[PROMO_KEY]
+    )
+    start, end = _days(promotions['Дата_начала']), _days(promotions['Дата_окончания'])
+
+    # Для запросов по окну: начала и окончания отдельно, сгруппированные по магазину
+    if STORE_KEY in keys:
+        store_index = pd.Index(promotions[STORE_KEY].unique())
+        store_code = store_index.get_indexer(promotions[STORE_KEY])
+    else:
+        store_index, store_code = None, np.zeros(len(promotions), dtype='int64')
+
+    print(f"DEBUG: Календарь акций: {len(key_index)} ключей, {len(promotions)} интервалов")
+    return {
+        'keys': keys,
+        'key_index': key_index,
+        'interval_key': _composite(key_code, start),  # отсортирован по (ключ, начало)
+        'key_first': np.searchsorted(key_code, np.arange(len(key_index))),
+        'start': start,
+        'end': end,
+        'type': promotions['Тип_акции'].to_numpy(dtype=object),
+        'discount': promotions['Процент_скидки'].to_numpy(dtype='float64'),
+        'clearance': promotions['Это_уценка'].to_numpy(dtype='float64'),
+        'store_index': store_index,
+        'window_start': np.sort(_composite(store_code, start)),
+        'window_end': np.sort(_composite(store_code, end)),
+    }
+
+def _row_key_codes(calendar, promo_ids, stores=None):
+    """Код ключа календаря для каждой строки (-1 - акции нет в календаре)"""
+    promo_ids = np.asarray(promo_ids)
+    if STORE_KEY in calendar['keys']:
+        if stores is None:
+            raise ValueError("Календарь акций задан по магазинам - нужна колонка Магазин")
+        return calendar['key_index'].get_indexer(pd.MultiIndex.from_arrays([promo_ids, np.asarray(stores)]))
+    return calendar['key_index'].get_indexer(promo_ids)
+
+def promotion_lookup(calendar, promo_ids, dates, stores=None):
+    """
+    Акция каждой строки: интервал ключа, начавшийся последним не позже даты (или первый интервал ключа).
+    Возвращает словарь массивов: active (int8), type (object, 'Нет акции'), discount (float64, 0),
+    clearance (float64, NaN - акции нет в календаре), found (bool)
+    """
+    codes = _row_key_codes(calendar, promo_ids, stores)
+    found = codes >= 0
+    days = _days(dates)
+    if not found.any():
+        return {
+            'active': np.zeros(len(codes), dtype='int8'),
+            'type': np.full(len(codes), 'Нет акции', dtype=object),
+            'discount': np.zeros(len(codes)),
+            'clearance': np.full(len(codes), np.nan),
+            'found': found,
+        }
+
+    safe_codes = np.where(found, codes, 0)
+    position = np.searchsorted(calendar['interval_key'], _composite(safe_codes, days), 'right') - 1
+    position = np.maximum(position, calendar['key_first'][safe_codes])
+
+    active = found & (np.asarray(promo_ids) != 0) \
+        & (days >= calendar['start'][position]) & (days <= calendar['end'][position])
+    return {
+        'active': active.astype('int8'),
+        'type': np.where(found, calendar['type'][position], 'Нет акции'),
+        'discount': np.where(found, calendar['discount'][position], 0),
+        'clearance': np.where(found, calendar['clearance'][position], np.nan),
+        'found': found,
+    }
+
+def count_active_promotions(calendar, dates, days=1, stores=None):
+    """
+    Число акций календаря, шедших хотя бы один день из последних days дней (включая дату строки);
+    для календаря по магазинам - акций магазина строки
+    """
+    day = _days(dates)
+    if calendar['store_index'] is not None:
+        if stores is None:
+            raise ValueError("Календарь акций задан по магазинам - нужна колонка Магазин")
+        store_code = calendar['store_index'].get_indexer(np.asarray(stores))
+        # Магазины без акций - код за последней группой (0 акций)
+        store_code = np.where(store_code >= 0, store_code, len(calendar['store_index']))
+    else:
+        store_code = np.zeros(len(day), dtype='int64')
+
+    # Начавшиеся не позже даты минус закончившиеся до начала окна
+    started = np.searchsorted(calendar['window_start'], _composite(store_code, day), 'right')
+    finished = np.searchsorted(calendar['window_end'], _composite(store_code, day - (days - 1)), 'left')
+    return (started - finished).astype('int16')
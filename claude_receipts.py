@@ -0,0 +1,150 @@
+import numpy as np
+import pandas as pd
+
+# ================================================
+# Агрегация по чекам с компактными ключами GUID
+# ================================================
+# Строковые GUID занимают большую часть памяти таблицы продаж, а хэширование
+# строк - большую часть времени группировок по чеку. Здесь GUID разбирается в
+# 128-битный ключ (две колонки uint64), чеки нумеруются одной сортировкой
+# ключей, суммы чека и сертификата считаются bincount по номерам чеков, а
+# возвраты агрегируются и присоединяются сортированным слиянием по составному
+# ключу (номер чека, пара SKU-Магазин) через searchsorted.
+
+GUID_COLUMN = 'GUID_продажи'
+GUID_KEY_COLUMNS = ['GUID_продажи_hi', 'GUID_продажи_lo']
+
+# Позиции шестнадцатеричных цифр в каноническом GUID 8-4-4-4-12
+_HEX_POSITIONS = np.array([i for i in range(36) if i not in (8, 13, 18, 23)])
+_NIBBLE_SHIFTS = np.arange(60, -1, -4, dtype='uint64')
+
+def _hex_table():
+    table = np.full(256, 16, dtype='uint8')
+    for value, char in enumerate('0123456789abcdef'):
+        table[ord(char)] = value
+        table[ord(char.upper())] = value
+    return table
+
+_HEX_TABLE = _hex_table()
+
+def parse_guids(guids):
+    """
+    GUID-строки -> (hi, lo, missing): старшие и младшие 64 бита (uint64) и маска пропусков.
+    Формат с дефисами 8-4-4-4-12 или 32 цифры без дефисов (регистр не важен, фигурные скобки допускаются)
+    """
+    values = np.asarray(guids, dtype=object)
+    missing = pd.isna(values)
+    if missing.any():
+        values = np.where(missing, '0' * 32, values)
+
+    # Байты строк фиксированной ширины; канонический вид - ровно 36 символов с дефисами на своих местах
+    chars = np.asarray(values, dtype='S37').view('uint8').reshape(len(values), 37)
+    canonical = (chars[:, 35] != 0) & (chars[:, 36] == 0) & (chars[:, [8, 13, 18, 23]] == ord('-')).all(axis=1)
+    digits = chars[:, _HEX_POSITIONS]
+
+    # Прочие записи: без скобок и дефисов должно остаться ровно 32 цифры
+    wrong_length = np.zeros(len(values), dtype=bool)
+    if not canonical.all():
+        other = pd.Series(values[~canonical]).astype(str).str.strip('{}').str.replace('-', '', regex=False)
+        other_chars = np.asarray(other.to_numpy(dtype=object), dtype='S32').view('uint8').reshape(len(other), 32)
+        digits[~canonical] = other_chars
+        wrong_length[~canonical] = other.str.len().to_numpy() != 32
+
+    nibbles = _HEX_TABLE[digits]
+    invalid = ((nibbles > 15).any(axis=1) | wrong_length) & ~missing
+    if invalid.any():
+        raise ValueError(f"Некорректные GUID ({invalid.sum()}), например: {values[invalid][0]!r}")
+
+    nibbles = nibbles.astype('uint64')
+    hi = np.bitwise_or.reduce(nibbles[:, :16] << _NIBBLE_SHIFTS, axis=1)
+    lo = np.bitwise_or.reduce(nibbles[:, 16:] << _NIBBLE_SHIFTS, axis=1)
+    return hi, lo, missing
+
+def format_guids(hi, lo):
+    """Обратное преобразование (hi, lo) -> GUID-строки 8-4-4-4-12"""
+    text = [f'{h:016x}{l:016x}' for h, l in zip(np.asarray(hi).tolist(), np.asarray(lo).tolist())]
+    return np.array([f'{t[:8]}-{t[8:12]}-{t[12:16]}-{t[16:20]}-{t[20:]}' for t in text], dtype=object)
+
+def _key_array(hi, lo):
+    keys = np.empty(len(hi), dtype=[('hi', 'uint64'), ('lo', 'uint64')])
+    keys['hi'], keys['lo'] = hi, lo
+    return keys
+
+def number_receipts(hi, lo, missing=None):
+    """
+    Номер чека для каждой строки (-1 - пропуск GUID) и отсортированные уникальные ключи чеков.
+    Одна сортировка ключей: границы чеков - смена (hi, lo) между соседями
+    """
+    valid = np.ones(len(hi), dtype=bool) if missing is None else ~missing
+    rows = np.flatnonzero(valid)
+    order = rows[np.lexsort((lo[rows], hi[rows]))]
+    sorted_hi, sorted_lo = hi[order], lo[order]
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = (sorted_hi[1:] != sorted_hi[:-1]) | (sorted_lo[1:] != sorted_lo[:-1])
+
+    receipt = np.full(len(hi), -1, dtype='int64')
+    receipt[order] = np.cumsum(starts) - 1
+    return receipt, _key_array(sorted_hi[starts], sorted_lo[starts])
+
+def lookup_receipts(receipt_keys, hi, lo):
+    """Номер чека по ключам (hi, lo) из number_receipts; -1 - такого чека нет"""
+    if len(receipt_keys) == 0:
+        return np.full(len(hi), -1, dtype='int64')
+    keys = _key_array(hi, lo)
+    position = np.minimum(np.searchsorted(receipt_keys, keys), len(receipt_keys) - 1)
+    return np.where(receipt_keys[position] == keys, position, -1)
+
+def aggregate_receipts(sales, returns, price_col='Цена_со_скидкой'):
+    """
+    Возвраты, чистые продажи, сумма чека и сумма сертификата - как в load_data, без строковых группировок.
+    GUID_продажи в sales заменяется двумя колонками uint64 (GUID_KEY_COLUMNS)
+    """
+    hi, lo, missing = parse_guids(sales[GUID_COLUMN])
+    receipt, receipt_keys = number_receipts(hi, lo, missing)
+    n_receipts, valid = len(receipt_keys), receipt >= 0
+
+    # Возвраты: номер чека продажи по GUID, возвраты по чекам не из sales отбрасываются
+    return_hi, return_lo, return_missing = parse_guids(returns[GUID_COLUMN])
+    return_receipt = lookup_receipts(receipt_keys, return_hi, return_lo)
+    return_receipt[return_missing] = -1
+    matched = return_receipt >= 0
+
+    # Составной ключ (чек, SKU, Магазин): коды SKU и магазинов общие для продаж и возвратов
+    sku_codes, skus = pd.factorize(np.concatenate([sales['SKU'].to_numpy(), returns['SKU'].to_numpy()]))
+    store_codes, stores = pd.factorize(np.concatenate([sales['Магазин'].to_numpy(), returns['Магазин'].to_numpy()]))
+    pair_codes = sku_codes.astype('int64') * max(len(stores), 1) + store_codes
+    n_pairs = max(len(skus) * len(stores), 1)
+    sales_key = receipt * n_pairs + pair_codes[:len(sales)]
+    return_key = return_receipt[matched] * n_pairs + pair_codes[len(sales):][matched]
+
+    # Сортированное слияние: суммы возвратов по уникальным ключам, поиск ключей продаж
+    return_keys, inverse = np.unique(return_key, return_inverse=True)
+    returned_by_key = np.bincount(
+        inverse, weights=returns['Количество_возвращено'].to_numpy(dtype='float64')[matched],
+        minlength=len(return_keys)
+    )
+    returned = np.zeros(len(sales))
+    if len(return_keys):
+        position = np.minimum(np.searchsorted(return_keys, sales_key), len(return_keys) - 1)
+        found = valid & (return_keys[position] == sales_key)
+        returned[found] = returned_by_key[position[found]]
+
+    # Суммы чека и сертификата (отрицательные цены) одним bincount по номерам чеков
+    price = sales[price_col].to_numpy(dtype='float64')
+    receipt_total = np.bincount(receipt[valid], weights=price[valid], minlength=max(n_receipts, 1))
+    certificate = np.bincount(receipt[valid], weights=np.minimum(price[valid], 0), minlength=max(n_receipts, 1))
+    receipt_row = np.maximum(receipt, 0)
+
+    guid_position = sales.columns.get_loc(GUID_COLUMN)
+    sales = sales.drop(columns=[GUID_COLUMN])
+    sales.insert(guid_position, GUID_KEY_COLUMNS[0], hi)
+    sales.insert(guid_position + 1, GUID_KEY_COLUMNS[1], lo)
+
+    sales['Количество_возвращено'] = returned
+    sales['Чистые_продажи'] = sales['Количество'] - sales['Количество_возвращено']
+    sales['Сумма_чека'] = np.where(valid, receipt_total[receipt_row], np.nan)
+    sales['Сумма_сертификата'] = np.where(valid, np.abs(certificate[receipt_row]), 0)
+
+    print(f"DEBUG: Чеки: {n_receipts}, строк с возвратами: {int((returned != 0).sum())}, "
+          f"возвратов без продажи отброшено: {int((~matched).sum())}")
+    return sales
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+
+# ================================================
+# Скользящее число различных значений за N дней
+# ================================================
+# Замена groupby(...).rolling('30D').apply(lambda x: x.nunique()): строки
+# сортируются по (группа, дата), и для каждой строки j находится, до какой строки
+# она остается последним вхождением своего значения в окне - до следующего
+# вхождения того же значения в группе или до первой строки, для которой дата j уже
+# старше окна (второй указатель, searchsorted). Счетчик окна - разностный массив:
+# +1 на строке j, -1 на конце ее участка; накопленная сумма дает число различных
+# значений для всех строк сразу, за O(n log n) и без Python-цикла по окнам.
+
+# Сдвиг для составного ключа: код группы * 2**32 + (день + 2**31)
+_KEY_SHIFT = np.int64(2 ** 32)
+_DAY_OFFSET = np.int64(2 ** 31)
+
+def _composite(groups, days):
+    return groups * _KEY_SHIFT + (days + _DAY_OFFSET)
+
+def group_codes(df, keys):
+    """Код группы по колонкам keys для rolling_distinct_count"""
+    return df.groupby(keys, observed=True, sort=False).ngroup().to_numpy()
+
+def rolling_distinct_count(groups, dates, values, window_days):
+    """
+    Число различных значений values за последние window_days дней (включая дату строки) внутри группы.
+    groups: целочисленные коды групп (group_codes); values: пропуски (NaN) не считаются.
+    Строки с одинаковой датой видят только предшествующие им в исходном порядке, как rolling('30D') в pandas.
+    Возвращает int32-массив в исходном порядке строк
+    """
+    groups = np.asarray(groups, dtype='int64')
+    days = np.asarray(dates).astype('datetime64[D]').astype('int64')
+    n = len(groups)
+    if n == 0:
+        return np.zeros(0, dtype='int32')
+
+    # Сортировка по (группа, дата); lexsort устойчив - одинаковые даты в исходном порядке
+    order = np.lexsort((days, groups))
+    sorted_groups, sorted_days = groups[order], days[order]
+    value_codes, _ = pd.factorize(np.asarray(values)[order], use_na_sentinel=True)
+    valid = value_codes >= 0
+
+    # Первая строка группы, для которой строка j уже вне окна
+    keys = _composite(sorted_groups, sorted_days)
+    window_end = np.searchsorted(keys, _composite(sorted_groups, sorted_days + window_days), 'left')
+
+    # Следующее вхождение того же значения в группе
+    by_value = np.lexsort((value_codes, sorted_groups))
+    same = ((sorted_groups[by_value[1:]] == sorted_groups[by_value[:-1]])
+            & (value_codes[by_value[1:]] == value_codes[by_value[:-1]]))
+    next_same = np.full(n, n, dtype='int64')
+    next_same[by_value[:-1][same]] = by_value[1:][same]
+
+    # Участок [j, конец), на котором строка j - последнее вхождение значения в окне
+    starts = np.flatnonzero(valid)
+    ends = np.minimum(next_same, window_end)[valid]
+    counts = np.cumsum(np.bincount(starts, minlength=n + 1) - np.bincount(ends, minlength=n + 1))[:n]
+
+    result = np.empty(n, dtype='int32')
+    result[order] = counts
+    return result
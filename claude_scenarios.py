@@ -0,0 +1,212 @@
+import numpy as np
+import pandas as pd
+
+from claude import prepare_future_features, score_future_features
+
+# ================================================
+# Пакетные сценарии «что если» по цене и акциям
+# ================================================
+# Сценарий меняет только Цена_со_скидкой, Процент_скидки, Акция_активна и
+# Тип_акции, поэтому полный проход признаков (prepare_future_features) делается один
+# раз для базового прогноза. Для каждого сценария строки базовых признаков его пар
+# (SKU, Магазин) копируются в общую таблицу, в них подставляются значения сценария
+# и пересчитываются только зависящие от них признаки:
+#   - цена: Скидка_фактическая, Была_ли_скидка, Цена_изменение и ценовые отношения
+#     (Цена_относительно_среднего, Цена_отн_средней_*, Цена_отклонение_от_магазина -
+#     при неизменных средних базового прогноза);
+#   - процент скидки без цены: Цена_со_скидкой = Цена_без_скидки * (1 - процент / 100);
+#   - активность акции: Кол_акций_в_магазине и кросс-признаки Акция_Весовой, Выходной_Акция;
+#   - тип акции: Тип_акции_расширенный и Тип_акции_target_mean (по истории).
+# Признаки по истории продаж (лаги, окна, эффективность и история акций) остаются
+# базовыми. Все сценарии и базовый прогноз оцениваются ансамблем одним пакетом:
+# 50 вариантов цены - один проход признаков и один вызов predict каждой модели.
+
+SCENARIO_COLUMNS = ['Цена_со_скидкой', 'Процент_скидки', 'Акция_активна', 'Тип_акции']
+SCENARIO_KEYS = ['SKU', 'Магазин']
+
+def scenario_base(ensemble_results, last_data, holidays_df, promotions_df, days_ahead=30, stage_cache=False):
+    """
+    Базовые признаки горизонта прогноза (один полный проход) и энкодинги типов акций по истории
+    last_data: история с признаками (как для predict_future_sales)
+    """
+    features = prepare_future_features(
+        ensemble_results, last_data, holidays_df, promotions_df, days_ahead, stage_cache
+    ).reset_index(drop=True)
+
+    type_encoding = {}
+    if {'Тип_акции', 'Тип_акции_target_mean'} <= set(last_data.columns):
+        type_encoding = last_data.drop_duplicates('Тип_акции', keep='last').set_index('Тип_акции')[
+            'Тип_акции_target_mean'].to_dict()
+
+    print(f"DEBUG: Базовые признаки сценариев: {len(features)} строк")
+    return {'features': features, 'type_encoding': type_encoding}
+
+def scenario_grid(scenarios):
+    """
+    Таблица сценариев: колонки SCENARIO_COLUMNS (пропуск - базовое значение), необязательные SKU и
+    Магазин (сценарий только для этих пар) и Сценарий (по умолчанию номер строки).
+    Принимает DataFrame, список словарей или словарь {колонка: список значений} (декартово произведение)
+    """
+    if isinstance(scenarios, dict):
+        grid = pd.MultiIndex.from_product(list(scenarios.values()), names=list(scenarios)).to_frame(index=False)
+    else:
+        grid = pd.DataFrame(scenarios).reset_index(drop=True)
+
+    unknown = [col for col in grid.columns if col not in SCENARIO_COLUMNS + SCENARIO_KEYS + ['Сценарий']]
+    if unknown:
+        raise ValueError(f"Сценарий не может менять {unknown}; допустимы {SCENARIO_COLUMNS}")
+    if 'Сценарий' not in grid.columns:
+        grid['Сценарий'] = np.arange(len(grid))
+    return grid
+
+def expand_scenarios(features, grid):
+    """
+    Строки признаков для всех сценариев одной таблицей: позиции базовых строк (rows) и строки сетки (scenario_rows).
+    SKU / Магазин в сетке ограничивают сценарий этими парами (пропуск - все пары)
+    """
+    rows = np.tile(np.arange(len(features)), len(grid))
+    scenario_rows = np.repeat(np.arange(len(grid)), len(features))
+    keep = np.ones(len(rows), dtype=bool)
+    for key in SCENARIO_KEYS:
+        if key in grid.columns:
+            wanted = grid[key].to_numpy()
+            any_pair = pd.isna(wanted)
+            wanted = np.where(any_pair, '', wanted.astype(str))
+            keep &= any_pair[scenario_rows] | (features[key].astype(str).to_numpy()[rows] == wanted[scenario_rows])
+    return rows[keep], scenario_rows[keep]
+
+def _replace_where(base_values, new_values, mask):
+    """Новые значения (строки) в строках mask, базовые - в остальных; категориальный тип сохраняется"""
+    values = new_values.astype(str).where(mask, base_values.astype(str))
+    return values.astype('category') if isinstance(base_values.dtype, pd.CategoricalDtype) else values
+
+def apply_scenario_overrides(stacked, base, overridden, type_encoding=None):
+    """
+    Пересчет признаков, зависящих от подставленных значений сценария.
+    base: те же строки с базовыми значениями (до подстановки);
+    overridden: {колонка: маска строк, где сценарий задал значение}
+    """
+    no_price = np.ones(len(stacked), dtype=bool)
+    if 'Цена_со_скидкой' in overridden:
+        no_price = ~overridden['Цена_со_скидкой']
+    if 'Процент_скидки' in overridden and 'Цена_без_скидки' in stacked.columns:
+        # Задан только процент скидки - цена по скидке от полной цены
+        percent_only = overridden['Процент_скидки'] & no_price
+        stacked.loc[percent_only, 'Цена_со_скидкой'] = (
+            stacked.loc[percent_only, 'Цена_без_скидки'] * (1 - stacked.loc[percent_only, 'Процент_скидки'] / 100)
+        ).astype(stacked['Цена_со_скидкой'].dtype)
+
+    price = stacked['Цена_со_скидкой'].astype('float64')
+    base_price = base['Цена_со_скидкой'].astype('float64')
+    full_price = stacked['Цена_без_скидки'].astype('float64')
+    changed = price != base_price
+    if changed.any():
+        stacked['Скидка_фактическая'] = (1 - price / full_price.replace(0, np.nan)).fillna(0).clip(0, 1).astype('float32')
+        stacked['Была_ли_скидка'] = (price < full_price).astype('int8')
+
+        # Отношения к средним: средние базового прогноза не меняются
+        with np.errstate(all='ignore'):
+            ratio = np.where(base_price != 0, price / base_price, 1.0)
+        for col in ['Цена_относительно_среднего'] + [c for c in stacked.columns if c.startswith('Цена_отн_средней_')]:
+            stacked[col] = (base[col] * ratio).astype(base[col].dtype)
+        if 'Цена_отклонение_от_магазина' in stacked.columns:
+            stacked['Цена_отклонение_от_магазина'] = (
+                base['Цена_отклонение_от_магазина'] + (price - base_price)
+            ).astype('float32')
+
+        # Изменение цены к предыдущему дню ряда: первая дата горизонта - к последней цене базового ряда
+        if 'Цена_изменение' in stacked.columns:
+            series = [stacked['_scenario_row'], stacked['SKU'], stacked['Магазин']]
+            first = ~pd.concat(series, axis=1).duplicated().to_numpy()
+            previous = price.groupby(series, observed=True, sort=False).shift(1)
+            previous[first] = (base_price / (1 + base['Цена_изменение'].astype('float64')))[first]
+            stacked['Цена_изменение'] = (price / previous - 1).replace([np.inf, -np.inf], np.nan).fillna(0).astype('float32')
+
+    promo_delta = stacked['Акция_активна'].astype('float64') - base['Акция_активна'].astype('float64')
+    if (promo_delta != 0).any():
+        if 'Кол_акций_в_магазине' in stacked.columns:
+            stacked['Кол_акций_в_магазине'] = (base['Кол_акций_в_магазине'] + promo_delta).clip(lower=0).astype('int16')
+        promo_changed = promo_delta != 0
+        if 'Акция_Весовой' in stacked.columns:
+            stacked['Акция_Весовой'] = _replace_where(
+                base['Акция_Весовой'], stacked['Акция_активна'].astype(str) + "_" + stacked['Весовой'].astype(str),
+                promo_changed
+            )
+        if 'Выходной_Акция' in stacked.columns:
+            stacked['Выходной_Акция'] = _replace_where(
+                base['Выходной_Акция'], stacked['Выходной'].astype(str) + "_" + stacked['Акция_активна'].astype(str),
+                promo_changed
+            )
+
+    type_changed = stacked['Тип_акции'].astype(str) != base['Тип_акции'].astype(str)
+    if type_changed.any():
+        if 'Тип_акции_расширенный' in stacked.columns:
+            stacked['Тип_акции_расширенный'] = _replace_where(
+                base['Тип_акции_расширенный'], stacked['Тип_акции'], type_changed
+            )
+        if 'Тип_акции_target_mean' in stacked.columns and type_encoding:
+            encoded = stacked['Тип_акции'].map(type_encoding).astype('float32')
+            stacked['Тип_акции_target_mean'] = encoded.where(encoded.notna(), base['Тип_акции_target_mean'])
+
+    return stacked
+
+def _override(stacked, grid, scenario_rows, column):
+    """Значения колонки сценария в строках stacked (пропуск в сетке - базовое значение); маска заданных строк"""
+    values = grid[column].to_numpy()[scenario_rows]
+    given = pd.notna(values)
+    if not given.any():
+        return given
+    dtype = stacked[column].dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        new = [value for value in pd.unique(values[given]) if value not in dtype.categories]
+        stacked[column] = stacked[column].cat.add_categories(new)
+        stacked.loc[given, column] = values[given]
+    elif dtype == object:
+        stacked.loc[given, column] = values[given]
+    else:
+        stacked.loc[given, column] = values[given].astype(dtype)
+    return given
+
+def run_scenarios(ensemble_results, base, scenarios):
+    """
+    Прогноз по всем сценариям одним пакетом.
+    base: результат scenario_base; scenarios: сетка (см. scenario_grid).
+    Возвращает таблицу Сценарий, Дата, SKU, Магазин, значения сценария, Прогноз_продаж, Базовый_прогноз, Эффект
+    """
+    features = base['features']
+    grid = scenario_grid(scenarios)
+    rows, scenario_rows = expand_scenarios(features, grid)
+    print(f"DEBUG: Сценариев: {len(grid)}, строк для оценки: {len(rows)} (+{len(features)} базовых)")
+
+    base_rows = features.iloc[rows].reset_index(drop=True)
+    stacked = base_rows.copy()
+    stacked['_scenario_row'] = scenario_rows
+    overridden = {
+        column: _override(stacked, grid, scenario_rows, column)
+        for column in SCENARIO_COLUMNS if column in grid.columns and column in stacked.columns
+    }
+    stacked = apply_scenario_overrides(stacked, base_rows, overridden, base.get('type_encoding'))
+
+    # Базовые строки в том же пакете: один вызов predict на все сценарии
+    batch = pd.concat([features, stacked.drop(columns='_scenario_row')], ignore_index=True)
+    for col in batch.columns:
+        if isinstance(features[col].dtype, pd.CategoricalDtype) and not isinstance(batch[col].dtype, pd.CategoricalDtype):
+            batch[col] = batch[col].astype('category')
+    forecast = score_future_features(ensemble_results, batch)
+
+    base_forecast = forecast[:len(features)]
+    result = stacked[['Дата', 'SKU', 'Магазин'] + [col for col in SCENARIO_COLUMNS if col in stacked.columns]].copy()
+    result.insert(0, 'Сценарий', grid['Сценарий'].to_numpy()[scenario_rows])
+    result['Прогноз_продаж'] = forecast[len(features):]
+    result['Базовый_прогноз'] = base_forecast[rows]
+    result['Эффект'] = result['Прогноз_продаж'] - result['Базовый_прогноз']
+
+    print("DEBUG: Сценарии оценены")
+    return result
+
+def scenario_summary(result):
+    """Суммарный прогноз и эффект по сценариям и парам SKU-Магазин за весь горизонт"""
+    summary = result.groupby(['Сценарий', 'SKU', 'Магазин'], observed=True, sort=False)[
+        ['Прогноз_продаж', 'Базовый_прогноз', 'Эффект']].sum().reset_index()
+    summary['Эффект_%'] = (100 * summary['Эффект'] / summary['Базовый_прогноз'].replace(0, np.nan)).round(2)
+    return summary
@@ -0,0 +1,178 @@
+import json
+import socketserver
+import threading
+import time
+
+from claude import load_data, aggregate_daily_sales, feature_engineering, load_models, predict_future_sales
+from claude_prediction_cache import (
+    create_prediction_cache, cached_prediction, history_version, prediction_cache_stats
+)
+
+# ================================================
+# Теплая интерактивная сессия прогнозирования
+# ================================================
+# Данные, признаки и ансамбль загружаются один раз. Для каждого запроса
+# (SKU, магазин, горизонт) из памяти берется вся история нужного ряда - без
+# хвостового среза, иначе признаки относительно начала ряда (Дни_с_начала,
+# средние и доли по истории ряда, эффективность акций) отличались бы от обучения.
+# Ответ не требует повторного прогона всего пайплайна. Готовые прогнозы
+# хранятся в ограниченном кэше (claude_prediction_cache) с версией моделей и данных сессии.
+
+def create_forecast_session(ensemble_results=None, model_prefix='retail_sales_', daily_grain=None,
+                            cache_entries=4096, cache_dir=None):
+    """
+    Создает сессию: загружает данные, строит признаки и индекс рядов (SKU, Магазин).
+    ensemble_results: уже обученный ансамбль; если не передан - загружается по model_prefix
+    daily_grain: зерно данных (aggregate_daily_sales); None - как при обучении ансамбля (ensemble_meta.pkl)
+    cache_entries / cache_dir: размер кэша прогнозов в памяти и его дисковый уровень (None - только память)
+    """
+    t0 = time.time()
+    print("DEBUG: Создание интерактивной сессии прогнозирования")
+
+    if ensemble_results is None:
+        ensemble_results = load_models(model_prefix)
+        if ensemble_results is None:
+            raise RuntimeError(f"Не удалось загрузить модели с префиксом '{model_prefix}'")
+
+    if daily_grain is None:
+        daily_grain = ensemble_results.get('daily_grain', True)
+
+    sales_df, holidays_df, promotions_df = load_data()
+    if daily_grain:
+        sales_df = aggregate_daily_sales(sales_df)
+    processed_df = feature_engineering(
+        sales_df, holidays_df, promotions_df, ensemble_results.get('time_series_backend', 'pandas')
+    ).reset_index(drop=True)
+
+    # Позиции строк каждого ряда в отсортированном по дате порядке
+    series_index = {
+        (str(sku), str(store)): positions
+        for (sku, store), positions in processed_df.groupby(['SKU', 'Магазин'], observed=True).indices.items()
+    }
+
+    session = {
+        'ensemble_results': ensemble_results,
+        'processed_df': processed_df,
+        'holidays_df': holidays_df,
+        'promotions_df': promotions_df,
+        'series_index': series_index,
+        # Данные сессии не меняются - их отпечаток считается один раз
+        'data_version': history_version(processed_df, holidays_df, promotions_df),
+        'forecast_cache': create_prediction_cache(cache_entries, cache_dir),
+        'lock': threading.Lock(),
+    }
+
+    print(f"DEBUG: Сессия готова за {time.time() - t0:.1f}s. Рядов в памяти: {len(series_index)}")
+    return session
+
+def session_forecast(session, sku, store_id, days_ahead=30):
+    """Прогноз для одного ряда (SKU, Магазин) по данным, уже загруженным в сессию"""
+    key = (str(sku), str(store_id))
+    days_ahead = max(1, min(100, int(days_ahead)))
+
+    positions = session['series_index'].get(key)
+    if positions is None:
+        return None
+
+    def compute():
+        item_data = session['processed_df'].iloc[positions].copy()
+        # Модели и pandas не потокобезопасны при параллельных запросах к сокету
+        with session['lock']:
+            return predict_future_sales(
+                session['ensemble_results'], item_data,
+                session['holidays_df'], session['promotions_df'], days_ahead=days_ahead
+            )
+
+    return cached_prediction(
+        session['forecast_cache'], 'session_forecast', session['ensemble_results'].get('artifact_version'),
+        session['data_version'], (key, days_ahead), compute
+    )
+
+def run_forecast_repl(session):
+    """Консольный цикл запросов к сессии (пустой ввод магазина - выход)"""
+    print("\nИнтерактивный прогноз продаж (пустой ввод - выход)")
+
+    while True:
+        try:
+            store_id = input("Введите ID магазина: ").strip()
+            if not store_id:
+                break
+            sku = input("Введите SKU товара: ").strip()
+            days_ahead = int(input("На сколько дней вперед построить прогноз? [1-100]: "))
+        except (EOFError, KeyboardInterrupt):
+            break
+        except ValueError:
+            print("Некорректное значение горизонта прогноза")
+            continue
+
+        t0 = time.time()
+        forecast_result = session_forecast(session, sku, store_id, days_ahead)
+        if forecast_result is None:
+            print(f"Нет данных для SKU {sku} в магазине {store_id}")
+            continue
+
+        print(f"\nПрогноз продаж для SKU {sku} в магазине {store_id} на {len(forecast_result)} дней "
+              f"({(time.time() - t0) * 1000:.0f} мс):")
+        print(forecast_result[['Дата', 'Прогноз_продаж']])
+
+class _ForecastRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Построчный JSON-протокол: запрос {"sku": ..., "store": ..., "days": ...},
+    ответ {"forecast": [{"Дата": ..., "Прогноз_продаж": ...}, ...]} или {"error": ...};
+    запрос {"stats": true} - счетчики кэша прогнозов {"cache": {...}}
+    """
+
+    def _forecast_response(self, query):
+        forecast_result = session_forecast(self.server.session, query['sku'], query['store'], query.get('days', 30))
+        if forecast_result is None:
+            return {'error': f"Нет данных для SKU {query['sku']} в магазине {query['store']}"}
+        records = forecast_result[['Дата', 'Прогноз_продаж']].copy()
+        records['Дата'] = records['Дата'].dt.strftime('%Y-%m-%d')
+        return {'forecast': records.to_dict(orient='records')}
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            t0 = time.time()
+            try:
+                query = json.loads(line)
+                if query.get('stats'):
+                    response = {'cache': prediction_cache_stats(self.server.session['forecast_cache'])}
+                else:
+                    response = self._forecast_response(query)
+            except Exception as e:
+                response = {'error': str(e)}
+            response['elapsed_ms'] = round((time.time() - t0) * 1000, 1)
+            self.wfile.write((json.dumps(response, ensure_ascii=False) + '\n').encode('utf-8'))
+
+class _ForecastServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+def serve_forecast_session(session, host='127.0.0.1', port=8765):
+    """Локальный сокет-сервер поверх сессии"""
+    with _ForecastServer((host, port), _ForecastRequestHandler) as server:
+        server.session = session
+        print(f"DEBUG: Сервер прогнозов слушает {host}:{port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("DEBUG: Сервер прогнозов остановлен")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Интерактивная сессия прогнозирования продаж")
+    parser.add_argument("--model_prefix", default="retail_sales_", help="Префикс файлов сохраненных моделей")
+    parser.add_argument("--serve", action="store_true", help="Запустить локальный сокет-сервер вместо консоли")
+    parser.add_argument("--host", default="127.0.0.1", help="Адрес сервера")
+    parser.add_argument("--port", type=int, default=8765, help="Порт сервера")
+
+    args = parser.parse_args()
+
+    session = create_forecast_session(model_prefix=args.model_prefix)
+    if args.serve:
+        serve_forecast_session(session, host=args.host, port=args.port)
+    else:
+        run_forecast_repl(session)
@@ -0,0 +1,360 @@
+import os
+import time
+import hashlib
+import joblib
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from claude import (
+    load_data, aggregate_daily_sales, feature_engineering, prepare_train_test_data, train_or_update_ensemble,
+    save_models, load_models, predict_future_sales
+)
+from claude_snapshot import save_state_snapshot
+from claude_prediction_cache import artifact_version
+from claude_forecast_store import (
+    FORECAST_COLUMNS, open_forecast_store, close_forecast_store, begin_forecast_run, write_forecast_batch,
+    finish_forecast_run, compact_forecast_store
+)
+
+# ================================================
+# Шардирование обучения и прогноза по магазинам
+# ================================================
+# Магазины распределяются по шардам (по кластерам магазинов или по хешу кода
+# магазина). Каждый шард целиком - признаки, обучение, прогноз - выполняется в
+# отдельном процессе и хранит свои артефакты с префиксом shards/shard_XXX_,
+# поэтому память процесса определяется размером шарда, а не всей сети.
+# Шарды можно обучать на разных машинах (shard_ids) в общий каталог:
+# маршрутизатор (shard_router.pkl) по магазину находит модели нужного шарда.
+# Признаки по SKU (средние по товару, таргет-энкодинг) в шарде считаются
+# только по его магазинам. Машины одного дня пишут прогнозы в общий запуск
+# хранилища прогнозов (shard_run_id), части помечены версией моделей своего шарда.
+
+SHARD_DIR = 'shards'
+
+def store_shard(store, n_shards):
+    """Стабильный (не зависящий от PYTHONHASHSEED) номер шарда для магазина"""
+    digest = hashlib.md5(str(store).encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % n_shards
+
+def assign_store_shards(stores, n_shards, store_clusters=None):
+    """
+    Распределение магазинов по шардам.
+    store_clusters: {магазин: номер кластера} - магазины одного кластера попадают в один шард;
+    магазины без кластера распределяются по хешу
+    """
+    store_clusters = {str(store): cluster for store, cluster in (store_clusters or {}).items()}
+    return {
+        str(store): (int(store_clusters[str(store)]) % n_shards if str(store) in store_clusters
+                     else store_shard(store, n_shards))
+        for store in stores
+    }
+
+def shard_prefix(shard_id, shard_dir=SHARD_DIR):
+    """Префикс файлов моделей шарда (для save_models/load_models)"""
+    return os.path.join(shard_dir, f"shard_{shard_id:03d}_")
+
+def load_shard_data(stores):
+    """
+    Данные только магазинов шарда в дневном зерне: продажи и возвраты фильтруются уже при чтении,
+    поэтому процесс шарда не держит в памяти всю сеть. Суммы чеков считаются по строкам магазинов
+    шарда (чек принадлежит одному магазину). Праздники и акции общие для всех шардов
+    """
+    sales_df, holidays_df, promotions_df = load_data(stores)
+    return aggregate_daily_sales(sales_df), holidays_df, promotions_df
+
+def train_shard(shard_id, stores, shard_dir=SHARD_DIR, test_size_days=30, forecast_days=30, n_trials=30,
+                incremental=False, time_series_backend='pandas', **ensemble_kwargs):
+    """
+    Полный цикл одного шарда в своем процессе: признаки, обучение (или дообучение), сохранение
+    моделей и прогноз. Возвращает манифест шарда для маршрутизатора.
+    """
+    t0 = time.time()
+    print(f"DEBUG: Шард {shard_id}: {len(stores)} магазинов")
+    prefix = shard_prefix(shard_id, shard_dir)
+
+    sales_df, holidays_df, promotions_df = load_shard_data(stores)
+    if sales_df.empty:
+        print(f"DEBUG: Шард {shard_id}: нет продаж в загруженных данных - пропуск")
+        return None
+    processed_df = feature_engineering(sales_df, holidays_df, promotions_df, time_series_backend)
+    del sales_df
+
+    X_train, y_train, X_test, y_test, _, cat_features, _, _ = prepare_train_test_data(
+        processed_df, test_size_days=test_size_days
+    )
+    ensemble_results, _ = train_or_update_ensemble(
+        processed_df, X_train, y_train, X_test, y_test, cat_features, n_trials,
+        test_size_days=test_size_days, incremental=incremental, file_prefix=prefix, **ensemble_kwargs
+    )
+    ensemble_results['time_series_backend'] = time_series_backend
+    ensemble_results['daily_grain'] = True
+    save_models(ensemble_results, X_train, file_prefix=prefix)
+    save_state_snapshot(
+        processed_df, holidays_df, X_train.columns.tolist(), cat_features, file_prefix=prefix,
+        time_series_backend=time_series_backend
+    )
+
+    forecast_path = None
+    if forecast_days > 0:
+        forecast_path = f"{prefix}forecast.csv"
+        predict_future_sales(
+            ensemble_results, processed_df, holidays_df, promotions_df, days_ahead=forecast_days
+        ).to_csv(forecast_path, index=False)
+
+    manifest = {
+        'shard': shard_id,
+        'stores': list(stores),
+        'prefix': prefix,
+        'rows': len(processed_df),
+        'metrics': ensemble_results.get('metrics'),
+        'forecast_path': forecast_path,
+        'trained_at': pd.Timestamp.now().isoformat(timespec='seconds'),
+    }
+    joblib.dump(manifest, f"{prefix}manifest.pkl")
+    print(f"DEBUG: Шард {shard_id} готов за {time.time() - t0:.1f}s")
+    return manifest
+
+def forecast_shard(shard_id, stores, shard_dir=SHARD_DIR, days_ahead=30):
+    """Прогноз одного шарда сохраненными моделями шарда (в своем процессе)"""
+    prefix = shard_prefix(shard_id, shard_dir)
+    ensemble_results = load_models(prefix)
+    if ensemble_results is None:
+        raise RuntimeError(f"Нет моделей шарда {shard_id} ('{prefix}')")
+
+    sales_df, holidays_df, promotions_df = load_shard_data(stores)
+    processed_df = feature_engineering(
+        sales_df, holidays_df, promotions_df, ensemble_results.get('time_series_backend', 'pandas')
+    )
+    forecast_path = f"{prefix}forecast.csv"
+    predict_future_sales(
+        ensemble_results, processed_df, holidays_df, promotions_df, days_ahead=days_ahead
+    ).to_csv(forecast_path, index=False)
+    return forecast_path
+
+def _run_shards(func, shard_stores, max_workers, on_result=None, **kwargs):
+    """
+    Запуск func(shard_id, stores, **kwargs) по шардам в пуле процессов; результаты по номеру шарда.
+    on_result(shard_id, result) вызывается сразу по готовности каждого шарда
+    """
+    results = {}
+    if max_workers == 1:
+        for shard_id, stores in shard_stores.items():
+            results[shard_id] = func(shard_id, stores, **kwargs)
+            if on_result is not None:
+                on_result(shard_id, results[shard_id])
+        return results
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(func, shard_id, stores, **kwargs): shard_id
+            for shard_id, stores in shard_stores.items()
+        }
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            if on_result is not None:
+                on_result(futures[future], results[futures[future]])
+    return results
+
+def shard_run_id(run_date=None):
+    """Общий запуск хранилища прогнозов для всех машин шардов за дату (по умолчанию сегодня)"""
+    return f"shards_{pd.Timestamp(run_date or pd.Timestamp.now()).strftime('%Y%m%d')}"
+
+def _stream_to_forecast_store(forecast_store, run_id, path_of, shard_dir=SHARD_DIR):
+    """on_result для _run_shards: прогноз готового шарда сразу пишется в хранилище прогнозов"""
+    def on_result(shard_id, result):
+        path = path_of(result)
+        if path:
+            write_forecast_batch(
+                forecast_store, run_id, pd.read_csv(path, parse_dates=['Дата']),
+                model_version=artifact_version(shard_prefix(shard_id, shard_dir))
+            )
+    return on_result
+
+def group_stores_by_shard(store_to_shard, shard_ids=None):
+    """{номер шарда: [магазины]} с фильтром по шардам этой машины"""
+    shard_stores = {}
+    for store, shard_id in sorted(store_to_shard.items()):
+        if shard_ids is None or shard_id in shard_ids:
+            shard_stores.setdefault(shard_id, []).append(store)
+    return shard_stores
+
+def run_sharded_training(n_shards=4, max_workers=None, shard_dir=SHARD_DIR, store_clusters=None, shard_ids=None,
+                         test_size_days=30, forecast_days=30, n_trials=30, keep_forecast_runs=7, forecast_csv=False,
+                         run_id=None, **ensemble_kwargs):
+    """
+    Шардированное обучение: магазины делятся на n_shards шардов, шарды обучаются в пуле процессов.
+    shard_ids: обучить только эти шарды (распределение шардов между машинами с общим shard_dir)
+    Прогноз каждого шарда пишется в хранилище прогнозов (claude_forecast_store) по мере готовности
+    в общий для машин запуск run_id (по умолчанию shard_run_id());
+    forecast_csv: дополнительно future_sales_forecast.csv
+    ensemble_kwargs: параметры train_shard и create_ensemble (final_fit, incremental, time_series_backend и т.д.)
+    Возвращает маршрутизатор и объединенный прогноз (если forecast_days > 0).
+    """
+    t0 = time.time()
+    os.makedirs(shard_dir, exist_ok=True)
+
+    # Для распределения нужен только список магазинов
+    stores = pd.read_csv('data/sales.csv', usecols=['Магазин'])['Магазин'].astype(str).unique()
+    store_to_shard = assign_store_shards(stores, n_shards, store_clusters)
+    shard_stores = group_stores_by_shard(store_to_shard, shard_ids)
+    max_workers = max_workers or min(len(shard_stores), os.cpu_count() or 1)
+    print(f"DEBUG: Шардированное обучение: {len(shard_stores)} шардов из {n_shards}, процессов: {max_workers}")
+
+    forecast_store = open_forecast_store() if forecast_days > 0 else None
+    try:
+        run_id = begin_forecast_run(forecast_store, run_id=run_id or shard_run_id()) if forecast_store else None
+        _run_shards(
+            train_shard, shard_stores, max_workers,
+            on_result=_stream_to_forecast_store(
+                forecast_store, run_id, lambda manifest: manifest and manifest['forecast_path'], shard_dir
+            ) if forecast_store else None,
+            shard_dir=shard_dir, test_size_days=test_size_days, forecast_days=forecast_days, n_trials=n_trials,
+            **ensemble_kwargs
+        )
+        if forecast_store:
+            finish_forecast_run(forecast_store, run_id)
+    finally:
+        if forecast_store:
+            close_forecast_store(forecast_store)
+
+    router = build_shard_router(n_shards, store_to_shard, shard_dir)
+    forecast = None
+    if forecast_days > 0:
+        compact_forecast_store(keep_runs=keep_forecast_runs)
+        forecast = collect_shard_forecasts(router)
+        if forecast_csv:
+            forecast.to_csv('future_sales_forecast.csv', index=False)
+
+    print(f"DEBUG: Шардированное обучение завершено за {time.time() - t0:.1f}s")
+    return router, forecast
+
+def run_sharded_forecast(shard_dir=SHARD_DIR, days_ahead=30, max_workers=None, shard_ids=None, keep_forecast_runs=7,
+                         forecast_csv=False, run_id=None):
+    """
+    Прогноз всех (или shard_ids) шардов сохраненными моделями в пуле процессов.
+    Прогноз шарда пишется в хранилище прогнозов сразу по готовности в общий для машин запуск
+    run_id (по умолчанию shard_run_id()); forecast_csv - также future_sales_forecast.csv
+    """
+    router = load_shard_router(shard_dir)
+    shard_stores = group_stores_by_shard(router['store_to_shard'], shard_ids)
+    max_workers = max_workers or min(len(shard_stores), os.cpu_count() or 1)
+
+    forecast_store = open_forecast_store()
+    try:
+        run_id = begin_forecast_run(forecast_store, run_id=run_id or shard_run_id())
+        paths = _run_shards(
+            forecast_shard, shard_stores, max_workers,
+            on_result=_stream_to_forecast_store(forecast_store, run_id, lambda path: path, shard_dir),
+            shard_dir=shard_dir, days_ahead=days_ahead
+        )
+        finish_forecast_run(forecast_store, run_id)
+    finally:
+        close_forecast_store(forecast_store)
+    compact_forecast_store(keep_runs=keep_forecast_runs)
+
+    forecast = _concat_forecasts([pd.read_csv(paths[shard_id]) for shard_id in sorted(paths) if paths[shard_id]])
+    print(f"DEBUG: Прогноз {len(paths)} шардов на {days_ahead} дней сохранен в хранилище прогнозов (запуск {run_id})")
+    if forecast_csv:
+        forecast.to_csv('future_sales_forecast.csv', index=False)
+    return forecast
+
+# ================================================
+# Маршрутизатор шардов
+# ================================================
+def build_shard_router(n_shards, store_to_shard, shard_dir=SHARD_DIR):
+    """
+    Маршрутизатор по манифестам шардов в shard_dir (в т.ч. обученных на других машинах).
+    Сохраняется в shard_dir/shard_router.pkl
+    """
+    manifests = {}
+    for shard_id in sorted(set(store_to_shard.values())):
+        path = f"{shard_prefix(shard_id, shard_dir)}manifest.pkl"
+        if os.path.exists(path):
+            manifests[shard_id] = joblib.load(path)
+        else:
+            print(f"DEBUG: Шард {shard_id} еще не обучен")
+
+    router = {
+        'n_shards': n_shards,
+        'shard_dir': shard_dir,
+        'store_to_shard': dict(store_to_shard),
+        'manifests': manifests,
+    }
+    joblib.dump(router, os.path.join(shard_dir, 'shard_router.pkl'))
+    return router
+
+def load_shard_router(shard_dir=SHARD_DIR):
+    router = joblib.load(os.path.join(shard_dir, 'shard_router.pkl'))
+    router['loaded_models'] = {}
+    return router
+
+def route_store(router, store):
+    """Номер шарда магазина; новый магазин направляется по хешу"""
+    store = str(store)
+    if store in router['store_to_shard']:
+        return router['store_to_shard'][store]
+    return store_shard(store, router['n_shards'])
+
+def shard_models(router, shard_id):
+    """Ансамбль шарда; загружается при первом обращении и остается в памяти"""
+    loaded = router.setdefault('loaded_models', {})
+    if shard_id not in loaded:
+        ensemble_results = load_models(shard_prefix(shard_id, router['shard_dir']))
+        if ensemble_results is None:
+            raise RuntimeError(f"Нет моделей шарда {shard_id}")
+        loaded[shard_id] = ensemble_results
+    return loaded[shard_id]
+
+def routed_forecast(router, last_data, holidays_df, promotions_df, days_ahead=30):
+    """
+    Прогноз для произвольного набора магазинов: строки истории разбиваются по шардам,
+    каждая часть прогнозируется моделями своего шарда
+    """
+    shards = last_data['Магазин'].astype(str).map(lambda store: route_store(router, store))
+    forecasts = [
+        predict_future_sales(shard_models(router, shard_id), part, holidays_df, promotions_df, days_ahead=days_ahead)
+        for shard_id, part in last_data.groupby(shards.values, sort=True)
+    ]
+    return pd.concat(forecasts, ignore_index=True)
+
+def _concat_forecasts(frames):
+    """Объединение прогнозов шардов; ни одного прогноза - пустая таблица с колонками прогноза"""
+    if not frames:
+        print("DEBUG: Ни один шард не сохранил прогноз")
+        return pd.DataFrame(columns=FORECAST_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+def collect_shard_forecasts(router):
+    """Объединение прогнозов, сохраненных шардами"""
+    return _concat_forecasts([
+        pd.read_csv(manifest['forecast_path'])
+        for _, manifest in sorted(router['manifests'].items()) if manifest.get('forecast_path')
+    ])
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Шардированное по магазинам обучение и прогноз")
+    parser.add_argument("--n_shards", type=int, default=4, help="Количество шардов")
+    parser.add_argument("--workers", type=int, default=None, help="Количество процессов")
+    parser.add_argument("--shard_dir", default=SHARD_DIR, help="Каталог артефактов шардов")
+    parser.add_argument("--shard_ids", type=int, nargs='*', default=None, help="Шарды этой машины (по умолчанию все)")
+    parser.add_argument("--test_days", type=int, default=30, help="Количество дней для теста")
+    parser.add_argument("--forecast_days", type=int, default=30, help="Горизонт прогноза")
+    parser.add_argument("--trials", type=int, default=30, help="Количество итераций Optuna")
+    parser.add_argument("--forecast_only", action="store_true", help="Только прогноз сохраненными моделями шардов")
+    parser.add_argument("--keep_forecast_runs", type=int, default=7, help="Сколько запусков хранить в хранилище прогнозов")
+    parser.add_argument("--forecast_csv", action="store_true", help="Также выгрузить future_sales_forecast.csv")
+
+    args = parser.parse_args()
+
+    if args.forecast_only:
+        run_sharded_forecast(
+            args.shard_dir, args.forecast_days, args.workers, args.shard_ids, args.keep_forecast_runs, args.forecast_csv
+        )
+    else:
+        run_sharded_training(
+            n_shards=args.n_shards, max_workers=args.workers, shard_dir=args.shard_dir, shard_ids=args.shard_ids,
+            test_size_days=args.test_days, forecast_days=args.forecast_days, n_trials=args.trials,
+            keep_forecast_runs=args.keep_forecast_runs, forecast_csv=args.forecast_csv
+        )
@@ -0,0 +1,341 @@
+import os
+import joblib
+import numpy as np
+import pandas as pd
+
+# ================================================
+# Снимок последнего состояния рядов (SKU, Магазин) для точечного прогноза
+# ================================================
+# В конце обучения для каждого ряда сохраняются:
+#   history.npy, history_days.npy - последние SNAPSHOT_DAYS наблюдений продаж ряда и их дни;
+#   year_ago.npy - последние продажи ряда в каждый день года (YoY_change);
+#   values.npy  - числовые признаки последней строки ряда (ранги магазина, эффективность акций,
+#                 target encoding и т. п.) и медиана продаж SKU для заполнения лагов;
+#   codes.npy   - категориальные признаки последней строки (коды по словарям снимка);
+#   meta.pkl    - индекс рядов, списки колонок, праздники, словари target encoding по датам.
+# Массивы открываются через np.load(mmap_mode='r'): ряд читается с диска по запросу, без
+# загрузки истории в память. snapshot_features по (SKU, Магазин, Дата) за микросекунды
+# достраивает полный вектор признаков модели: календарные и праздничные признаки - из даты,
+# лаги, скользящие статистики и тренды - из истории ряда, остальное - из последней строки.
+# Будущие продажи неизвестны и равны 0, как в predict_future_sales (fill_unknown_target).
+
+SNAPSHOT_DIR = 'state_snapshot'
+SNAPSHOT_DAYS = 90
+TARGET_COL = 'Чистые_продажи'
+
+# Признаки, которые snapshot_features пересчитывает из даты и входных значений
+CROSS_FEATURES = {
+    'SKU_Магазин': ('SKU', 'Магазин'),
+    'День_недели_Весовой': ('День_недели', 'Весовой'),
+    'Акция_Весовой': ('Акция_активна', 'Весовой'),
+    'Выходной_Акция': ('Выходной', 'Акция_активна'),
+}
+
+# Признаки продаж самого дня: для дат после конца истории продажи неизвестны - значения,
+# которые получает будущая строка в predict_future_sales
+UNKNOWN_DAY_FEATURES = {
+    'Активность_магазина': 0.0,
+    'Доля_в_магазине': 0.0,
+    'Продажи_относительно_среднего': 1.0,
+    'Отношение_к_среднему_группы': 1.0,
+}
+
+def snapshot_dir(file_prefix='retail_sales_'):
+    return f"{file_prefix}{SNAPSHOT_DIR}"
+
+def _key(value):
+    """Ключ словаря категорий/энкодингов: 1, 1.0 и '1' - одно значение"""
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    return str(value)
+
+def _day(date):
+    return int(np.datetime64(pd.Timestamp(date).date(), 'D').astype('int64'))
+
+def save_state_snapshot(df, holidays_df, feature_list, cat_features, file_prefix='retail_sales_',
+                        time_series_backend='pandas'):
+    """
+    Снимок последнего состояния рядов по таблице признаков обучения (результат feature_engineering).
+    time_series_backend: 'pandas' - лаги и окна по строкам ряда, 'panel' - по календарным дням (как при обучении)
+    """
+    print("DEBUG: Сохранение снимка состояния рядов")
+    directory = snapshot_dir(file_prefix)
+    os.makedirs(directory, exist_ok=True)
+
+    df = df.sort_values('Дата', kind='stable')
+    pairs = pd.MultiIndex.from_arrays([df['SKU'].astype(str).to_numpy(), df['Магазин'].astype(str).to_numpy()])
+    codes, pair_index = pairs.factorize()
+    n_pairs = len(pair_index)
+
+    # Последняя строка каждого ряда (таблица отсортирована по дате)
+    _, first_reversed = np.unique(codes[::-1], return_index=True)
+    last_rows = len(codes) - 1 - first_reversed
+    last = df.iloc[last_rows]
+
+    # История продаж: последние SNAPSHOT_DAYS наблюдений ряда (значение и день), выравнивание по правому краю
+    day = df['Дата'].to_numpy().astype('datetime64[D]').astype('int64')
+    end_day = int(day.max())
+    target = df[TARGET_COL].to_numpy(dtype='float32')
+    order = np.lexsort((np.arange(len(codes)), codes))
+    from_end = pd.Series(codes[order]).groupby(codes[order]).cumcount(ascending=False).to_numpy()
+    keep = from_end < SNAPSHOT_DAYS
+    rows, columns = codes[order][keep], SNAPSHOT_DAYS - 1 - from_end[keep]
+    history = np.full((n_pairs, SNAPSHOT_DAYS), np.nan, dtype='float32')
+    history_days = np.full((n_pairs, SNAPSHOT_DAYS), np.iinfo('int32').min, dtype='int32')
+    history[rows, columns] = target[order][keep]
+    history_days[rows, columns] = day[order][keep]
+
+    # Последние продажи ряда в каждый день года - предыдущая строка с тем же днем года для YoY_change
+    day_of_year = df['Дата'].dt.dayofyear.to_numpy() - 1
+    flat = codes.astype('int64') * 366 + day_of_year
+    _, first_reversed = np.unique(flat[::-1], return_index=True)
+    latest = len(flat) - 1 - first_reversed
+    year_ago = np.full(n_pairs * 366, np.nan, dtype='float32')
+    year_ago[flat[latest]] = target[latest]
+    year_ago = year_ago.reshape(n_pairs, 366)
+
+    # Числовые признаки последней строки и медиана SKU (заполнение лагов, как в create_lags_vectorized)
+    numeric_columns = [col for col in feature_list if col not in cat_features and col in df.columns]
+    values = np.empty((n_pairs, len(numeric_columns) + 1), dtype='float32')
+    for i, col in enumerate(numeric_columns):
+        values[:, i] = pd.to_numeric(last[col], errors='coerce').to_numpy(dtype='float32')
+    values[:, -1] = last['SKU'].astype(str).map(
+        df.groupby(df['SKU'].astype(str))[TARGET_COL].median()
+    ).to_numpy(dtype='float32')
+
+    # Категориальные признаки последней строки - коды по словарям снимка
+    categorical_columns = [col for col in feature_list if col in cat_features and col in df.columns]
+    categories = {}
+    cat_codes = np.empty((n_pairs, len(categorical_columns)), dtype='int32')
+    for i, col in enumerate(categorical_columns):
+        cat_codes[:, i], categories[col] = pd.factorize(last[col].astype(object).to_numpy(), use_na_sentinel=True)
+
+    # Target encoding признаков, зависящих от даты или акции: значение -> среднее
+    encodings = {}
+    for col in feature_list:
+        source = col[:-len('_target_mean')] if col.endswith('_target_mean') else None
+        if source and source in df.columns and col in df.columns:
+            mapping = df.groupby(df[source].astype(object), observed=True)[col].first()
+            encodings[col] = {
+                'source': source,
+                'map': {_key(value): float(encoding) for value, encoding in mapping.items()},
+                'default': float(df[col].mean()),
+            }
+
+    # Праздники: отсортированные дни (все и по типам) и признаки самой даты
+    holiday_days, holiday_types, holiday_rows = np.zeros(0, dtype='int64'), {}, {}
+    if holidays_df is not None and len(holidays_df):
+        holiday_dates = pd.to_datetime(holidays_df['Дата'])
+        holiday_days = np.unique(holiday_dates.to_numpy().astype('datetime64[D]').astype('int64'))
+        if 'Тип_праздника' in holidays_df.columns:
+            for h_type in holidays_df['Тип_праздника'].dropna().unique():
+                holiday_types[f'Дней_до_{h_type}'] = np.unique(
+                    holiday_dates[holidays_df['Тип_праздника'] == h_type].to_numpy().astype('datetime64[D]').astype('int64')
+                )
+        for date, h_type, day_off in zip(holiday_dates, holidays_df.get('Тип_праздника', [None] * len(holidays_df)),
+                                         holidays_df.get('Выходной', [0] * len(holidays_df))):
+            holiday_rows[_day(date)] = ('Нет' if pd.isna(h_type) else h_type, 0 if pd.isna(day_off) else int(day_off))
+
+    np.save(os.path.join(directory, 'history.npy'), history)
+    np.save(os.path.join(directory, 'history_days.npy'), history_days)
+    np.save(os.path.join(directory, 'year_ago.npy'), year_ago)
+    np.save(os.path.join(directory, 'values.npy'), values)
+    np.save(os.path.join(directory, 'codes.npy'), cat_codes)
+    joblib.dump({
+        'features': list(feature_list),
+        'pairs': {pair: i for i, pair in enumerate(pair_index)},
+        'numeric_columns': numeric_columns,
+        'categorical_columns': categorical_columns,
+        'categories': categories,
+        'encodings': encodings,
+        'start_day': int(day.min()),
+        'end_day': end_day,
+        'end_date': pd.Timestamp(df['Дата'].max()),
+        'time_series_backend': time_series_backend,
+        'holiday_days': holiday_days,
+        'holiday_types': holiday_types,
+        'holiday_rows': holiday_rows,
+    }, os.path.join(directory, 'meta.pkl'))
+    print(f"DEBUG: Снимок состояния: {n_pairs} рядов, {SNAPSHOT_DAYS} дней истории -> '{directory}'")
+
+def load_state_snapshot(file_prefix='retail_sales_'):
+    """Снимок с массивами, отображенными в память (None - снимок не сохранялся)"""
+    directory = snapshot_dir(file_prefix)
+    if not os.path.exists(os.path.join(directory, 'meta.pkl')):
+        return None
+    meta_path = os.path.join(directory, 'meta.pkl')
+    snapshot = joblib.load(meta_path)
+    stat = os.stat(meta_path)
+    # Версия для кэша прогнозов: последний день истории и время записи снимка
+    snapshot['version'] = f"{snapshot['end_day']}-{stat.st_size}-{stat.st_mtime_ns}"
+    for name in ['history', 'history_days', 'year_ago', 'values', 'codes']:
+        snapshot[name] = np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+    snapshot['series_plan'] = _series_plan(snapshot['features'])
+    return snapshot
+
+def _date_features(snapshot, day, date):
+    """Календарные и праздничные признаки даты (как create_time_features / add_holiday_features)"""
+    day_of_week, day_of_year, day_of_month = date.dayofweek, date.dayofyear, date.day
+    features = {
+        'День_недели': day_of_week, 'Месяц': date.month, 'Год': date.year, 'Выходной': int(day_of_week >= 5),
+        'Дни_с_начала': day - snapshot['start_day'], 'День_года': day_of_year,
+        'Неделя_года': date.isocalendar()[1], 'Квартал': date.quarter,
+        'Sin_День': np.sin(2 * np.pi * day_of_year / 365), 'Cos_День': np.cos(2 * np.pi * day_of_year / 365),
+        'Sin_Неделя': np.sin(2 * np.pi * day_of_week / 7), 'Cos_Неделя': np.cos(2 * np.pi * day_of_week / 7),
+        'Sin_Месяц': np.sin(2 * np.pi * date.month / 12), 'Cos_Месяц': np.cos(2 * np.pi * date.month / 12),
+        'День_месяца': day_of_month, 'Начало_месяца': int(day_of_month <= 5), 'Конец_месяца': int(day_of_month >= 25),
+        'Зарплатный_день': int(14 <= day_of_month <= 16 or day_of_month >= 29 or day_of_month <= 1),
+        'Сезон_распродаж': int(date.month in (11, 12)),
+    }
+
+    def distances(days):
+        position = np.searchsorted(days, day)
+        after = int(days[position] - day) if position < len(days) else 999
+        before = int(day - days[position - 1]) if position > 0 else 999
+        if position < len(days) and days[position] == day:
+            before = 0
+        return after, before
+
+    features['Дней_до_праздника'], features['Дней_после_праздника'] = distances(snapshot['holiday_days'])
+    for name, days in snapshot['holiday_types'].items():
+        features[name] = distances(days)[0]
+    holiday_type, day_off = snapshot['holiday_rows'].get(day, (None, 0))
+    features['Праздник'] = int(holiday_type is not None)
+    features['Праздник_тип'] = holiday_type or 'Нет'
+    features['Выходной_день'] = day_off
+    return features
+
+def _series(snapshot, row, day):
+    """
+    Продажи ряда до даты включительно, по возрастанию дат; после конца истории - нули (продажи неизвестны).
+    'pandas' - наблюдавшиеся строки ряда, 'panel' - календарные дни (NaN - нет наблюдения)
+    """
+    values = np.asarray(snapshot['history'][row], dtype='float64')
+    days = np.asarray(snapshot['history_days'][row], dtype='int64')
+    end_day = snapshot['end_day']
+    known = ~np.isnan(values) & (days <= day)
+    if snapshot['time_series_backend'] != 'panel':
+        return np.concatenate([values[known], np.zeros(max(day - end_day, 0))])
+
+    series = np.full(SNAPSHOT_DAYS + 1, np.nan)
+    position = days[known] - (day - SNAPSHOT_DAYS)
+    inside = position >= 0
+    series[position[inside]] = values[known][inside]
+    series[max(end_day + 1 - (day - SNAPSHOT_DAYS), 0):] = 0
+    return series
+
+def _year_over_year(snapshot, row, date, value):
+    """YoY_change: продажи даты к последним продажам ряда в тот же день года (1 - нет данных или деление на 0)"""
+    previous = float(snapshot['year_ago'][row][date.dayofyear - 1])
+    if np.isnan(previous) or previous == 0 or np.isnan(value):
+        return 1.0
+    return value / previous
+
+def _slope(values):
+    """Наклон линейного тренда (np.polyfit степени 1) по последним 7 значениям, минимум 3"""
+    values = values[-7:]
+    values = values[~np.isnan(values)]
+    if len(values) < 3:
+        return 0.0
+    x = np.arange(len(values)) - (len(values) - 1) / 2
+    return float((x * values).sum() / (x * x).sum())
+
+def _series_plan(features):
+    """Лаги и окна, которые нужны модели: {'lags': [(имя, k)], 'windows': {окно: [(имя, статистика)]}, 'trends': set}"""
+    plan = {'lags': [], 'windows': {}, 'trends': set()}
+    for name in features:
+        kind, _, size = name.rpartition('_')
+        if name.startswith(('Trend_', 'Acceleration_')):
+            plan['trends'].add(name)
+        elif kind == 'Lag' and size.isdigit():
+            plan['lags'].append((name, int(size)))
+        elif kind in ('MA', 'Median', 'Max', 'Min', 'Std') and size.isdigit():
+            plan['windows'].setdefault(int(size), []).append((name, kind))
+    return plan
+
+def _series_features(series, median, plan):
+    """Лаги, скользящие статистики и тренды на конце ряда"""
+    features = {}
+
+    def lag(k):
+        value = series[-1 - k] if k < len(series) else np.nan
+        return median if np.isnan(value) else value
+
+    def window_values(size):
+        window = series[-size:]
+        return window[~np.isnan(window)]
+
+    for name, k in plan['lags']:
+        features[name] = lag(k)
+    for size, stats in plan['windows'].items():
+        window = window_values(size)
+        for name, kind in stats:
+            if not len(window):
+                features[name] = 0.0 if kind == 'Std' else np.nan
+            elif kind == 'MA':
+                features[name] = window.mean()
+            elif kind == 'Median':
+                features[name] = np.median(window)
+            elif kind == 'Max':
+                features[name] = window.max()
+            elif kind == 'Min':
+                features[name] = window.min()
+            else:
+                features[name] = window.std(ddof=1) if len(window) > 1 else 0.0
+
+    def window_mean(size):
+        window = window_values(size)
+        return window.mean() if len(window) else np.nan
+
+    trends = plan['trends']
+    if 'Trend_1_7' in trends:
+        features['Trend_1_7'] = lag(1) - window_mean(7)
+    if 'Trend_7_30' in trends:
+        features['Trend_7_30'] = window_mean(7) - window_mean(30)
+    if 'Trend_slope_7' in trends or 'Acceleration_7' in trends:
+        features['Trend_slope_7'] = _slope(series)
+        features['Acceleration_7'] = features['Trend_slope_7'] - _slope(series[:-1])
+    return features
+
+def snapshot_features(snapshot, user_input):
+    """
+    Полный вектор признаков модели для user_input с SKU, Магазин и Дата (по умолчанию - день после
+    конца истории): значения из user_input имеют приоритет, остальное - из снимка.
+    Ряд, которого нет в снимке, получает только признаки даты и значения user_input
+    """
+    sku, store = _key(user_input.get('SKU')), _key(user_input.get('Магазин'))
+    date = pd.Timestamp(user_input.get('Дата') or snapshot['end_date'] + pd.Timedelta(days=1))
+    day = _day(date)
+    features = {}
+
+    row = snapshot['pairs'].get((sku, store))
+    if row is not None:
+        values = snapshot['values'][row]
+        features.update(zip(snapshot['numeric_columns'], values[:-1].tolist()))
+        features.update({
+            col: (snapshot['categories'][col][code] if code >= 0 else None)
+            for col, code in zip(snapshot['categorical_columns'], snapshot['codes'][row].tolist())
+        })
+        series = _series(snapshot, row, day)
+        features.update(_series_features(series, float(values[-1]), snapshot['series_plan']))
+        if 'YoY_change' in snapshot['features']:
+            features['YoY_change'] = _year_over_year(snapshot, row, date, series[-1] if len(series) else np.nan)
+    features.update(_date_features(snapshot, day, date))
+    if day > snapshot['end_day']:
+        features.update({name: value for name, value in UNKNOWN_DAY_FEATURES.items() if name in features})
+        for is_weighted, weight_type in [(0, 'штучный'), (1, 'весовой')]:
+            if f'Продажи_квантиль_{weight_type}' in features:
+                features[f'Продажи_квантиль_{weight_type}'] = 0.5 if features.get('Весовой') == is_weighted else 0.0
+    features.update(user_input)
+    features['Дата'] = date
+
+    # Признаки, зависящие от даты и входных значений: кросс-признаки и target encoding
+    for name, (left, right) in CROSS_FEATURES.items():
+        if name in snapshot['features'] and left in features and right in features:
+            features[name] = f"{_key(features[left])}_{_key(features[right])}"
+    for name, encoding in snapshot['encodings'].items():
+        if name not in user_input and encoding['source'] in features:
+            features[name] = encoding['map'].get(_key(features[encoding['source']]), encoding['default'])
+    return features
@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import hashlib
+import inspect
+import types
+import joblib
+import pandas as pd
+
+import claude
+from claude_panel import panel_time_series_features
+
+# ================================================
+# Кэш этапов инженерии признаков
+# ================================================
+# feature_engineering и prepare_data_for_prediction - цепочка одних и тех же этапов.
+# Каждый этап объявляет читаемые колонки, изменяемые колонки и параметры; новые и
+# измененные им колонки сохраняются на диск с ключом из отпечатка входных колонок
+# (значения, типы, индекс и порядок строк), параметров и версии кода этапа.
+# Версия кода - исходники функции этапа и всех функций модулей проекта (claude*),
+# которые она вызывает прямо или через другие функции: правка вспомогательной
+# функции (claude_rolling, claude_promo_calendar, claude_groupstats и т.д.)
+# сбрасывает кэш всех этапов, которые до нее доходят.
+# При повторном запуске неизменившиеся этапы загружаются с диска, а изменение
+# одного этапа пересчитывает только его и этапы, чьи входы от него зависят.
+# Размер кэша ограничен: при превышении удаляются давно не использованные записи.
+
+STAGE_CACHE_DIR = 'cache/stages'
+
+# Увеличить при изменении кода вне функций проекта (константы, сторонние зависимости),
+# от которого зависят этапы
+STAGE_CODE_VERSION = 2
+
+def stage(name, func, inputs, outputs, reorders=False, code=None, **params):
+    """
+    Описание этапа.
+    inputs: читаемые колонки (None - вся таблица); outputs: создаваемые или перезаписываемые колонки
+    (список или функция от таблицы и параметров); reorders: этап меняет порядок строк;
+    code: функции, чей исходный код входит в версию этапа (по умолчанию func; вызываемые ими функции
+    проекта добавляются автоматически - code_closure); params: аргументы func
+    """
+    return {
+        'name': name, 'func': func, 'inputs': inputs, 'outputs': outputs,
+        'reorders': reorders, 'code': code or [func], 'params': params,
+    }
+
+SALES = 'Чистые_продажи'
+SERIES_INPUTS = ['SKU', 'Магазин', 'Дата', SALES]
+CROSS_OUTPUTS = ['SKU_Магазин', 'День_недели_Весовой', 'Акция_Весовой', 'Выходной_Акция']
+TARGET_ENCODED = ['SKU', 'Магазин', 'Тип_акции', 'День_недели', 'Месяц', 'Весовой']
+
+def _holiday_outputs(df, params):
+    holidays_df = params['holidays_df']
+    holiday_types = holidays_df['Тип_праздника'].dropna().unique() if 'Тип_праздника' in holidays_df.columns else []
+    return (['Дней_до_праздника', 'Дней_после_праздника'] + [f'Дней_до_{h_type}' for h_type in holiday_types]
+            + ['Сезон_распродаж'])
+
+def _volume_outputs(df, params):
+    weight_types = {0: 'штучный', 1: 'весовой'}
+    return (['Весовой', 'Среднее_по_весовой_группе', 'Отношение_к_среднему_группы']
+            + [f'{prefix}_{weight_types[is_weighted]}' for is_weighted in df['Весовой'].dropna().unique()
+               if is_weighted in weight_types for prefix in ['Цена_отн_средней', 'Продажи_квантиль']])
+
+def _lag_outputs(df, params):
+    return [f'Lag_{lag}' for lag in params['lags']]
+
+def _rolling_outputs(df, params):
+    return [f'{stat}_{window}' for window in params['windows'] for stat in claude.ROLLING_STATS
+            if params['columns'] is None or f'{stat}_{window}' in params['columns']]
+
+def _trend_outputs(df, params):
+    trends = list(claude.TREND_DEPENDENCIES) if params['features'] is None else params['features']
+    return trends + (['Trend_slope_7'] if 'Acceleration_7' in trends else [])
+
+def _panel_outputs(df, params):
+    return (_lag_outputs(df, params)
+            + _rolling_outputs(df, {'windows': params['windows'], 'columns': params['rolling_columns']})
+            + _trend_outputs(df, {'features': params['trends']}))
+
+def _parallel_outputs(df, params):
+    return _panel_outputs(df, {'lags': claude.LAG_DAYS, 'windows': claude.ROLLING_WINDOWS,
+                               'rolling_columns': None, 'trends': None})
+
+def common_stages(holidays_df, promotions_df):
+    """Этапы до временных рядов - общие для обучения и прогноза"""
+    return [
+        stage('price', claude.create_price_features, ['Цена_со_скидкой', 'Цена_без_скидки', 'SKU', 'Магазин', 'Дата'],
+              ['Скидка_фактическая', 'Была_ли_скидка', 'Цена_относительно_среднего', 'Цена_изменение',
+               'Цена_отклонение_от_магазина']),
+        stage('time', claude.create_time_features, ['Дата'],
+              ['День_недели', 'Месяц', 'Год', 'Выходной', 'Дни_с_начала', 'День_года', 'Неделя_года', 'Квартал',
+               'Sin_День', 'Cos_День', 'Sin_Неделя', 'Cos_Неделя', 'Sin_Месяц', 'Cos_Месяц',
+               'День_месяца', 'Начало_месяца', 'Конец_месяца', 'Зарплатный_день']),
+        stage('promotion', claude.create_promotion_features,
+              ['Номер_акции', 'Магазин', 'Дата', 'Акция_активна', 'SKU', 'Скидка_фактическая', SALES],
+              ['Тип_акции_расширенный', 'Является_уценкой', 'Акций_в_календаре_30д', 'Кол_акций_в_магазине',
+               'Акций_за_30д_товар', 'Скидка_средняя_товар', 'Был_на_акции_7д', 'Продажи_на_акции', 'Эффективность_акции'],
+              promotions_df=promotions_df),
+        stage('holiday', claude.add_holiday_features, ['Дата', 'Месяц'], _holiday_outputs, holidays_df=holidays_df),
+        stage('volume', claude.create_advanced_volume_features, ['Весовой', 'Магазин', SALES, 'Цена_со_скидкой'],
+              _volume_outputs),
+        stage('store', claude.create_store_features, ['Магазин', 'Дата', 'SKU', SALES],
+              ['Активность_магазина', 'Ранг_магазина', 'Доля_в_магазине', 'Продажи_относительно_среднего']),
+    ]
+
+def time_series_stages(time_series_backend='pandas', lags=claude.LAG_DAYS, windows=claude.ROLLING_WINDOWS,
+                       rolling_columns=None, trends=None, n_jobs=1):
+    """
+    Лаги, окна и тренды: на панели - одним этапом, в pandas - тремя;
+    n_jobs != 1 (pandas, полный набор признаков) - одним этапом в пуле процессов (parallel_time_series_features)
+    """
+    if time_series_backend == 'pandas' and n_jobs != 1:
+        return [stage(
+            'time_series_parallel', claude.parallel_time_series_features, claude.SERIES_LOCAL_INPUTS,
+            _parallel_outputs, reorders=True, n_jobs=n_jobs
+        )]
+    if time_series_backend == 'panel':
+        return [stage(
+            'time_series_panel', panel_time_series_features, SERIES_INPUTS, _panel_outputs,
+            lags=lags, windows=windows, rolling_stats=claude.ROLLING_STATS,
+            rolling_columns=rolling_columns, trends=trends
+        )]
+    return [
+        stage('lags', claude.create_lags_vectorized, SERIES_INPUTS, _lag_outputs, lags=lags),
+        stage('rolling', claude.create_rolling_vectorized, SERIES_INPUTS, _rolling_outputs, reorders=True,
+              windows=windows, columns=rolling_columns),
+        stage('trends', claude.compute_trends, SERIES_INPUTS + ['День_года', 'Lag_1', 'MA_7', 'MA_30'],
+              _trend_outputs, features=trends),
+    ]
+
+def cross_stage():
+    return stage('cross', claude.create_cross_features,
+                 ['SKU', 'Магазин', 'День_недели', 'Весовой', 'Акция_активна', 'Выходной'], CROSS_OUTPUTS)
+
+def training_stages(holidays_df, promotions_df, time_series_backend='pandas', n_jobs=1):
+    """Этапы feature_engineering в том же порядке"""
+    return common_stages(holidays_df, promotions_df) + time_series_stages(time_series_backend, n_jobs=n_jobs) + [
+        cross_stage(),
+        stage('target_encoding', claude.create_target_encodings, ['Дата', SALES] + TARGET_ENCODED,
+              [f'{feature}_target_mean' for feature in TARGET_ENCODED]),
+        stage('target', claude.transform_target_variable, [SALES, 'Весовой'],
+              [SALES, 'log_Чистые_продажи', 'boxcox_Чистые_продажи']),
+    ]
+
+def prediction_stages(holidays_df, promotions_df, features=None, time_series_backend='pandas'):
+    """Этапы prepare_data_for_prediction (с пропуском ненужных модели признаков)"""
+    plan = claude.inference_feature_plan(features)
+    stages = []
+    for stage_def in common_stages(holidays_df, promotions_df):
+        if plan['holidays'] or stage_def['name'] != 'holiday':
+            stages.append(stage_def)
+        if stage_def['name'] == 'volume':
+            stages.append(stage('unknown_target', claude.fill_unknown_target, [SALES], [SALES]))
+    return stages + time_series_stages(
+        time_series_backend, lags=plan['lags'], windows=plan['windows'],
+        rolling_columns=plan['rolling_columns'], trends=plan['trends']
+    ) + [cross_stage()]
+
+def _hash_value(h, value):
+    if isinstance(value, pd.DataFrame):
+        h.update(json.dumps([list(map(str, value.columns)), list(map(str, value.dtypes))]).encode('utf-8'))
+        h.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+    else:
+        h.update(json.dumps(value, default=str, sort_keys=True).encode('utf-8'))
+
+def _is_project_function(value):
+    return isinstance(value, types.FunctionType) and (value.__module__ or '').startswith('claude')
+
+def _referenced_names(code):
+    """Глобальные имена и атрибуты, упомянутые в коде функции (включая вложенные функции и lambda)"""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _referenced_names(const)
+    return names
+
+def code_closure(funcs):
+    """Функции funcs и все функции модулей проекта, до которых они доходят (по имени или module.имя)"""
+    seen, queue = {}, list(funcs)
+    while queue:
+        func = queue.pop()
+        key = f"{func.__module__}.{func.__qualname__}"
+        if key in seen:
+            continue
+        seen[key] = func
+        names = _referenced_names(func.__code__)
+        modules = [value for value in (func.__globals__.get(name) for name in names)
+                   if isinstance(value, types.ModuleType) and value.__name__.startswith('claude')]
+        candidates = [func.__globals__.get(name) for name in names]
+        candidates += [getattr(module, name, None) for module in modules for name in names]
+        queue.extend(value for value in candidates if _is_project_function(value))
+    return [seen[key] for key in sorted(seen)]
+
+def stage_key(stage_def, df):
+    """Отпечаток: версия кода, параметры и входные колонки этапа (с индексом и порядком строк)"""
+    h = hashlib.md5()
+    h.update(f"{stage_def['name']}:{STAGE_CODE_VERSION}".encode('utf-8'))
+    for func in code_closure(stage_def['code']):
+        h.update(inspect.getsource(func).encode('utf-8'))
+    for name in sorted(stage_def['params']):
+        h.update(name.encode('utf-8'))
+        _hash_value(h, stage_def['params'][name])
+    inputs = df.columns if stage_def['inputs'] is None else [col for col in stage_def['inputs'] if col in df.columns]
+    _hash_value(h, df[list(inputs)])
+    return h.hexdigest()[:16]
+
+def enforce_disk_budget(cache_dir, disk_budget_mb):
+    """LRU: удаление записей с самым старым временем использования, пока кэш больше бюджета"""
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith('.pkl'):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total, budget = sum(size for _, size, _ in entries), disk_budget_mb * 1024 ** 2
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        os.remove(path)
+        total -= size
+        print(f"DEBUG: Кэш этапов: удалена запись {os.path.basename(path)}")
+
+def run_stages(df, stages, cache_dir=STAGE_CACHE_DIR, disk_budget_mb=2048):
+    """Выполнение цепочки этапов с загрузкой неизменившихся из кэша"""
+    os.makedirs(cache_dir, exist_ok=True)
+    hits = 0
+    for stage_def in stages:
+        t0 = time.time()
+        path = os.path.join(cache_dir, f"{stage_def['name']}-{stage_key(stage_def, df)}.pkl")
+
+        if os.path.exists(path):
+            entry = joblib.load(path)
+            os.utime(path)  # время последнего использования для LRU
+            if entry['index'] is not None:
+                df = df.loc[entry['index']]
+            for col in entry['columns'].columns:
+                df[col] = entry['columns'][col]
+            hits += 1
+            print(f"DEBUG: Этап {stage_def['name']}: из кэша за {time.time() - t0:.2f}s")
+            continue
+
+        before = set(df.columns)
+        declared = stage_def['outputs']
+        declared = set(declared(df, stage_def['params']) if callable(declared) else declared)
+        df = stage_def['func'](df, **stage_def['params'])
+        outputs = [col for col in df.columns if col in declared or col not in before]
+        joblib.dump({
+            'columns': df[outputs],
+            'index': df.index if stage_def['reorders'] else None,
+        }, path)
+        print(f"DEBUG: Этап {stage_def['name']}: вычислен за {time.time() - t0:.2f}s, колонок: {len(outputs)}")
+
+    enforce_disk_budget(cache_dir, disk_budget_mb)
+    print(f"DEBUG: Кэш этапов: {hits} из {len(stages)} этапов загружены")
+    return df
+
+def cached_feature_engineering(sales_df, holidays_df, promotions_df, time_series_backend='pandas', n_jobs=1,
+                               cache_dir=STAGE_CACHE_DIR, disk_budget_mb=2048):
+    print("DEBUG: Начало создания признаков (кэш этапов)")
+    sales_df = run_stages(
+        sales_df, training_stages(holidays_df, promotions_df, time_series_backend, n_jobs), cache_dir, disk_budget_mb
+    )
+    print("DEBUG: Завершение создания признаков. Размер DataFrame:", sales_df.shape)
+    return sales_df
+
+def cached_prediction_features(data, holidays_df, promotions_df, features=None, time_series_backend='pandas',
+                               cache_dir=STAGE_CACHE_DIR, disk_budget_mb=2048):
+    print("DEBUG: Подготовка данных для прогнозирования (кэш этапов)")
+    return run_stages(
+        data, prediction_stages(holidays_df, promotions_df, features, time_series_backend), cache_dir, disk_budget_mb
+    )